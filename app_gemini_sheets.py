@@ -1,12 +1,61 @@
 import streamlit as st
-import google.generativeai as genai
-import pandas as pd
-from datetime import datetime
+from datetime import datetime, timedelta
 import uuid
 import os
 import json
-import gspread
-from google.oauth2.service_account import Credentials
+import random
+import sqlite3
+import threading
+import time
+import collections
+import hashlib
+import hmac
+import secrets
+import importlib
+import re
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import gazetteer
+import gemini_cassette
+
+# スクリプト1回分（再実行ごと）の実行時間の計測開始
+_script_started = time.perf_counter()
+
+class LazyModule:
+    """属性に最初にアクセスした時点でimportするモジュール（起動時に重いSDKを読み込まない）"""
+    
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+    
+    def load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+    
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+# Gemini・Google SheetsのSDK（使う処理が最初に呼ばれたとき、またはバックグラウンドの先読みで読み込む）
+genai = LazyModule("google.generativeai")
+glm = LazyModule("google.ai.generativelanguage")
+protos = LazyModule("google.generativeai.protos")
+content_types = LazyModule("google.generativeai.types.content_types")
+generation_types = LazyModule("google.generativeai.types.generation_types")
+google_exceptions = LazyModule("google.api_core.exceptions")
+gspread = LazyModule("gspread")
+service_account = LazyModule("google.oauth2.service_account")
+google_auth_requests = LazyModule("google.auth.transport.requests")
+LAZY_MODULES = [
+    genai, glm, protos, content_types, generation_types,
+    google_exceptions, gspread, service_account, google_auth_requests,
+]
+# 集計ページでのみ使う（先読みしない）
+pd = LazyModule("pandas")
+np = LazyModule("numpy")
+# セッションの保存先にRedisを使う場合のみ
+redis = LazyModule("redis")
 
 # ページ設定
 st.set_page_config(
@@ -18,6 +67,144 @@ st.set_page_config(
 # APIキーの設定（環境変数から読み込み）
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
 
+# 複数のAPIキー（カンマ区切り）。クォータを超えたキーは休ませて別のキーに振り分ける
+GEMINI_API_KEYS = [key.strip() for key in os.getenv("GEMINI_API_KEYS", "").split(",") if key.strip()]
+if not GEMINI_API_KEYS and GEMINI_API_KEY:
+    GEMINI_API_KEYS = [GEMINI_API_KEY]
+if not GEMINI_API_KEY and GEMINI_API_KEYS:
+    GEMINI_API_KEY = GEMINI_API_KEYS[0]
+
+# 使用するGeminiモデル
+GEMINI_MODEL_NAME = "gemini-2.5-flash-lite"
+
+# 全てのキーで主モデルのクォータが尽きたときに使う代替モデル（カンマ区切り、優先順）
+GEMINI_FALLBACK_MODELS = [name.strip() for name in os.getenv("GEMINI_FALLBACK_MODELS", "").split(",") if name.strip()]
+
+# 429を受けたキーを休ませる秒数（連続するたびに倍、日次上限なら最大まで）
+GEMINI_KEY_COOLDOWN = float(os.getenv("GEMINI_KEY_COOLDOWN", "60"))
+GEMINI_KEY_MAX_COOLDOWN = float(os.getenv("GEMINI_KEY_MAX_COOLDOWN", "3600"))
+
+# 会話コンテキストの方針：直近Nターンはそのまま送り、それより古いターンは要約に置き換える（0で無効）
+CONTEXT_KEEP_TURNS = int(os.getenv("GEMINI_CONTEXT_KEEP_TURNS", "4"))
+
+# システムプロンプトをGeminiのコンテキストキャッシュに登録して全セッションで参照するか
+GEMINI_CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE", "0") == "1"
+GEMINI_CONTEXT_CACHE_TTL = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL", "3600"))
+GEMINI_CONTEXT_CACHE_REFRESH = 300  # 期限のこの秒数前にTTLを延長
+GEMINI_CONTEXT_CACHE_RETRY = 600  # 作成に失敗したらこの秒数はsystem_instructionで続ける
+
+# Gemini呼び出しのレート制限（APIキー×モデルごとの上限に合わせて設定）
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "15"))
+GEMINI_TPM = int(os.getenv("GEMINI_TPM", "250000"))
+GEMINI_MAX_QUEUE_WAIT = float(os.getenv("GEMINI_MAX_QUEUE_WAIT", "45"))
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "3"))
+GEMINI_BACKOFF_BASE = float(os.getenv("GEMINI_BACKOFF_BASE", "2"))
+GEMINI_BACKOFF_MAX = float(os.getenv("GEMINI_BACKOFF_MAX", "20"))
+
+# トークン使用量の上限（プロセスごと、直近24時間の入力＋出力トークン数。0で無制限）
+GEMINI_DAILY_TOKEN_BUDGET = int(os.getenv("GEMINI_DAILY_TOKEN_BUDGET", "0"))
+GEMINI_BUDGET_REDUCE_AT = float(os.getenv("GEMINI_BUDGET_REDUCE_AT", "0.8"))  # この割合を超えたら応答を短くする
+GEMINI_BUDGET_STOP_AT = float(os.getenv("GEMINI_BUDGET_STOP_AT", "0.95"))  # この割合を超えたら新しい調査を受け付けない
+GEMINI_BUDGET_MAX_OUTPUT_TOKENS = int(os.getenv("GEMINI_BUDGET_MAX_OUTPUT_TOKENS", "512"))
+
+# 費用の見積もりに使う単価（100万トークンあたりのUSD、既定は gemini-2.5-flash-lite の料金）
+GEMINI_PRICE_INPUT = float(os.getenv("GEMINI_PRICE_INPUT", "0.10"))
+GEMINI_PRICE_CACHED = float(os.getenv("GEMINI_PRICE_CACHED", "0.025"))
+GEMINI_PRICE_OUTPUT = float(os.getenv("GEMINI_PRICE_OUTPUT", "0.40"))
+
+# 基本情報の選択肢
+AGE_GROUPS = ["10代", "20代", "30代", "40代", "50代", "60代", "70代以上"]
+USAGE_FREQUENCIES = ["ほぼ毎日", "週に数回", "月に数回", "年に数回", "ほとんど利用しない"]
+
+# 調査で聞き出したい項目（SYSTEM_PROMPTの「データとして欲しい情報」）。対話から抽出して要約シートに保存する
+SURVEY_SLOTS = {
+    "route": "利用区間",
+    "usual_time": "よく利用する時間帯",
+    "morning_minutes": "朝の所要時間",
+    "noon_minutes": "昼の所要時間",
+    "evening_minutes": "夕方の所要時間",
+    "fastest": "最速の時間帯と所要時間",
+    "slowest": "最遅の時間帯と所要時間",
+    "spread": "時間帯による差",
+    "causes": "変動の要因",
+    "impact": "行動への影響",
+}
+# 項目の抽出（SLOT_EXTRACT_EVERY回の回答ごとにバックグラウンドで実行し、揃ったら調査員に終了を提案させる）
+SLOT_TRACKING = os.getenv("SLOT_TRACKING", "1") == "1"
+SLOT_REQUIRED = [
+    key.strip() for key in os.getenv("SLOT_REQUIRED", ",".join(SURVEY_SLOTS)).split(",") if key.strip()
+]
+SLOT_EXTRACT_EVERY = int(os.getenv("SLOT_EXTRACT_EVERY", "3"))
+SLOT_WORKERS = int(os.getenv("SLOT_WORKERS", "4"))
+SLOT_FINAL_WAIT = float(os.getenv("SLOT_FINAL_WAIT", "5"))  # 終了時に最後の抽出を待つ秒数
+
+# 挨拶キャッシュ：地域が未記入のときは、年齢層×利用頻度ごとに事前生成した挨拶を使う（0で無効）
+GREETING_CACHE_VARIANTS = int(os.getenv("GREETING_CACHE_VARIANTS", "3"))
+GREETING_CACHE_PATH = os.getenv("GREETING_CACHE_PATH", "survey_data/greetings.json")
+# 事前生成の1組（年齢層×利用頻度）あたりの試行回数の上限と、失敗・空・重複のあとの待ち時間（秒、倍々に延ばす）
+GREETING_MAX_ATTEMPTS = int(os.getenv("GREETING_MAX_ATTEMPTS", "6"))
+GREETING_RETRY_DELAY = float(os.getenv("GREETING_RETRY_DELAY", "30"))
+GREETING_RETRY_MAX_DELAY = float(os.getenv("GREETING_RETRY_MAX_DELAY", "600"))
+
+# 集計ページ（?dashboard=1）：要約シートの新しい行を読み込む最短間隔（秒）と、所要時間の分布の刻み（分）
+DASHBOARD_REFRESH_INTERVAL = float(os.getenv("DASHBOARD_REFRESH_INTERVAL", "60"))
+DASHBOARD_BIN_MINUTES = 5
+DASHBOARD_BINS = 24  # 0〜120分（それ以上は最後の区間）
+
+# 「お住まいの場所」を地域コード・座標に正規化する地名辞書（gazetteer.py build で作成、なければ正規化しない）
+GAZETTEER_PATH = os.getenv("GAZETTEER_PATH", "survey_data/gazetteer.idx")
+
+# 起動後最初のアクセス時にGemini・Google Sheetsへの接続をバックグラウンドで確立するか
+SURVEY_WARMUP = os.getenv("SURVEY_WARMUP", "1") == "1"
+
+# 計測値をPrometheus形式で公開するポート（未設定なら公開しない）と管理者ページのパスワード
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD", "")
+
+# Gemini呼び出しの記録・再生（"record"で実際の呼び出しをカセットに記録、"replay"で記録から応答を返す）
+GEMINI_CASSETTE_MODE = os.getenv("GEMINI_CASSETTE_MODE", "")
+GEMINI_CASSETTE_DIR = os.getenv("GEMINI_CASSETTE_DIR", "survey_data/cassettes")
+GEMINI_REPLAY_SPEED = float(os.getenv("GEMINI_REPLAY_SPEED", "0"))  # 記録時の遅延の何倍で再生するか（0で遅延なし）
+if GEMINI_CASSETTE_MODE == "replay":
+    # 再生時はGeminiに接続しないので、APIキーがなくても仮のキーで動かし、コンテキストキャッシュも作らない
+    GEMINI_API_KEYS = GEMINI_API_KEYS or ["replay"]
+    GEMINI_API_KEY = GEMINI_API_KEY or GEMINI_API_KEYS[0]
+    GEMINI_CONTEXT_CACHE = False
+
+# 応答をストリーミング表示するか（"0"で従来どおり全文を待ってから表示）
+GEMINI_STREAMING = os.getenv("GEMINI_STREAMING", "1") == "1"
+# 対話欄のフラグメントで描画するメッセージ数の上限（超えたらスクリプト全体を再実行して履歴側に移す）
+CHAT_FRAGMENT_MAX_MESSAGES = int(os.getenv("CHAT_FRAGMENT_MAX_MESSAGES", "6"))
+
+# 保存キュー設定（完了したセッションはまずローカルに書き込み、バックグラウンドで送信）
+OUTBOX_PATH = os.getenv("SURVEY_OUTBOX_PATH", "survey_data/outbox.sqlite3")
+OUTBOX_FLUSH_INTERVAL = float(os.getenv("SURVEY_OUTBOX_FLUSH_INTERVAL", "15"))
+OUTBOX_COALESCE_SECONDS = float(os.getenv("SURVEY_OUTBOX_COALESCE_SECONDS", "3"))
+OUTBOX_MAX_BACKOFF = float(os.getenv("SURVEY_OUTBOX_MAX_BACKOFF", "300"))
+OUTBOX_BATCH_ROWS = int(os.getenv("SURVEY_OUTBOX_BATCH_ROWS", "2000"))
+
+# ワークシートの分割（"monthly"で月ごと、"rows"で行数のみで分割、空なら summary / details の1枚ずつ）
+# シャードは別のスプレッドシートファイルとして作る（セル数の上限は1ファイルの全シートの合計にかかるため）
+# どちらの方式でも、1つがSHEET_SHARD_MAX_ROWS行に達したら次のファイル（例：details_2026-10_002）に切り替える
+SHEET_SHARD_MODE = os.getenv("SHEET_SHARD_MODE", "")
+SHEET_SHARD_MAX_ROWS = int(os.getenv("SHEET_SHARD_MAX_ROWS", "100000"))
+SHEET_SHARD_FOLDER_ID = os.getenv("SHEET_SHARD_FOLDER_ID", "")  # シャードのファイルを作るDriveのフォルダ（空ならサービスアカウントのドライブ直下）
+SHEET_SHARD_SHARE_WITH = [
+    email.strip() for email in os.getenv("SHEET_SHARD_SHARE_WITH", "").split(",") if email.strip()
+]  # 作ったシャードのファイルを編集者として共有するアカウント
+
+# 対話中のセッションの保存先（各ターンの後に書き込み、どのレプリカからでも再開用のクッキーで再開できる）
+# SESSION_STORE_URL に redis://〜 を指定するとRedis互換のサーバー、未指定ならローカルのSQLite
+SESSION_STORE_URL = os.getenv("SESSION_STORE_URL", "")
+SESSION_STORE_PATH = os.getenv("SESSION_STORE_PATH", "survey_data/sessions.sqlite3")
+SESSION_RETENTION_DAYS = float(os.getenv("SESSION_RETENTION_DAYS", "7"))  # 戻ってこなかったセッションを残す日数
+# 最後の操作から一定時間たったセッションはメモリから外す（戻ってきたら保存先から復元）
+SESSION_IDLE_TIMEOUT = float(os.getenv("SESSION_IDLE_TIMEOUT", "900"))
+SESSION_SWEEP_INTERVAL = float(os.getenv("SESSION_SWEEP_INTERVAL", "60"))
+# 再開用トークンを入れるクッキー（URLには入れないので、アドレスを共有しても他の人は再開できない）
+RESUME_COOKIE = "bus_survey_resume"
+
 # Google Sheets設定
 SCOPES = [
     'https://www.googleapis.com/auth/spreadsheets',
@@ -25,15 +212,15 @@ SCOPES = [
 ]
 
 # セッション状態の初期化
+# （対話の履歴・チャットなど大きいものは LiveSession としてプロセス内の表に置き、アイドル時に退避する）
 if "session_id" not in st.session_state:
     st.session_state.session_id = str(uuid.uuid4())
-    st.session_state.messages = []
+    st.session_state.client_id = uuid.uuid4().hex  # このブラウザセッションの識別子（調査を再開しても変わらない）
+    st.session_state.resume_token = None
+    st.session_state.session_conflict = False
     st.session_state.user_info = {}
     st.session_state.survey_started = False
     st.session_state.survey_completed = False
-    st.session_state.chat = None
-    st.session_state.sheets_client = None
-    st.session_state.spreadsheet = None
     st.session_state.error_fallback_shown = False
 
 # システムプロンプト
@@ -181,12 +368,131 @@ SYSTEM_PROMPT = """あなたは交通政策の研究者として、公共交通
 
 回答は簡潔に、1〜3文程度にしてください。"""
 
+# 計測する処理時間（秒）とその説明
+TIMINGS = {
+    "gemini_ttfb": "Gemini呼び出しの最初の応答までの時間（待ち行列を含む）",
+    "gemini_total": "Gemini呼び出しの応答完了までの時間（待ち行列を含む）",
+    "sheets_write": "Google Sheetsへの書き込み時間",
+    "sheets_credentials": "Google Sheetsの認証・接続時間",
+    "script_run": "スクリプト1回分の実行時間",
+}
+TIMING_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64]
+
+class Metrics:
+    """プロセス内の計測値（処理時間のヒストグラムと件数カウンタ）"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {
+            name: {"buckets": [0] * (len(TIMING_BUCKETS) + 1), "sum": 0.0, "count": 0}
+            for name in TIMINGS
+        }
+        self.counters = collections.Counter()
+    
+    def observe(self, name, seconds):
+        """処理時間を記録"""
+        with self.lock:
+            histogram = self.histograms[name]
+            index = next((i for i, bound in enumerate(TIMING_BUCKETS) if seconds <= bound), len(TIMING_BUCKETS))
+            histogram["buckets"][index] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+    
+    def count(self, name, label=""):
+        """件数を1増やす"""
+        with self.lock:
+            self.counters[(name, label)] += 1
+    
+    def totals(self, name):
+        """記録した件数と合計秒数"""
+        with self.lock:
+            histogram = self.histograms[name]
+            return histogram["count"], histogram["sum"]
+    
+    def quantile(self, name, q):
+        """ヒストグラムから分位点を推定（バケット内は線形補間）"""
+        with self.lock:
+            histogram = self.histograms[name]
+            buckets = list(histogram["buckets"])
+            total = histogram["count"]
+        if total == 0:
+            return None
+        rank = q * total
+        seen = 0
+        lower = 0.0
+        for i, n in enumerate(buckets):
+            upper = TIMING_BUCKETS[i] if i < len(TIMING_BUCKETS) else TIMING_BUCKETS[-1]
+            if n and seen + n >= rank:
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+            lower = upper
+        return TIMING_BUCKETS[-1]
+    
+    def to_prometheus(self):
+        """Prometheusのテキスト形式で出力"""
+        lines = []
+        with self.lock:
+            for name, histogram in self.histograms.items():
+                metric = f"bus_survey_{name}_seconds"
+                lines.append(f"# HELP {metric} {TIMINGS[name]}")
+                lines.append(f"# TYPE {metric} histogram")
+                cumulative = 0
+                for bound, n in zip(TIMING_BUCKETS + ["+Inf"], histogram["buckets"]):
+                    cumulative += n
+                    lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+                lines.append(f"{metric}_sum {histogram['sum']}")
+                lines.append(f"{metric}_count {histogram['count']}")
+            
+            names = sorted({name for name, _ in self.counters})
+            for name in names:
+                metric = f"bus_survey_{name}_total"
+                lines.append(f"# TYPE {metric} counter")
+                for (counter_name, label), value in sorted(self.counters.items()):
+                    if counter_name != name:
+                        continue
+                    if label:
+                        lines.append(f'{metric}{{category="{label}"}} {value}')
+                    else:
+                        lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+@st.cache_resource
+def get_metrics():
+    """計測値（プロセス全体で共有）"""
+    return Metrics()
+
+def _make_metrics_handler(metrics):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.to_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        
+        def log_message(self, format, *args):
+            pass
+    
+    return MetricsHandler
+
+@st.cache_resource
+def _metrics_server():
+    """Prometheus形式の /metrics を別ポートで公開（プロセスで1つ）"""
+    server = ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), _make_metrics_handler(get_metrics()))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
 def initialize_google_sheets():
-    """Google Sheetsクライアントを初期化"""
+    """Google Sheetsクライアントを初期化（スプレッドシート・クライアント・認証情報を返す）"""
     try:
         # Streamlit Secretsから認証情報を取得
         if "gcp_service_account" in st.secrets:
-            credentials = Credentials.from_service_account_info(
+            credentials = service_account.Credentials.from_service_account_info(
                 st.secrets["gcp_service_account"],
                 scopes=SCOPES
             )
@@ -198,162 +504,1977 @@ def initialize_google_sheets():
             elif "spreadsheet_key" in st.secrets:
                 spreadsheet = client.open_by_key(st.secrets["spreadsheet_key"])
             else:
-                return None, "スプレッドシートのURLまたはキーが設定されていません"
+                return None, None, None, "スプレッドシートのURLまたはキーが設定されていません"
             
-            return spreadsheet, None
+            return spreadsheet, client, credentials, None
         else:
-            return None, "Google Cloud認証情報が設定されていません"
+            return None, None, None, "Google Cloud認証情報が設定されていません"
     
     except Exception as e:
-        return None, f"Google Sheets初期化エラー: {str(e)}"
+        return None, None, None, f"Google Sheets初期化エラー: {str(e)}"
 
-def save_to_google_sheets(spreadsheet):
-    """対話履歴をGoogle Sheetsに保存"""
-    try:
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+@st.cache_resource
+def _sheets_connection():
+    """Google Sheets接続の共有状態（プロセス全体で1つ）"""
+    return {"lock": threading.Lock(), "spreadsheet": None, "client": None, "credentials": None, "error": None}
+
+def get_spreadsheet(reconnect=False):
+    """共有のスプレッドシートハンドルを取得（初回・再接続時のみ認証とオープンを行う）
+    
+    reconnectでは新しい接続を開けたときだけ差し替え、開けなければ今のハンドルを残してエラーを返す。
+    """
+    conn = _sheets_connection()
+    with conn["lock"]:
+        if conn["spreadsheet"] is None or reconnect:
+            started = time.perf_counter()
+            spreadsheet, client, credentials, error = initialize_google_sheets()
+            get_metrics().observe("sheets_credentials", time.perf_counter() - started)
+            conn["error"] = error
+            if spreadsheet is None:
+                return None, error
+            if conn["spreadsheet"] is not None:
+                invalidate_worksheet_cache(conn["spreadsheet"])
+            conn["spreadsheet"] = spreadsheet
+            conn["client"] = client
+            conn["credentials"] = credentials
+        
+        # アクセストークンの期限切れはロック内でまとめて更新
+        # （各スレッドのリクエストが同時にリフレッシュしないようにする）
+        credentials = conn["credentials"]
+        if credentials.token is not None and not credentials.valid:
+            try:
+                started = time.perf_counter()
+                credentials.refresh(google_auth_requests.Request())
+                get_metrics().observe("sheets_credentials", time.perf_counter() - started)
+            except Exception as e:
+                conn["spreadsheet"] = None
+                conn["client"] = None
+                conn["credentials"] = None
+                conn["error"] = f"Google Sheets認証更新エラー: {str(e)}"
+                return None, conn["error"]
+        
+        return conn["spreadsheet"], None
+
+def last_spreadsheet_error():
+    """直近の接続で起きたエラー（接続を試みず、まだ接続していなければNone）"""
+    return _sheets_connection()["error"]
+
+# シートのヘッダー定義
+SUMMARY_HEADER = [
+    "session_id", "timestamp", "age_group", "usage_frequency",
+    "location", "message_count", "completed"
+] + [f"slot_{key}" for key in SURVEY_SLOTS] + ["area_code", "latitude", "longitude"] + [
+    "gemini_calls", "prompt_tokens", "cached_tokens", "output_tokens", "cost_usd"
+]
+DETAIL_HEADER = [
+    "session_id", "timestamp", "age_group", "usage_frequency",
+    "location", "message_number", "role", "content"
+]
+
+# シートごとの作成時の大きさとヘッダー
+SHEET_LAYOUT = {
+    "summary": ("1000", str(len(SUMMARY_HEADER)), SUMMARY_HEADER),
+    "details": ("10000", "10", DETAIL_HEADER),
+}
+
+# 分割時のシャードのファイル一覧と、session_id からシャードを引く索引シート（どちらもメインのスプレッドシートに置く）
+SHARD_FILES_SHEET = "shard_files"
+SHARD_FILES_HEADER = ["sheet", "shard", "spreadsheet_id", "url", "created_at"]
+SHARD_INDEX_SHEET = "shard_index"
+SHARD_INDEX_HEADER = ["session_id", "sheet", "shard", "timestamp"]
+
+@st.cache_resource
+def _worksheet_cache():
+    """ワークシートハンドルのキャッシュ（プロセス全体で共有）"""
+    return {"lock": threading.Lock(), "sheets": {}}
+
+def get_worksheet(spreadsheet, title, rows, cols, header):
+    """ワークシートを取得（なければ作成）し、ヘッダー確認済みのハンドルをキャッシュする"""
+    cache = _worksheet_cache()
+    key = (spreadsheet.id, title)
+    with cache["lock"]:
+        worksheet = cache["sheets"].get(key)
+        if worksheet is not None:
+            return worksheet
         
-        # 要約シートに保存
         try:
-            summary_sheet = spreadsheet.worksheet("summary")
-        except:
-            # シートがなければ作成
-            summary_sheet = spreadsheet.add_worksheet(title="summary", rows="1000", cols="10")
-            # ヘッダー行を追加
-            summary_sheet.append_row([
-                "session_id", "timestamp", "age_group", "usage_frequency", 
-                "location", "message_count", "completed"
-            ])
-        
-        # 要約データを追加
-        summary_sheet.append_row([
-            st.session_state.session_id,
+            worksheet = spreadsheet.worksheet(title)
+            # 既存シートのヘッダー行が空、または列が追加される前のものなら更新（確認は初回のみ）
+            existing = worksheet.row_values(1)
+            if existing != header and header[:len(existing)] == existing:
+                if worksheet.col_count < len(header):
+                    worksheet.add_cols(len(header) - worksheet.col_count)
+                worksheet.update(values=[header], range_name="A1")
+        except gspread.exceptions.WorksheetNotFound:
+            # シートがなければ作成してヘッダー行を追加
+            worksheet = spreadsheet.add_worksheet(title=title, rows=rows, cols=cols)
+            worksheet.append_row(header)
+        
+        cache["sheets"][key] = worksheet
+        return worksheet
+
+def invalidate_worksheet_cache(spreadsheet):
+    """スプレッドシート（とシャードのファイル）のワークシートキャッシュを破棄（シート削除などに備える）"""
+    # 使用行数の見込みとファイル一覧も次回読み直す
+    shards = _shard_state()
+    with shards["lock"]:
+        ids = {spreadsheet.id} | set(shards["handles"])
+        for key in [k for k in shards["current"] if k[0] == spreadsheet.id]:
+            del shards["current"][key]
+        shards["files"] = None
+        shards["handles"].clear()
+    cache = _worksheet_cache()
+    with cache["lock"]:
+        for key in [k for k in cache["sheets"] if k[0] in ids]:
+            del cache["sheets"][key]
+
+@st.cache_resource
+def _shard_state():
+    """シャードのファイル一覧・書き込み先の番号と使用行数（プロセス全体で共有）"""
+    return {
+        "lock": threading.Lock(),
+        "current": {},       # (スプレッドシートID, シート, 期間) -> [番号, 使用行数]
+        "files": None,       # シャード名 -> スプレッドシートID（未読み込みならNone）
+        "handles": {},       # スプレッドシートID -> 開いたシャードのファイル
+    }
+
+def shard_period(timestamp):
+    """行のタイムスタンプから分割の期間を求める（月ごとの分割でなければ空）"""
+    return timestamp[:7] if SHEET_SHARD_MODE == "monthly" else ""
+
+def shard_title(sheet, period, number):
+    """シャードのワークシート名（details_001, details_2026-10_002 など）
+    
+    1つ目にも番号を付け、分割前にメインのスプレッドシートに書いた summary / details と区別する。
+    """
+    parts = [sheet]
+    if period:
+        parts.append(period)
+    parts.append(f"{number:03d}")
+    return "_".join(parts)
+
+def parse_shard_title(sheet, title):
+    """シャード名を (期間, 番号) に分解（sheetのシャードでなければNone）"""
+    match = re.fullmatch(rf"{re.escape(sheet)}(?:_(\d{{4}}-\d{{2}}))?(?:_(\d{{3,}}))?", title)
+    if match is None:
+        return None
+    return match.group(1) or "", int(match.group(2) or 1)
+
+def _read_shard_files(directory):
+    """ファイル一覧シートの行を {シャード名: スプレッドシートID} にする"""
+    files = {}
+    for row in directory.get_all_values()[1:]:
+        # 同じシャードを複数のプロセスが同時に作ったときは、先に登録されたファイルにそろえる
+        if len(row) >= 3 and row[1] and row[1] not in files:
+            files[row[1]] = row[2]
+    return files
+
+def _shard_files(spreadsheet, reload=False):
+    """シャードのファイル一覧 {シャード名: スプレッドシートID}（初回と reload のときだけ一覧シートを読む、ロックは呼び出し側で取る）"""
+    shards = _shard_state()
+    if shards["files"] is None or reload:
+        directory = get_worksheet(
+            spreadsheet, SHARD_FILES_SHEET, "1000", str(len(SHARD_FILES_HEADER)), SHARD_FILES_HEADER
+        )
+        shards["files"] = _read_shard_files(directory)
+    return shards["files"]
+
+def _create_shard_file(spreadsheet, sheet, title):
+    """シャードを新しいスプレッドシートファイルとして作り、ファイル一覧シートに登録する（ロックは呼び出し側で取る）"""
+    client = _sheets_connection()["client"]
+    if client is None:
+        raise RuntimeError("Google Sheetsに接続していません")
+    rows, cols, header = SHEET_LAYOUT[sheet]
+    shard = client.create(f"{spreadsheet.title} {title}", folder_id=SHEET_SHARD_FOLDER_ID or None)
+    worksheet = shard.sheet1
+    worksheet.update_title(title)
+    worksheet.resize(rows=int(rows), cols=int(cols))
+    worksheet.update(values=[header], range_name="A1")
+    for email in SHEET_SHARD_SHARE_WITH:
+        shard.share(email, perm_type="user", role="writer", notify=False)
+    
+    directory = get_worksheet(
+        spreadsheet, SHARD_FILES_SHEET, "1000", str(len(SHARD_FILES_HEADER)), SHARD_FILES_HEADER
+    )
+    directory.append_row([sheet, title, shard.id, shard.url, datetime.now().strftime("%Y-%m-%d %H:%M:%S")])
+    _shard_state()["handles"][shard.id] = shard
+
+def _open_shard_file(spreadsheet_id):
+    """シャードのファイルを開く（開いたハンドルはプロセス内で使い回す、ロックは呼び出し側で取る）"""
+    handles = _shard_state()["handles"]
+    if spreadsheet_id not in handles:
+        client = _sheets_connection()["client"]
+        if client is None:
+            raise RuntimeError("Google Sheetsに接続していません")
+        handles[spreadsheet_id] = client.open_by_key(spreadsheet_id)
+    return handles[spreadsheet_id]
+
+def _shard_worksheet(spreadsheet, sheet, title, create=False):
+    """シャードのワークシート（ファイルがなければ create のときだけ作り、それ以外はNone、ロックは呼び出し側で取る）"""
+    files = _shard_files(spreadsheet)
+    if title not in files:
+        # 他のプロセスが先に作っていないか一覧を読み直してから作る
+        files = _shard_files(spreadsheet, reload=True)
+        if title not in files:
+            if not create:
+                return None
+            _create_shard_file(spreadsheet, sheet, title)
+            files = _shard_files(spreadsheet, reload=True)
+    return get_worksheet(_open_shard_file(files[title]), title, *SHEET_LAYOUT[sheet])
+
+def _current_shard(spreadsheet, sheet, period):
+    """期間の最新シャードの [番号, 使用行数]（初回のみファイル一覧と行数を読む、ロックは呼び出し側で取る）"""
+    key = (spreadsheet.id, sheet, period)
+    current = _shard_state()["current"]
+    if key not in current:
+        number = 1
+        for title in _shard_files(spreadsheet):
+            parsed = parse_shard_title(sheet, title)
+            if parsed is not None and parsed[0] == period:
+                number = max(number, parsed[1])
+        # まだファイルがなければヘッダー行だけのシャードとして扱い、最初の追記のときに作る
+        worksheet = _shard_worksheet(spreadsheet, sheet, shard_title(sheet, period, number))
+        current[key] = [number, len(worksheet.col_values(1)) if worksheet is not None else 1]
+    return current[key]
+
+def append_to_shards(spreadsheet, sheet, rows):
+    """行を書き込み先のシャードに追記し、(session_id, シャード名) の一覧を返す
+    
+    1セッション分の行は同じシャードに入れ、入りきらなければ次のシャード（新しいファイル）に切り替える。
+    使用行数はプロセス内で数えているため、複数プロセスから書き込むと上限を少し超えることがある。
+    """
+    # 同じセッション・期間の連続した行をまとめる
+    groups = []
+    for row in rows:
+        period = shard_period(str(row[1]))
+        if groups and groups[-1][0] == row[0] and groups[-1][1] == period:
+            groups[-1][2].append(row)
+        else:
+            groups.append((row[0], period, [row]))
+    
+    shards = _shard_state()
+    with shards["lock"]:
+        plan = {}
+        placed = []
+        for session_id, period, session_rows in groups:
+            current = _current_shard(spreadsheet, sheet, period)
+            # ヘッダーだけのシャードには上限を超えても書き込む（1セッションが上限より大きい場合）
+            if current[1] > 1 and current[1] + len(session_rows) > SHEET_SHARD_MAX_ROWS:
+                current[0] += 1
+                current[1] = 1
+            title = shard_title(sheet, period, current[0])
+            plan.setdefault(title, []).extend(session_rows)
+            current[1] += len(session_rows)
+            placed.append((session_id, title))
+        
+        for title, shard_rows in plan.items():
+            _shard_worksheet(spreadsheet, sheet, title, create=True).append_rows(shard_rows)
+    return placed
+
+def list_shards(spreadsheet, sheet):
+    """シートの全シャードのワークシート（古い順、ワークシートやファイルは作らない）
+    
+    分割を有効にする前にメインのスプレッドシートに書いた summary / details も先頭に含める。
+    """
+    existing = spreadsheet.worksheets()
+    worksheets = sorted(
+        (worksheet for worksheet in existing if parse_shard_title(sheet, worksheet.title) is not None),
+        key=lambda worksheet: parse_shard_title(sheet, worksheet.title),
+    )
+    directory = next((worksheet for worksheet in existing if worksheet.title == SHARD_FILES_SHEET), None)
+    if directory is not None:
+        shards = _shard_state()
+        with shards["lock"]:
+            files = shards["files"] = _read_shard_files(directory)
+            titles = sorted(
+                (parse_shard_title(sheet, title), title) for title in files
+                if parse_shard_title(sheet, title) is not None
+            )
+            for _, title in titles:
+                worksheets.append(_open_shard_file(files[title]).worksheet(title))
+    return worksheets
+
+def build_session_rows():
+    """現在のセッションから要約シート1行と詳細シートの行リストを作成"""
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    session_id = st.session_state.session_id
+    age_group = st.session_state.user_info.get("age_group", "")
+    usage_frequency = st.session_state.user_info.get("usage_frequency", "")
+    location = st.session_state.user_info.get("location", "未記入")
+    
+    session = current_session()
+    slots = session.slot_tracker.snapshot() if session.slot_tracker is not None else {}
+    summary_row = [
+        session_id,
+        timestamp,
+        age_group,
+        usage_frequency,
+        location,
+        len(session.messages),
+        "完了"
+    ] + [slots.get(key, "") for key in SURVEY_SLOTS] + [
+        st.session_state.user_info.get("area_code", ""),
+        st.session_state.user_info.get("latitude", ""),
+        st.session_state.user_info.get("longitude", ""),
+    ] + session.usage.summary_values()
+    detail_rows = [
+        [
+            session_id,
             timestamp,
-            st.session_state.user_info.get("age_group", ""),
-            st.session_state.user_info.get("usage_frequency", ""),
-            st.session_state.user_info.get("location", "未記入"),
-            len(st.session_state.messages),
-            "完了"
-        ])
-        
-        # 詳細シートに対話履歴を保存
+            age_group,
+            usage_frequency,
+            location,
+            i + 1,
+            msg["role"],
+            msg["content"]
+        ]
+        for i, msg in enumerate(session.messages)
+    ]
+    return summary_row, detail_rows
+
+def save_to_google_sheets(spreadsheet, summary_rows, detail_rows):
+    """行をGoogle Sheetsに保存（ワークシートごとに1回の一括追記）"""
+    metrics = get_metrics()
+    started = time.perf_counter()
+    try:
+        if not SHEET_SHARD_MODE:
+            if summary_rows:
+                summary_sheet = get_worksheet(spreadsheet, "summary", *SHEET_LAYOUT["summary"])
+                summary_sheet.append_rows(summary_rows)
+            
+            if detail_rows:
+                detail_sheet = get_worksheet(spreadsheet, "details", *SHEET_LAYOUT["details"])
+                detail_sheet.append_rows(detail_rows)
+        else:
+            # シャードに書き込んでから、セッションごとの書き込み先を索引シートに追記
+            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            index_rows = []
+            for sheet, rows in (("summary", summary_rows), ("details", detail_rows)):
+                if rows:
+                    index_rows += [
+                        [session_id, sheet, title, timestamp]
+                        for session_id, title in append_to_shards(spreadsheet, sheet, rows)
+                    ]
+            if index_rows:
+                index = get_worksheet(spreadsheet, SHARD_INDEX_SHEET, "1000", "4", SHARD_INDEX_HEADER)
+                index.append_rows(index_rows)
+        
+        metrics.observe("sheets_write", time.perf_counter() - started)
+        return True, None
+    
+    except Exception as e:
+        metrics.count("sheets_errors")
+        # キャッシュしたハンドルが無効になっている可能性があるので破棄
+        invalidate_worksheet_cache(spreadsheet)
+        return False, f"保存エラー: {str(e)}"
+
+def _outbox_connect():
+    """保存キュー（SQLite）に接続（テーブルがなければ作成）"""
+    directory = os.path.dirname(OUTBOX_PATH)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(OUTBOX_PATH, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=FULL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sheet TEXT NOT NULL,
+            row_json TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            sent_at TEXT
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (id) WHERE sent_at IS NULL")
+    return conn
+
+def enqueue_session():
+    """現在のセッションを保存キューに書き込む（Google Sheetsへの送信はバックグラウンド）"""
+    try:
+        summary_row, detail_rows = build_session_rows()
+        created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        records = [("summary", json.dumps(summary_row, ensure_ascii=False), created_at)]
+        records += [
+            ("details", json.dumps(row, ensure_ascii=False), created_at)
+            for row in detail_rows
+        ]
+        
+        conn = _outbox_connect()
         try:
-            detail_sheet = spreadsheet.worksheet("details")
-        except:
-            # シートがなければ作成
-            detail_sheet = spreadsheet.add_worksheet(title="details", rows="10000", cols="10")
-            # ヘッダー行を追加
-            detail_sheet.append_row([
-                "session_id", "timestamp", "age_group", "usage_frequency",
-                "location", "message_number", "role", "content"
-            ])
-        
-        # 各メッセージを保存
-        for i, msg in enumerate(st.session_state.messages):
-            detail_sheet.append_row([
-                st.session_state.session_id,
-                timestamp,
-                st.session_state.user_info.get("age_group", ""),
-                st.session_state.user_info.get("usage_frequency", ""),
-                st.session_state.user_info.get("location", "未記入"),
-                i + 1,
-                msg["role"],
-                msg["content"]
-            ])
+            # 1セッション分を1トランザクションで書き込む
+            with conn:
+                conn.executemany(
+                    "INSERT INTO outbox (sheet, row_json, created_at) VALUES (?, ?, ?)",
+                    records
+                )
+        finally:
+            conn.close()
         
+        _outbox_flusher()["wake"].set()
         return True, None
     
     except Exception as e:
         return False, f"保存エラー: {str(e)}"
 
-def initialize_chat():
-    """Gemini チャットセッションを初期化"""
+def flush_outbox(reconnect=False):
+    """保存キューの未送信行をシートごとにまとめてGoogle Sheetsへ送信（送信した行数を返す）
+    
+    reconnectを指定すると、未送信行があるときだけ接続を張り直してから送る。
+    """
+    conn = _outbox_connect()
+    try:
+        pending = conn.execute(
+            "SELECT id, sheet, row_json FROM outbox WHERE sent_at IS NULL ORDER BY id LIMIT ?",
+            (OUTBOX_BATCH_ROWS,)
+        ).fetchall()
+        if not pending:
+            return 0
+        
+        spreadsheet, error = get_spreadsheet(reconnect=reconnect)
+        if spreadsheet is None:
+            raise RuntimeError(error)
+        
+        sent = 0
+        for sheet in ("summary", "details"):
+            ids = [row_id for row_id, name, _ in pending if name == sheet]
+            rows = [json.loads(row_json) for _, name, row_json in pending if name == sheet]
+            if not rows:
+                continue
+            
+            if sheet == "summary":
+                success, error = save_to_google_sheets(spreadsheet, rows, [])
+            else:
+                success, error = save_to_google_sheets(spreadsheet, [], rows)
+            if not success:
+                raise RuntimeError(error)
+            
+            # 送信済みの印を付ける（行はローカルの控えとして残す）
+            sent_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            with conn:
+                conn.executemany(
+                    "UPDATE outbox SET sent_at = ? WHERE id = ?",
+                    [(sent_at, row_id) for row_id in ids]
+                )
+            sent += len(rows)
+        return sent
+    finally:
+        conn.close()
+
+def outbox_pending_count():
+    """保存キューの未送信行数"""
+    conn = _outbox_connect()
+    try:
+        return conn.execute("SELECT COUNT(*) FROM outbox WHERE sent_at IS NULL").fetchone()[0]
+    finally:
+        conn.close()
+
+def _run_outbox_flusher(state):
+    """保存キューを定期的に送信し、失敗時は指数バックオフ（ジッター付き）で再試行"""
+    failures = 0
+    while True:
+        try:
+            # 失敗の後は次の送信のときに接続を張り直す（画面側が使う共有の接続は開き直せるまで残す）
+            sent = flush_outbox(reconnect=failures > 0)
+            failures = 0
+            # キューが残っていればすぐ続きを送る
+            if sent >= OUTBOX_BATCH_ROWS:
+                continue
+            delay = OUTBOX_FLUSH_INTERVAL
+        except Exception as e:
+            failures += 1
+            state["last_error"] = str(e)
+            delay = min(OUTBOX_MAX_BACKOFF, OUTBOX_FLUSH_INTERVAL * 2 ** failures)
+            delay *= random.uniform(0.5, 1.5)
+        
+        if failures:
+            time.sleep(delay)
+        elif state["wake"].wait(delay):
+            # 新しいセッションが届いたら少し待って、同時期に終わったセッションとまとめて送る
+            state["wake"].clear()
+            time.sleep(OUTBOX_COALESCE_SECONDS)
+
+@st.cache_resource
+def _outbox_flusher():
+    """保存キューのバックグラウンド送信スレッドを開始（プロセスで1つ）"""
+    state = {"wake": threading.Event(), "last_error": None}
+    thread = threading.Thread(target=_run_outbox_flusher, args=(state,), daemon=True)
+    thread.start()
+    state["thread"] = thread
+    return state
+
+# モデルの設定
+GENERATION_CONFIG = {
+    "temperature": 0.7,
+    "top_p": 0.95,
+    "top_k": 40,
+    "max_output_tokens": 1024,
+}
+
+# セーフティ設定（バス調査は安全な内容なので緩和）
+SAFETY_SETTINGS = [
+    {
+        "category": "HARM_CATEGORY_HARASSMENT",
+        "threshold": "BLOCK_ONLY_HIGH"
+    },
+    {
+        "category": "HARM_CATEGORY_HATE_SPEECH",
+        "threshold": "BLOCK_ONLY_HIGH"
+    },
+    {
+        "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+        "threshold": "BLOCK_ONLY_HIGH"
+    },
+    {
+        "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
+        "threshold": "BLOCK_ONLY_HIGH"
+    }
+]
+
+@st.cache_resource
+def _cassette_store(directory, mode):
+    """カセット（プロセス全体で共有）"""
+    return gemini_cassette.CassetteStore(directory, mode)
+
+def _serialize_contents(contents):
+    """リクエスト内容を [役割, テキスト] の一覧に変換"""
+    return [
+        [content.role or "user", "".join(part.text for part in content.parts)]
+        for content in content_types.to_contents(contents)
+    ]
+
+def _response_proto(text, finish_reason, usage):
+    """記録からGenerateContentResponseのprotoを組み立てる"""
+    parts = [protos.Part(text=text)] if text else []
+    return protos.GenerateContentResponse(
+        candidates=[protos.Candidate(
+            index=0,
+            content=protos.Content(role="model", parts=parts),
+            finish_reason=finish_reason,
+        )],
+        usage_metadata=protos.GenerateContentResponse.UsageMetadata(**usage) if usage else None,
+    )
+
+def _replay_response(entry, stream):
+    """記録した応答を、記録時の遅延（GEMINI_REPLAY_SPEED倍）付きで返す"""
+    if entry.get("error"):
+        time.sleep(entry["ttfb"] * GEMINI_REPLAY_SPEED)
+        error_class = getattr(google_exceptions, entry["error"]["type"], None)
+        if error_class is None:
+            raise RuntimeError(entry["error"]["message"])
+        raise error_class(entry["error"]["message"])
+    
+    chunks = entry["chunks"] or [["", 0.0]]
+    last = len(chunks) - 1
+    
+    def iterate():
+        for i, (text, delay) in enumerate(chunks):
+            time.sleep(delay * GEMINI_REPLAY_SPEED)
+            yield _response_proto(
+                text,
+                entry["finish_reason"] if i == last else 0,
+                entry["usage"] if i == last else None,
+            )
+    
+    time.sleep(entry["ttfb"] * GEMINI_REPLAY_SPEED)
+    if stream:
+        return generation_types.GenerateContentResponse.from_iterator(iterate())
+    time.sleep(max(0.0, entry["total"] - entry["ttfb"]) * GEMINI_REPLAY_SPEED)
+    text = "".join(text for text, _ in chunks)
+    return generation_types.GenerateContentResponse.from_response(
+        _response_proto(text, entry["finish_reason"], entry["usage"])
+    )
+
+class CassetteMixin:
+    """generate_contentを記録・再生する（GenerativeModelと組み合わせて使う、ChatSessionからの呼び出しも対象）"""
+    
+    def generate_content(self, contents, *, stream=False, **kwargs):
+        store = _cassette_store(GEMINI_CASSETTE_DIR, GEMINI_CASSETTE_MODE)
+        serialized = _serialize_contents(contents)
+        key = gemini_cassette.CassetteStore.request_key(self.model_name, serialized)
+        
+        if GEMINI_CASSETTE_MODE == "replay":
+            entry = store.lookup(key)
+            if entry is None:
+                raise gemini_cassette.CassetteMiss(
+                    f"カセット（{GEMINI_CASSETTE_DIR}）に一致する記録がありません: "
+                    f"モデル {self.model_name}、{len(serialized)}件目のメッセージ「{serialized[-1][1][:40]}」"
+                )
+            return _replay_response(entry, stream)
+        
+        entry = {"key": key, "model": self.model_name, "contents": serialized, "stream": stream}
+        started = time.perf_counter()
+        try:
+            response = super().generate_content(contents, stream=stream, **kwargs)
+            entry["ttfb"] = time.perf_counter() - started
+            
+            # ストリーミングはここで受信しきってチャンクの間隔を記録し、記録から応答を作り直す
+            chunks = []
+            last = time.perf_counter()
+            for chunk in response if stream else [response]:
+                now = time.perf_counter()
+                chunks.append(["".join(part.text for part in chunk.parts), now - last if chunks else 0.0])
+                last = now
+            entry["total"] = time.perf_counter() - started
+            entry["chunks"] = chunks
+            candidate = response.candidates[0] if response.candidates else None
+            entry["finish_reason"] = int(candidate.finish_reason) if candidate is not None else 0
+            usage = response.usage_metadata
+            entry["usage"] = {
+                "prompt_token_count": usage.prompt_token_count,
+                "cached_content_token_count": usage.cached_content_token_count,
+                "candidates_token_count": usage.candidates_token_count,
+                "total_token_count": usage.total_token_count,
+            } if usage else None
+        except Exception as e:
+            entry["ttfb"] = entry["total"] = time.perf_counter() - started
+            entry["error"] = {"type": type(e).__name__, "message": str(e)}
+            store.record(entry)
+            raise
+        
+        store.record(entry)
+        if stream:
+            return _replay_response(dict(entry, ttfb=0.0, total=0.0, chunks=[[text, 0.0] for text, _ in chunks]), stream)
+        return response
+
+def _model_class():
+    """記録・再生モードならCassetteMixinを組み込んだGenerativeModel、通常はGenerativeModel"""
+    if GEMINI_CASSETTE_MODE in ("record", "replay"):
+        return type("CassetteModel", (CassetteMixin, genai.GenerativeModel), {})
+    return genai.GenerativeModel
+
+@st.cache_resource
+def _generative_client(api_key):
+    """APIキー専用のGenerativeServiceクライアント（複数キーを同時に使うためグローバル設定に頼らない）"""
+    return glm.GenerativeServiceClient(client_options={"api_key": api_key})
+
+@st.cache_resource
+def _genai_configure_lock():
+    """genai.configure（プロセス全体の設定）を使う処理の排他用"""
+    return threading.Lock()
+
+@st.cache_resource
+def _inline_gemini_model(api_key, model_name):
+    """システムプロンプトを毎回送るGenerativeModel（APIキー×モデルごとにプロセスで1つを共有）"""
+    model = _model_class()(
+        model_name=model_name,
+        generation_config=GENERATION_CONFIG,
+        safety_settings=SAFETY_SETTINGS,
+        system_instruction=SYSTEM_PROMPT
+    )
+    model._client = _generative_client(api_key)
+    return model
+
+@st.cache_resource
+def _prompt_cache_state(api_key, model_name):
+    """システムプロンプトのコンテキストキャッシュの状態（APIキー×モデルごとにプロセスで1つ）"""
+    return {"lock": threading.Lock(), "cache": None, "model": None, "expires_at": 0.0, "retry_at": 0.0}
+
+def get_gemini_model(api_key, model_name=GEMINI_MODEL_NAME):
+    """チャット用のモデルを取得（コンテキストキャッシュが有効ならキャッシュを参照するモデル）"""
+    if not GEMINI_CONTEXT_CACHE:
+        return _inline_gemini_model(api_key, model_name)
+    
+    state = _prompt_cache_state(api_key, model_name)
+    with state["lock"]:
+        now = time.time()
+        if state["model"] is not None and now < state["expires_at"] - GEMINI_CONTEXT_CACHE_REFRESH:
+            return state["model"]
+        if now < state["retry_at"]:
+            return _inline_gemini_model(api_key, model_name)
+        
+        try:
+            # キャッシュAPIはグローバル設定のキーを使うので、設定から呼び出しまでを排他する
+            with _genai_configure_lock():
+                genai.configure(api_key=api_key)
+                ttl = timedelta(seconds=GEMINI_CONTEXT_CACHE_TTL)
+                if state["cache"] is not None and now < state["expires_at"]:
+                    # 期限切れ前にTTLを延長（キャッシュ名は変わらない）
+                    state["cache"].update(ttl=ttl)
+                else:
+                    state["cache"] = genai.caching.CachedContent.create(
+                        model=f"models/{model_name}",
+                        display_name="bus-survey-system-prompt",
+                        system_instruction=SYSTEM_PROMPT,
+                        ttl=ttl
+                    )
+                    state["model"] = _model_class().from_cached_content(
+                        cached_content=state["cache"],
+                        generation_config=GENERATION_CONFIG,
+                        safety_settings=SAFETY_SETTINGS
+                    )
+                    state["model"]._client = _generative_client(api_key)
+            state["expires_at"] = now + GEMINI_CONTEXT_CACHE_TTL
+            return state["model"]
+        
+        except Exception:
+            # キャッシュが使えなければ従来のsystem_instructionで続け、しばらくしてから再試行
+            state["cache"] = None
+            state["model"] = None
+            state["retry_at"] = now + GEMINI_CONTEXT_CACHE_RETRY
+            return _inline_gemini_model(api_key, model_name)
+
+@st.cache_resource
+def get_summary_model(api_key, model_name=GEMINI_MODEL_NAME):
+    """履歴要約用のGenerativeModel（システムプロンプトなし、APIキー×モデルごとにプロセスで1つを共有）"""
+    model = _model_class()(
+        model_name=model_name,
+        generation_config={"temperature": 0.2, "max_output_tokens": 512}
+    )
+    model._client = _generative_client(api_key)
+    return model
+
+def initialize_chat(history=None):
+    """Gemini チャットセッションを初期化（共有モデルからチャットを開始するだけ）"""
     if not GEMINI_API_KEY:
         return None
     
     try:
-        genai.configure(api_key=GEMINI_API_KEY)
-        
-        # モデルの設定
-        generation_config = {
-            "temperature": 0.7,
-            "top_p": 0.95,
-            "top_k": 40,
-            "max_output_tokens": 1024,
-        }
-        
-        # セーフティ設定（バス調査は安全な内容なので緩和）
-        safety_settings = [
-            {
-                "category": "HARM_CATEGORY_HARASSMENT",
-                "threshold": "BLOCK_ONLY_HIGH"
-            },
-            {
-                "category": "HARM_CATEGORY_HATE_SPEECH",
-                "threshold": "BLOCK_ONLY_HIGH"
-            },
-            {
-                "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                "threshold": "BLOCK_ONLY_HIGH"
-            },
-            {
-                "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
-                "threshold": "BLOCK_ONLY_HIGH"
-            }
-        ]
+        return get_gemini_model(GEMINI_API_KEY).start_chat(history=history or [])
+    
+    except Exception as e:
+        st.error(f"チャット初期化エラー：{str(e)}")
+        return None
+
+def _run_warmup():
+    """GeminiとGoogle Sheetsへの接続を事前に確立（失敗しても本処理で再接続する）"""
+    try:
+        # count_tokensは生成と同じ接続を使い、生成クォータを消費しない（再生時はGeminiに接続しない）
+        if GEMINI_CASSETTE_MODE != "replay":
+            for api_key in GEMINI_API_KEYS:
+                get_gemini_model(api_key).count_tokens("接続確認")
+    except Exception:
+        pass
+    
+    spreadsheet, _ = get_spreadsheet()
+    if spreadsheet is not None:
+        try:
+            if SHEET_SHARD_MODE:
+                # 今の期間の書き込み先シャードと使用行数を確認しておく
+                period = shard_period(datetime.now().strftime("%Y-%m-%d"))
+                with _shard_state()["lock"]:
+                    for sheet in SHEET_LAYOUT:
+                        _current_shard(spreadsheet, sheet, period)
+            else:
+                get_worksheet(spreadsheet, "summary", *SHEET_LAYOUT["summary"])
+                get_worksheet(spreadsheet, "details", *SHEET_LAYOUT["details"])
+        except Exception:
+            invalidate_worksheet_cache(spreadsheet)
+    
+    # 挨拶キャッシュの不足分を生成
+    if GREETING_CACHE_VARIANTS > 0:
+        pregenerate_greetings()
+
+@st.cache_resource
+def _warm_up_connections():
+    """起動後最初のアクセスでウォームアップを開始（プロセスで1回のみ、表示は待たない）"""
+    thread = threading.Thread(target=_run_warmup, daemon=True)
+    thread.start()
+    return thread
+
+def _load_sdks():
+    """重いSDKをまとめて読み込む（未インストールのものは使う処理で改めてエラーにする）"""
+    for module in LAZY_MODULES:
+        try:
+            module.load()
+        except ImportError:
+            pass
+
+@st.cache_resource
+def _preload_sdks():
+    """SDKの読み込みをバックグラウンドで開始（プロセスで1回のみ、表示は待たない）"""
+    thread = threading.Thread(target=_load_sdks, daemon=True)
+    thread.start()
+    return thread
+
+class GeminiQueueTimeout(Exception):
+    """レート制限の待ち行列で待ちきれなかった"""
+
+class RateLimiter:
+    """リクエスト数/分とトークン数/分の2つのトークンバケット（待ち行列は先着順）"""
+    
+    def __init__(self, rpm, tpm):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = float(rpm)
+        self.tokens = float(tpm)
+        self.updated = time.monotonic()
+        self.cond = threading.Condition()
+        self.queue = collections.deque()
+    
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+    
+    def _seconds_until(self, tokens):
+        """指定トークン数と1リクエスト分が貯まるまでの秒数"""
+        request_wait = max(0.0, 1 - self.requests) * 60 / self.rpm
+        token_wait = max(0.0, tokens - self.tokens) * 60 / self.tpm
+        return max(request_wait, token_wait)
+    
+    def acquire(self, tokens, timeout, on_wait=None):
+        """枠が空くまで待って確保する（timeout秒以内に確保できなければFalse）"""
+        tokens = min(tokens, self.tpm)
+        ticket = object()
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            self.queue.append(ticket)
+        try:
+            while True:
+                with self.cond:
+                    self._refill()
+                    is_head = self.queue[0] is ticket
+                    if is_head and self.requests >= 1 and self.tokens >= tokens:
+                        self.requests -= 1
+                        self.tokens -= tokens
+                        return True
+                    
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    position = self.queue.index(ticket) + 1
+                    wait = self._seconds_until(tokens) if is_head else 1.0
+                    self.cond.wait(min(remaining, max(wait, 0.05), 1.0))
+                
+                # 待ち順はロックの外で通知する
+                if on_wait is not None:
+                    on_wait(position)
+        finally:
+            with self.cond:
+                self.queue.remove(ticket)
+                self.cond.notify_all()
+    
+    def available(self):
+        """今すぐ使えるリクエスト枠の数（待ち行列の分を差し引く）"""
+        with self.cond:
+            self._refill()
+            return self.requests - len(self.queue)
+    
+    def has_spare_capacity(self):
+        """待ち行列が空で、リクエスト枠が半分以上残っているか（優先度の低い処理用）"""
+        with self.cond:
+            self._refill()
+            return not self.queue and self.requests >= self.rpm / 2
+    
+    def adjust(self, estimated, actual):
+        """実際の使用トークン数との差を精算"""
+        with self.cond:
+            self.tokens -= actual - estimated
+    
+    def penalize(self):
+        """429を受けたらリクエスト枠を空にして、後続の呼び出しを待たせる"""
+        with self.cond:
+            self.requests = min(self.requests, 0.0)
+
+class GeminiKeyPool:
+    """APIキー×モデル（エンドポイント）ごとのレート制限・健全性・クールダウンを管理"""
+    
+    def __init__(self, api_keys, model_names):
+        # 主モデルのエンドポイントを先に並べる
+        self.endpoints = [(api_key, model_name) for model_name in model_names for api_key in api_keys]
+        self.limiters = {endpoint: RateLimiter(GEMINI_RPM, GEMINI_TPM) for endpoint in self.endpoints}
+        self.lock = threading.Lock()
+        self.cooldown_until = {endpoint: 0.0 for endpoint in self.endpoints}
+        self.strikes = {endpoint: 0 for endpoint in self.endpoints}
+        self.errors = {endpoint: 0 for endpoint in self.endpoints}
+    
+    def healthy(self):
+        """クールダウン中でないエンドポイント（優先順）"""
+        now = time.monotonic()
+        with self.lock:
+            return [endpoint for endpoint in self.endpoints if self.cooldown_until[endpoint] <= now]
+    
+    def choose(self, preferred=None):
+        """呼び出し先を選ぶ（使用中のエンドポイントに空きがあれば継続、なければ最も空いているキー）"""
+        healthy = self.healthy()
+        if not healthy:
+            # 全て休止中なら最も早く復帰するものを使う
+            with self.lock:
+                return min(self.endpoints, key=self.cooldown_until.get)
         
-        model = genai.GenerativeModel(
-            model_name="gemini-2.5-flash-lite",
-            generation_config=generation_config,
-            safety_settings=safety_settings,
-            system_instruction=SYSTEM_PROMPT
+        # 使えるうちで最も優先度の高いモデルの中から選ぶ
+        candidates = [endpoint for endpoint in healthy if endpoint[1] == healthy[0][1]]
+        if preferred in candidates and self.limiters[preferred].available() >= 1:
+            return preferred
+        return max(candidates, key=lambda endpoint: self.limiters[endpoint].available())
+    
+    def has_spare_capacity(self):
+        """主モデルのいずれかのキーに余裕があるか"""
+        return any(
+            self.limiters[endpoint].has_spare_capacity()
+            for endpoint in self.healthy() if endpoint[1] == GEMINI_MODEL_NAME
         )
+    
+    def record_success(self, endpoint):
+        with self.lock:
+            self.strikes[endpoint] = 0
+            self.errors[endpoint] = 0
+    
+    def record_quota_error(self, endpoint, error):
+        """429を受けたキーを休ませる（連続するたびに倍、日次上限なら最大まで）"""
+        with self.lock:
+            self.strikes[endpoint] += 1
+            cooldown = GEMINI_KEY_COOLDOWN * 2 ** (self.strikes[endpoint] - 1)
+            if "per day" in str(error).lower() or "perday" in str(error).lower():
+                cooldown = GEMINI_KEY_MAX_COOLDOWN
+            self.cooldown_until[endpoint] = time.monotonic() + min(cooldown, GEMINI_KEY_MAX_COOLDOWN)
+    
+    def record_error(self, endpoint):
+        """その他のエラーが3回続いたキーも短時間休ませる"""
+        with self.lock:
+            self.errors[endpoint] += 1
+            if self.errors[endpoint] >= 3:
+                self.errors[endpoint] = 0
+                self.cooldown_until[endpoint] = time.monotonic() + GEMINI_KEY_COOLDOWN
+
+@st.cache_resource
+def _gemini_pool(api_keys, model_names):
+    """Gemini呼び出し用のキープール（プロセス全体で共有）"""
+    return GeminiKeyPool(api_keys, model_names)
+
+def get_gemini_pool():
+    """設定中のAPIキーとモデルのキープール"""
+    return _gemini_pool(tuple(GEMINI_API_KEYS), tuple([GEMINI_MODEL_NAME] + GEMINI_FALLBACK_MODELS))
+
+def is_quota_error(error):
+    """クォータ超過エラー（429）かどうか"""
+    if isinstance(error, google_exceptions.ResourceExhausted):
+        return True
+    error_msg = str(error)
+    return "429" in error_msg or "quota" in error_msg.lower()
+
+def classify_gemini_error(error):
+    """計測用のエラー分類（quota / safety / network / other）"""
+    if isinstance(error, GeminiQueueTimeout) or is_quota_error(error):
+        return "quota"
+    if isinstance(error, (
+        generation_types.BlockedPromptException,
+        generation_types.StopCandidateException,
+    )):
+        return "safety"
+    if isinstance(error, (
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.DeadlineExceeded,
+        google_exceptions.InternalServerError,
+        ConnectionError,
+        TimeoutError,
+    )):
+        return "network"
+    return "other"
+
+def estimate_tokens_for_text(text):
+    """システムプロンプト付きで単発送信するときのトークン数を概算（日本語は1文字≒1トークンとして多めに見積もる）"""
+    return len(SYSTEM_PROMPT) + len(text)
+
+def estimate_tokens(chat, user_message):
+    """チャットで送信するプロンプトのトークン数を概算（履歴を含む）"""
+    tokens = estimate_tokens_for_text(user_message)
+    for content in chat.history:
+        for part in content.parts:
+            tokens += len(getattr(part, "text", ""))
+    return tokens
+
+def call_with_failover(call, tokens, endpoint=None, on_wait=None):
+    """キープールから呼び出し先を選んでレート制限の枠を確保して呼び出す
+    
+    429を受けたキーは休ませて別のキー・モデルに切り替え、使えるキーがなければ
+    ジッター付き指数バックオフで再試行する。(応答, 使ったエンドポイント) を返す。
+    """
+    pool = get_gemini_pool()
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        endpoint = pool.choose(endpoint)
+        limiter = pool.limiters[endpoint]
+        if not limiter.acquire(tokens, GEMINI_MAX_QUEUE_WAIT, on_wait):
+            raise GeminiQueueTimeout("rate limit queue timeout")
+        
+        try:
+            response = call(endpoint)
+        except Exception as e:
+            if not is_quota_error(e):
+                pool.record_error(endpoint)
+                raise
+            get_metrics().count("gemini_quota_retries")
+            limiter.penalize()
+            pool.record_quota_error(endpoint, e)
+            if attempt == GEMINI_MAX_RETRIES:
+                raise
+            if not pool.healthy():
+                delay = min(GEMINI_BACKOFF_MAX, GEMINI_BACKOFF_BASE * 2 ** attempt)
+                time.sleep(delay * random.uniform(0.5, 1.5))
+            endpoint = None
+            continue
+        
+        pool.record_success(endpoint)
+        return response, endpoint
+
+def send_chat_message(chat, user_message, endpoint=None, stream=False, on_wait=None):
+    """チャットでメッセージを送信（(応答, 使ったエンドポイント) を返す）"""
+    estimated = estimate_tokens(chat, user_message)
+    
+    def call(endpoint):
+        # 別のキー・モデルに移るときは、手元の履歴をそのまま新しいエンドポイントへ送り直す
+        # （コンテキストキャッシュの延長・再作成・フォールバックにもここで追従する）
+        chat.model = get_gemini_model(*endpoint)
+        # 使用量が上限に近いときは応答の長さを抑える
+        max_output_tokens = get_token_budget().max_output_tokens()
+        if max_output_tokens < GENERATION_CONFIG["max_output_tokens"]:
+            return chat.send_message(
+                user_message, stream=stream, generation_config={"max_output_tokens": max_output_tokens}
+            )
+        return chat.send_message(user_message, stream=stream)
+    
+    response, endpoint = call_with_failover(call, estimated, endpoint, on_wait)
+    
+    # 非ストリーミング時は実際の使用量で精算
+    usage = getattr(response, "usage_metadata", None)
+    if not stream and usage is not None and usage.prompt_token_count:
+        get_gemini_pool().limiters[endpoint].adjust(estimated, usage.prompt_token_count)
+    return response, endpoint
+
+class TokenUsage:
+    """1セッション分のGeminiの使用量（対話・要約・項目抽出の呼び出しをすべて含む）"""
+    
+    FIELDS = ("calls", "prompt_tokens", "cached_tokens", "output_tokens")
+    
+    def __init__(self, counts=None):
+        self.lock = threading.Lock()
+        self.counts = dict.fromkeys(self.FIELDS, 0)
+        self.counts.update(counts or {})
+    
+    def add(self, prompt_tokens, cached_tokens, output_tokens):
+        with self.lock:
+            self.counts["calls"] += 1
+            self.counts["prompt_tokens"] += prompt_tokens
+            self.counts["cached_tokens"] += cached_tokens
+            self.counts["output_tokens"] += output_tokens
+    
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts)
+    
+    def cost(self):
+        """見積もり費用（USD、キャッシュから読んだ分は入力の単価から差し引く）"""
+        counts = self.snapshot()
+        uncached = counts["prompt_tokens"] - counts["cached_tokens"]
+        return (
+            uncached * GEMINI_PRICE_INPUT
+            + counts["cached_tokens"] * GEMINI_PRICE_CACHED
+            + counts["output_tokens"] * GEMINI_PRICE_OUTPUT
+        ) / 1_000_000
+    
+    def summary_values(self):
+        """要約シートの使用量の列（gemini_calls 〜 cost_usd）"""
+        counts = self.snapshot()
+        return [counts[key] for key in self.FIELDS] + [round(self.cost(), 6)]
+
+class TokenBudget:
+    """プロセス全体の直近24時間のトークン使用量（1分ごとに集計して古い分から捨てる）"""
+    
+    WINDOW = 24 * 60  # 分
+    
+    def __init__(self, limit):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.minutes = collections.deque()  # [分, トークン数]
+        self.total = 0
+    
+    def _expire(self, minute):
+        while self.minutes and self.minutes[0][0] <= minute - self.WINDOW:
+            self.total -= self.minutes.popleft()[1]
+    
+    def spend(self, tokens):
+        minute = int(time.time() // 60)
+        with self.lock:
+            self._expire(minute)
+            if self.minutes and self.minutes[-1][0] == minute:
+                self.minutes[-1][1] += tokens
+            else:
+                self.minutes.append([minute, tokens])
+            self.total += tokens
+    
+    def used(self):
+        with self.lock:
+            self._expire(int(time.time() // 60))
+            return self.total
+    
+    def fraction(self):
+        """上限に対する使用割合（上限なしなら0）"""
+        return self.used() / self.limit if self.limit > 0 else 0.0
+    
+    def max_output_tokens(self):
+        """応答の最大トークン数（上限に近づいたら短くする）"""
+        if self.fraction() >= GEMINI_BUDGET_REDUCE_AT:
+            return min(GENERATION_CONFIG["max_output_tokens"], GEMINI_BUDGET_MAX_OUTPUT_TOKENS)
+        return GENERATION_CONFIG["max_output_tokens"]
+    
+    def accepting_new_sessions(self):
+        return self.fraction() < GEMINI_BUDGET_STOP_AT
+
+@st.cache_resource
+def get_token_budget():
+    """トークン使用量の上限管理（プロセス全体で共有）"""
+    return TokenBudget(GEMINI_DAILY_TOKEN_BUDGET)
+
+def record_usage(response, usage=None):
+    """応答の使用量をプロセスの集計と（渡されれば）セッションの集計に加える
+    
+    ストリーミングの応答は最後まで受信してから渡す（使用量は最後のチャンクで確定する）。
+    """
+    metadata = getattr(response, "usage_metadata", None)
+    if metadata is None:
+        return
+    prompt_tokens = getattr(metadata, "prompt_token_count", 0) or 0
+    cached_tokens = getattr(metadata, "cached_content_token_count", 0) or 0
+    output_tokens = getattr(metadata, "candidates_token_count", 0) or 0
+    get_token_budget().spend(prompt_tokens + output_tokens)
+    if usage is not None:
+        usage.add(prompt_tokens, cached_tokens, output_tokens)
+
+# 古いターンを要約するときの指示
+SUMMARY_PROMPT = """以下はバス利用に関するヒアリング調査の対話記録です。
+これまでに把握できた事実だけを、次の項目ごとに簡潔な箇条書きでまとめてください。
+未確認の項目は「未確認」と書いてください。推測は加えないでください。
+
+- 回答者の基本情報（年齢層・利用頻度・地域）
+- 利用区間
+- よく利用する時間帯・利用頻度
+- 朝／昼／夕方の所要時間
+- 最速・最遅の時間帯と所要時間
+- 時間帯による差
+- 変動の要因
+- 行動への影響・エピソード
+- すでに尋ねた質問
+
+【対話記録】
+"""
+
+def compact_chat_history(chat, usage=None):
+    """古いターンを要約に置き換え、毎回送信する履歴を直近Nターン＋要約に抑える"""
+    if CONTEXT_KEEP_TURNS <= 0 or chat is None:
+        return chat
+    
+    try:
+        # 1ターン＝回答者と調査員の1往復。保持数の2倍を超えたらまとめて要約する
+        # （途中で止まったストリーミング応答が残っていると履歴の読み出しが例外になる）
+        history = list(chat.history)
+        keep = CONTEXT_KEEP_TURNS * 2
+        if len(history) <= keep * 2:
+            return chat
+        older, recent = history[:-keep], history[-keep:]
+        
+        lines = []
+        for content in older:
+            speaker = "回答者" if content.role == "user" else "調査員"
+            text = "".join(getattr(part, "text", "") for part in content.parts)
+            lines.append(f"{speaker}：{text}")
+        prompt = SUMMARY_PROMPT + "\n".join(lines)
         
-        chat = model.start_chat(history=[])
+        response, _ = call_with_failover(
+            lambda endpoint: get_summary_model(*endpoint).generate_content(prompt),
+            len(prompt)
+        )
+        record_usage(response, usage)
+        summary = response.text
+    except Exception:
+        # 履歴を読めない・要約できなければ全履歴のまま続ける
         return chat
     
-    except Exception as e:
-        st.error(f"チャット初期化エラー：{str(e)}")
+    return chat.model.start_chat(history=[
+        {"role": "user", "parts": [f"【これまでの対話の要約】\n{summary}\n\nこの内容を踏まえて調査を続けてください。"]},
+        {"role": "model", "parts": ["承知しました。確認済みの内容は繰り返さずに質問を続けます。"]},
+    ] + recent)
+
+# 対話から調査項目を抽出するときの指示
+SLOT_PROMPT = """以下はバス利用に関するヒアリング調査の対話の一部です。
+回答者の発言から、次の項目について新たに分かったことを抽出してください。
+値は「駅→大学」「30分」「8時頃・25分」のように短く書いてください。
+発言から分からない項目は含めないでください。推測は加えないでください。
+
+【項目】
+{slots}
+
+【これまでに分かっていること】
+{known}
+
+【対話】
+{dialogue}
+
+項目のキーを使ったJSONオブジェクトだけを出力してください。"""
+
+class SlotTracker:
+    """1セッション分の調査項目の記入状況（対話からバックグラウンドで抽出して埋める）"""
+    
+    def __init__(self, values=None, extracted=0, usage=None):
+        self.lock = threading.Lock()
+        self.values = dict(values or {})
+        self.extracted = extracted  # 抽出済みのメッセージ数
+        self.future = None
+        self.usage = usage  # セッションの使用量（抽出の呼び出しも含める）
+    
+    def snapshot(self):
+        with self.lock:
+            return dict(self.values)
+    
+    def missing(self):
+        """まだ埋まっていない必須項目"""
+        with self.lock:
+            return [key for key in SLOT_REQUIRED if key in SURVEY_SLOTS and not self.values.get(key)]
+    
+    def checklist(self):
+        """調査員（モデル）に渡す短い確認状況"""
+        with self.lock:
+            marks = [f"{'✅' if self.values.get(key) else '□'}{label}" for key, label in SURVEY_SLOTS.items()]
+        missing = self.missing()
+        lines = ["【確認状況】" + " ".join(marks)]
+        if not missing:
+            lines.append("必要な項目はすべて確認できました。お礼を伝え、画面の「調査を終了」ボタンで終了できることを案内してください。")
+        else:
+            lines.append("確認済みの項目は繰り返し尋ねず、□の項目を優先して聞いてください。")
+        return "\n".join(lines)
+    
+    def submit(self, messages, force=False):
+        """未抽出のメッセージの抽出をバックグラウンドで開始（実行中・混雑時・回答がたまるまでは次のターンに回す）"""
+        with self.lock:
+            if self.future is not None and not self.future.done():
+                return self.future
+            if len(messages) <= self.extracted:
+                return None
+            # 1回の抽出でSLOT_EXTRACT_EVERY回分の回答をまとめて読む（終了時は残りをすべて読む）
+            answers = sum(1 for message in messages[self.extracted:] if message["role"] == "user")
+            if not force and answers < SLOT_EXTRACT_EVERY:
+                return None
+        # 抽出は優先度が低いので、対話の呼び出しに余裕がないときは見送る
+        if not force and not get_gemini_pool().has_spare_capacity():
+            return None
+        future = _slot_executor().submit(self._extract, list(messages))
+        with self.lock:
+            self.future = future
+        return future
+    
+    def busy(self):
+        with self.lock:
+            return self.future is not None and not self.future.done()
+    
+    def wait(self, timeout):
+        with self.lock:
+            future = self.future
+        if future is not None:
+            try:
+                future.result(timeout=timeout)
+            except Exception:
+                pass
+    
+    def _extract(self, messages):
+        with self.lock:
+            start = self.extracted
+            known = dict(self.values)
+        # 直前の質問も含めて、回答が何についてのものか分かるようにする
+        start = max(0, start - 1)
+        dialogue = "\n".join(
+            f"{'回答者' if message['role'] == 'user' else '調査員'}：{message['content']}"
+            for message in messages[start:]
+        )
+        prompt = SLOT_PROMPT.format(
+            slots="\n".join(f"- {key}：{label}" for key, label in SURVEY_SLOTS.items()),
+            known=json.dumps(known, ensure_ascii=False) if known else "なし",
+            dialogue=dialogue,
+        )
+        try:
+            response, _ = call_with_failover(
+                lambda endpoint: get_summary_model(*endpoint).generate_content(
+                    prompt, generation_config={"response_mime_type": "application/json"}
+                ),
+                len(prompt)
+            )
+            record_usage(response, self.usage)
+            found = json.loads(response.text)
+        except Exception:
+            # 抽出できなければ次のターンでまとめて抽出し直す
+            get_metrics().count("slot_errors")
+            return
+        
+        with self.lock:
+            if isinstance(found, dict):
+                for key, value in found.items():
+                    if key in SURVEY_SLOTS and value not in (None, "", []):
+                        self.values[key] = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+            self.extracted = max(self.extracted, len(messages))
+
+@st.cache_resource
+def _slot_executor():
+    """項目抽出のワーカー（プロセス全体で共有）"""
+    return ThreadPoolExecutor(max_workers=SLOT_WORKERS, thread_name_prefix="slots")
+
+def get_slot_tracker():
+    """現在のセッションの項目トラッカー（項目抽出が無効ならNone）"""
+    if not SLOT_TRACKING:
         return None
+    session = current_session()
+    if session.slot_tracker is None:
+        session.slot_tracker = SlotTracker(usage=session.usage)
+    return session.slot_tracker
 
-def get_gemini_response(user_message):
-    """Gemini APIを呼び出して応答を取得"""
+def slot_checklist():
+    """次のターンに添える確認状況（項目抽出が無効ならNone）"""
+    tracker = get_slot_tracker()
+    return tracker.checklist() if tracker is not None else None
+
+def with_slot_checklist(user_message, checklist):
+    """回答者のメッセージに確認状況を添えてGeminiへ送る形にする"""
+    return f"{checklist}\n\n【回答者の発言】\n{user_message}"
+
+def drop_slot_checklist(chat, user_message):
+    """送信後の履歴から確認状況を外し、回答者の発言だけを残す
+    
+    確認状況は毎ターン新しいものを添えるので、履歴に残すと古い確認状況の分だけ入力が増え続ける。
+    """
+    history = chat.history
+    if len(history) >= 2 and history[-2].role == "user":
+        chat.history = history[:-2] + [
+            protos.Content(role="user", parts=[protos.Part(text=user_message)]), history[-1]
+        ]
+
+class LiveSession:
+    """1セッション分の対話の状態（表示・保存用の履歴、Geminiのチャット、項目トラッカー）
+    
+    st.session_state には置かず、プロセス内の表（_live_sessions）で持つ。
+    履歴と調査の状態は各ターンの後にセッションの保存先（get_session_store）へ書き込むので、
+    別のレプリカや再起動後のプロセスでも、再開用のクッキーを持つブラウザなら続きを再開できる。
+    最後の操作から SESSION_IDLE_TIMEOUT 秒たったセッションは表から外し、
+    回答者が戻ってきたら保存先から復元する（チャットは保存した履歴から作り直す）。
+    """
+    
+    def __init__(self, session_id, messages=None, slot_tracker=None, usage=None, flags=None,
+                 owner=None, resume_hash="", version=0):
+        self.session_id = session_id
+        self.messages = messages if messages is not None else []
+        self.chat = None
+        self.gemini_endpoint = None
+        self.slot_tracker = slot_tracker
+        self.usage = usage or TokenUsage()
+        self.flags = flags or {}  # 最後に保存したときの st.session_state の調査の状態（SESSION_FLAGS）
+        self.owner = owner  # 回答中のブラウザセッション（client_id）
+        self.resume_hash = resume_hash  # 再開用トークンのSHA-256
+        self.version = version  # 保存先に最後に書き込んだ版
+        self.last_active = time.monotonic()
+    
+    def touch(self):
+        """最終操作時刻を更新（_live_sessions のロックを持って呼ぶ）"""
+        self.last_active = time.monotonic()
+    
+    def busy(self):
+        """バックグラウンドの項目抽出が実行中か（実行中は退避しない）"""
+        return self.slot_tracker is not None and self.slot_tracker.busy()
+    
+    def checkpoint(self):
+        """保存する内容（チャットは履歴から作り直せるので含めない）"""
+        tracker = self.slot_tracker
+        return {
+            "messages": self.messages,
+            "slots": tracker.snapshot() if tracker is not None else {},
+            "extracted": tracker.extracted if tracker is not None else 0,
+            "usage": self.usage.snapshot(),
+            "flags": self.flags,
+            "owner": self.owner,
+            "resume_hash": self.resume_hash,
+        }
+    
+    @classmethod
+    def from_checkpoint(cls, session_id, state, version):
+        usage = TokenUsage(state.get("usage"))
+        tracker = None
+        if SLOT_TRACKING and (state["slots"] or state["extracted"]):
+            tracker = SlotTracker(state["slots"], state["extracted"], usage)
+        return cls(session_id, state["messages"], tracker, usage, state.get("flags"),
+                   state.get("owner"), state.get("resume_hash", ""), version)
+
+# セッションと一緒に保存・復元する st.session_state の項目
+SESSION_FLAGS = ("user_info", "survey_started", "survey_completed", "error_fallback_shown")
+
+class SQLiteSessionStore:
+    """セッションの保存先：ローカルのSQLite（同じマシンのプロセス間で共有できる）
+    
+    書き込みは版番号の比較つき（保存先の版が手元の版と同じときだけ書き込む）。
+    終了したセッションは削除せず終了の印を残すので、古い内容で作り直されることもない。
+    """
+    
+    def __init__(self, path):
+        self.path = path
+    
+    def _connect(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS session_states (
+                session_id TEXT PRIMARY KEY,
+                state BLOB NOT NULL,
+                version INTEGER NOT NULL,
+                finished INTEGER NOT NULL DEFAULT 0,
+                updated_at TEXT NOT NULL
+            )
+        """)
+        return conn
+    
+    def save(self, session_id, data, version):
+        """版 version として書き込む（保存先が version - 1 版でなければ書き込まずにFalse）"""
+        updated_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        conn = self._connect()
+        try:
+            with conn:
+                if version == 1:
+                    cursor = conn.execute(
+                        "INSERT OR IGNORE INTO session_states VALUES (?, ?, 1, 0, ?)",
+                        (session_id, data, updated_at)
+                    )
+                else:
+                    cursor = conn.execute(
+                        "UPDATE session_states SET state = ?, version = ?, updated_at = ? "
+                        "WHERE session_id = ? AND version = ? AND finished = 0",
+                        (data, version, updated_at, session_id, version - 1)
+                    )
+            return cursor.rowcount == 1
+        finally:
+            conn.close()
+    
+    def load(self, session_id):
+        """(内容, 版)（保存されていない・終了済みならNone）"""
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                "SELECT state, version FROM session_states WHERE session_id = ? AND finished = 0",
+                (session_id,)
+            ).fetchone()
+        finally:
+            conn.close()
+        return tuple(row) if row else None
+    
+    def finish(self, session_id):
+        """終了の印を付けて内容を消す（以後の書き込み・再開はできない）"""
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("""
+                    INSERT INTO session_states VALUES (?, X'', 0, 1, ?)
+                    ON CONFLICT (session_id) DO UPDATE SET state = X'', finished = 1, updated_at = excluded.updated_at
+                """, (session_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+        finally:
+            conn.close()
+    
+    def purge(self):
+        """戻ってこなかったセッションと古い終了の印を削除"""
+        cutoff = (datetime.now() - timedelta(days=SESSION_RETENTION_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM session_states WHERE updated_at < ?", (cutoff,))
+        finally:
+            conn.close()
+    
+    def count(self):
+        conn = self._connect()
+        try:
+            return conn.execute("SELECT COUNT(*) FROM session_states WHERE finished = 0").fetchone()[0]
+        finally:
+            conn.close()
+
+class RedisSessionStore:
+    """セッションの保存先：Redis互換のサーバー（複数のノードのレプリカで共有する、redisパッケージが必要）
+    
+    セッションごとのハッシュ（state・version・finished）に、版番号の比較つきで書き込む。
+    """
+    
+    PREFIX = "bus_survey:session:"
+    SAVE_SCRIPT = """
+        local version = tonumber(redis.call('HGET', KEYS[1], 'version') or '0')
+        if redis.call('HGET', KEYS[1], 'finished') == '1' or version ~= tonumber(ARGV[2]) - 1 then
+            return 0
+        end
+        redis.call('HSET', KEYS[1], 'state', ARGV[1], 'version', ARGV[2])
+        redis.call('EXPIRE', KEYS[1], ARGV[3])
+        return 1
+    """
+    
+    def __init__(self, url):
+        self.client = redis.Redis.from_url(url)
+        self.save_script = self.client.register_script(self.SAVE_SCRIPT)
+        # 戻ってこなかったセッションはキーの有効期限で消える
+        self.ttl = int(SESSION_RETENTION_DAYS * 86400)
+    
+    def save(self, session_id, data, version):
+        return self.save_script(keys=[self.PREFIX + session_id], args=[data, version, self.ttl]) == 1
+    
+    def load(self, session_id):
+        state, version, finished = self.client.hmget(self.PREFIX + session_id, "state", "version", "finished")
+        if state is None or finished == b"1":
+            return None
+        return state, int(version)
+    
+    def finish(self, session_id):
+        key = self.PREFIX + session_id
+        pipeline = self.client.pipeline()
+        pipeline.hset(key, "finished", 1)
+        pipeline.hdel(key, "state")
+        pipeline.expire(key, self.ttl)
+        pipeline.execute()
+    
+    def purge(self):
+        pass
+    
+    def count(self):
+        # SQLiteの保存先と同じく、終了の印だけが残ったセッションは数えない
+        pipeline = self.client.pipeline(transaction=False)
+        for key in self.client.scan_iter(match=self.PREFIX + "*", count=1000):
+            pipeline.hget(key, "finished")
+        return sum(1 for finished in pipeline.execute() if finished != b"1")
+
+@st.cache_resource
+def get_session_store():
+    """セッションの保存先（SESSION_STORE_URL が redis:// ならRedis、それ以外はローカルのSQLite）"""
+    if SESSION_STORE_URL.startswith(("redis://", "rediss://", "unix://")):
+        return RedisSessionStore(SESSION_STORE_URL)
+    return SQLiteSessionStore(SESSION_STORE_PATH)
+
+def save_session_checkpoint(session):
+    """セッションの履歴と状態を保存先に書き込む（JSONをzlibで圧縮）
+    
+    保存先の版が手元で最後に書き込んだ版のままのときだけ書き込む。Falseなら別のブラウザ・レプリカが
+    このセッションを再開して先に書き込んだか、調査が終了している。
+    """
+    data = zlib.compress(json.dumps(session.checkpoint(), ensure_ascii=False).encode("utf-8"))
+    if not get_session_store().save(session.session_id, data, session.version + 1):
+        return False
+    session.version += 1
+    return True
+
+def load_session_checkpoint(session_id):
+    """保存先からセッションを復元（保存されていない・終了済みならNone）"""
+    loaded = get_session_store().load(session_id)
+    if loaded is None:
+        return None
+    data, version = loaded
+    return LiveSession.from_checkpoint(session_id, json.loads(zlib.decompress(data)), version)
+
+def resume_token_hash(token):
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+@st.cache_resource
+def _live_sessions():
+    """メモリ上のセッション（session_id → LiveSession、プロセス全体で共有）"""
+    return {"lock": threading.Lock(), "sessions": {}}
+
+def current_session():
+    """現在のセッションの対話の状態（メモリになければ保存先から復元）"""
+    registry = _live_sessions()
+    session_id = st.session_state.session_id
+    with registry["lock"]:
+        session = registry["sessions"].get(session_id)
+        if session is not None:
+            # 退避スレッドが同時に外さないよう、表のロックを持ったまま最終操作時刻を更新する
+            session.touch()
+            return session
+    restored = load_session_checkpoint(session_id) if st.session_state.survey_started else None
+    with registry["lock"]:
+        session = registry["sessions"].setdefault(
+            session_id, restored or LiveSession(session_id, owner=st.session_state.client_id)
+        )
+        session.touch()
+    if restored is not None and session is restored:
+        get_metrics().count("sessions", "restored")
+    return session
+
+def session_taken_over():
+    """この調査が別のブラウザセッションで再開され、この画面では続けられないか"""
+    if st.session_state.session_conflict:
+        return True
+    owner = current_session().owner
+    return owner is not None and owner != st.session_state.client_id
+
+def persist_session():
+    """現在のセッションの履歴と調査の状態を保存先に書き込む（各ターンの後に呼ぶ）
+    
+    別のブラウザセッションが再開して先に書き込んでいた場合は書き込まずにFalseを返す。
+    """
+    if session_taken_over():
+        return False
+    session = current_session()
+    session.flags = {key: st.session_state[key] for key in SESSION_FLAGS}
+    if not session.resume_hash:
+        # 再開用トークンは最初の保存時に作り、保存先にはハッシュだけを残す（トークンはクッキーへ）
+        st.session_state.resume_token = secrets.token_urlsafe(32)
+        session.resume_hash = resume_token_hash(st.session_state.resume_token)
+    try:
+        if not save_session_checkpoint(session):
+            st.session_state.session_conflict = True
+            return False
+    except Exception:
+        # 保存できなくても対話は続ける（次のターンで書き込み直す）
+        get_metrics().count("session_store_errors")
+    return True
+
+def _write_resume_cookie(value, max_age):
+    """再開用のクッキーを書き込む（st.context.cookies は読み取り専用なので、ページのスクリプトで設定する）"""
+    secure = "; Secure" if (st.context.url or "").startswith("https://") else ""
+    st.iframe(
+        f"<script>window.parent.document.cookie = {json.dumps(f'{RESUME_COOKIE}={value}')} + "
+        f"'; path=/; max-age={max_age}; SameSite=Strict{secure}';</script>",
+        height="content",
+    )
+
+def set_resume_cookie():
+    """このブラウザに再開用のクッキーを設定（セッションIDと再開用トークン、URLには入れない）"""
+    token = st.session_state.resume_token
+    if token:
+        _write_resume_cookie(f"{st.session_state.session_id}.{token}", int(SESSION_RETENTION_DAYS * 86400))
+
+def clear_resume_cookie():
+    _write_resume_cookie("", 0)
+
+def resume_session():
+    """このブラウザの再開用クッキーから、保存先の調査の続きを再開（別のレプリカ・再起動後のプロセスでも）
+    
+    トークンが保存先のハッシュと一致しないとき、終了・期限切れのときは再開しない。
+    同じ調査を開いている別のブラウザセッション（再読み込み前の画面など）からは、ここで書き込んだ版で引き継ぐ。
+    """
+    if st.session_state.survey_started:
+        return
+    cookie = st.context.cookies.get(RESUME_COOKIE)
+    if not isinstance(cookie, str):
+        return
+    session_id, _, token = cookie.partition(".")
+    if not token:
+        return
+    try:
+        session = load_session_checkpoint(session_id)
+    except Exception:
+        get_metrics().count("session_store_errors")
+        return
+    if (session is None or not session.flags.get("survey_started")
+            or not hmac.compare_digest(session.resume_hash, resume_token_hash(token))):
+        return
+    
+    # 自分の版として書き込んでから使う（前の画面・別のレプリカに残っている古い状態は次の書き込みで失敗する）
+    session.owner = st.session_state.client_id
+    try:
+        if not save_session_checkpoint(session):
+            return
+    except Exception:
+        get_metrics().count("session_store_errors")
+        return
+    
+    st.session_state.session_id = session_id
+    st.session_state.resume_token = token
+    for key in SESSION_FLAGS:
+        if key in session.flags:
+            st.session_state[key] = session.flags[key]
+    # 保存先の内容を正とする（このプロセスに古い状態が残っていても置き換える）
+    registry = _live_sessions()
+    with registry["lock"]:
+        registry["sessions"][session_id] = session
+        session.touch()
+    get_metrics().count("sessions", "resumed")
+
+def end_live_session():
+    """調査を終えたセッションをメモリから外し、保存先に終了の印を付ける（回答は保存キューに書き込み済み）"""
+    registry = _live_sessions()
+    session_id = st.session_state.session_id
+    with registry["lock"]:
+        registry["sessions"].pop(session_id, None)
+    get_session_store().finish(session_id)
+
+def chat_history_from_messages(messages):
+    """保存した履歴からGeminiのチャット履歴を作る（最初の依頼文は基本情報から作り直す）"""
+    user_info = st.session_state.user_info
+    history = [{"role": "user", "parts": [build_initial_context(
+        user_info.get("age_group", ""), user_info.get("usage_frequency", ""),
+        "" if user_info.get("location", "未記入") == "未記入" else user_info["location"]
+    )]}]
+    for message in messages:
+        role = "user" if message["role"] == "user" else "model"
+        # 同じ話者が続く場合（自由記述など）は1つにまとめて交互にする
+        if history[-1]["role"] == role:
+            history[-1]["parts"][0] += "\n\n" + message["content"]
+        else:
+            history.append({"role": role, "parts": [message["content"]]})
+    return history
+
+def evict_idle_sessions():
+    """最後の操作から SESSION_IDLE_TIMEOUT 秒たったセッションをメモリから外す
+    
+    各ターンの後に persist_session で書き込んでいるので、ここでは保存先に書き込まない
+    （手元の古い内容で、別のレプリカが書き込んだ新しい内容や終了の印を上書きしないため）。
+    最後のターンの後に抽出した項目は、復元後の次のターンで抽出し直される。
+    """
+    registry = _live_sessions()
+    now = time.monotonic()
+    with registry["lock"]:
+        idle = [
+            session_id for session_id, session in registry["sessions"].items()
+            if now - session.last_active > SESSION_IDLE_TIMEOUT and not session.busy()
+        ]
+        for session_id in idle:
+            del registry["sessions"][session_id]
+            get_metrics().count("sessions", "evicted")
+    
+    get_session_store().purge()
+
+def _run_session_sweeper(state):
+    while True:
+        time.sleep(SESSION_SWEEP_INTERVAL)
+        try:
+            evict_idle_sessions()
+        except Exception as e:
+            state["last_error"] = str(e)
+
+@st.cache_resource
+def _session_sweeper():
+    """アイドルセッションの退避スレッドを開始（プロセスで1つ）"""
+    state = {"last_error": None}
+    thread = threading.Thread(target=_run_session_sweeper, args=(state,), daemon=True)
+    thread.start()
+    state["thread"] = thread
+    return state
+
+def session_counts():
+    """メモリ上のセッション数と保存先にあるセッション数"""
+    registry = _live_sessions()
+    with registry["lock"]:
+        live = len(registry["sessions"])
+    return live, get_session_store().count()
+
+@st.cache_resource(max_entries=1)
+def _load_gazetteer(path, inode, mtime_ns):
+    """地名辞書をメモリマップで読み込む（読み込めたものだけをプロセス全体で共有する）
+    
+    ファイルのinode・更新時刻もキーにするので、索引を作り直すと次の呼び出しで読み込み直す。
+    置き換え前の索引は引いている途中の呼び出しが終わるまで古いファイルのまま読める。
+    """
+    return gazetteer.Gazetteer(path)
+
+def get_gazetteer():
+    """地名辞書（ファイルがない・読めなければNone）
+    
+    失敗はキャッシュしないので、起動後に辞書を置いた・作り直した場合も次の呼び出しで読み込む。
+    """
+    try:
+        stat = os.stat(GAZETTEER_PATH)
+        return _load_gazetteer(GAZETTEER_PATH, stat.st_ino, stat.st_mtime_ns)
+    except (OSError, ValueError):
+        return None
+
+def normalize_location(location):
+    """自由記述の場所を地域コード・座標に正規化（分からなければ空の値）"""
+    index = get_gazetteer()
+    place = index.lookup(location) if index is not None and location else None
+    if place is None:
+        return {"area_code": "", "latitude": "", "longitude": ""}
+    return {"area_code": place.area_code, "latitude": place.latitude, "longitude": place.longitude}
+
+def build_initial_context(age_group, usage_frequency, location):
+    """初回メッセージ（挨拶と最初の質問）を依頼するプロンプト"""
+    location_info = f"\n- お住まいの地域：{location}" if location else ""
+    return f"""調査対象者の基本情報：
+- 年齢層：{age_group}
+- バス利用頻度：{usage_frequency}{location_info}
+
+この情報を踏まえて、自然な挨拶と最初の質問をしてください。"""
+
+@st.cache_resource
+def _greeting_cache():
+    """挨拶キャッシュ（年齢層×利用頻度ごとの挨拶候補、ファイルから読み込み）"""
+    greetings = {}
+    try:
+        with open(GREETING_CACHE_PATH, encoding="utf-8") as f:
+            greetings = json.load(f)
+    except (OSError, ValueError):
+        pass
+    return {"lock": threading.Lock(), "greetings": greetings, "turns": collections.Counter()}
+
+def _greeting_key(age_group, usage_frequency):
+    return f"{age_group}|{usage_frequency}"
+
+def get_cached_greeting(age_group, usage_frequency):
+    """キャッシュ済みの挨拶を候補から順番に返す（なければNone）"""
+    if GREETING_CACHE_VARIANTS <= 0:
+        return None
+    cache = _greeting_cache()
+    key = _greeting_key(age_group, usage_frequency)
+    with cache["lock"]:
+        variants = cache["greetings"].get(key)
+        if not variants:
+            return None
+        cache["turns"][key] += 1
+        return variants[cache["turns"][key] % len(variants)]
+
+def store_greeting(age_group, usage_frequency, greeting):
+    """挨拶を候補に追加してファイルに保存（追加したらTrue、候補数が上限に達しているか重複ならFalse）"""
+    if GREETING_CACHE_VARIANTS <= 0:
+        return False
+    cache = _greeting_cache()
+    key = _greeting_key(age_group, usage_frequency)
+    with cache["lock"]:
+        variants = cache["greetings"].setdefault(key, [])
+        if len(variants) >= GREETING_CACHE_VARIANTS or greeting in variants:
+            return False
+        variants.append(greeting)
+        
+        directory = os.path.dirname(GREETING_CACHE_PATH)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = GREETING_CACHE_PATH + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(cache["greetings"], f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, GREETING_CACHE_PATH)
+        return True
+
+def cached_greeting_count(age_group, usage_frequency):
+    """キャッシュ済みの挨拶候補の数"""
+    cache = _greeting_cache()
+    with cache["lock"]:
+        return len(cache["greetings"].get(_greeting_key(age_group, usage_frequency), []))
+
+def pregenerate_greetings():
+    """全ての年齢層×利用頻度について挨拶候補を生成（回答者の呼び出しを優先し、空きがあるときだけ生成）
+    
+    1組あたりGREETING_MAX_ATTEMPTS回試して足りなければあきらめる（次回の起動時に続きを生成する）。
+    エラー・空・重複の応答のあとは待ち時間を倍々に延ばし、トークン使用量が上限に近づいたら生成をやめる。
+    """
+    pool = get_gemini_pool()
+    budget = get_token_budget()
+    for age_group in AGE_GROUPS:
+        for usage_frequency in USAGE_FREQUENCIES:
+            failures = 0
+            for _ in range(GREETING_MAX_ATTEMPTS):
+                if cached_greeting_count(age_group, usage_frequency) >= GREETING_CACHE_VARIANTS:
+                    break
+                # 挨拶の生成は省けるので、回答者の応答を短くし始める段階で打ち切る
+                if budget.fraction() >= GEMINI_BUDGET_REDUCE_AT:
+                    return
+                if failures:
+                    delay = min(GREETING_RETRY_MAX_DELAY, GREETING_RETRY_DELAY * 2 ** (failures - 1))
+                    time.sleep(delay * random.uniform(0.5, 1.5))
+                while not pool.has_spare_capacity():
+                    time.sleep(5)
+                
+                initial_context = build_initial_context(age_group, usage_frequency, "")
+                try:
+                    response, _ = call_with_failover(
+                        lambda endpoint: get_gemini_model(*endpoint).generate_content(initial_context),
+                        estimate_tokens_for_text(initial_context)
+                    )
+                    record_usage(response)
+                    greeting = response.text if response.parts else ""
+                except Exception:
+                    # クォータ超過などの場合は時間をおいて再試行
+                    failures += 1
+                    continue
+                if greeting and store_greeting(age_group, usage_frequency, greeting):
+                    failures = 0
+                else:
+                    failures += 1
+
+def get_gemini_response(user_message, placeholder=None, checklist=None):
+    """Gemini APIを呼び出して応答を取得（placeholderを渡すと受信途中の文章を逐次表示）
+    
+    checklistを渡すとこのターンだけ確認状況を添えて送り、履歴には回答者の発言だけを残す。
+    """
     if not GEMINI_API_KEY:
         return "エラー：APIキーが設定されていません。"
     
     try:
-        # チャットセッションがなければ初期化
-        if st.session_state.chat is None:
-            st.session_state.chat = initialize_chat()
-            if st.session_state.chat is None:
+        # チャットセッションがなければ初期化（保存先から復元したセッションは保存した履歴から作り直す）
+        session = current_session()
+        if session.chat is None:
+            history = chat_history_from_messages(session.messages[:-1]) if len(session.messages) > 1 else None
+            session.chat = initialize_chat(history=history)
+            if session.chat is None:
                 return "エラー：チャットセッションを初期化できませんでした。"
         
-        # メッセージを送信して応答を取得
-        response = st.session_state.chat.send_message(user_message)
+        # 混雑時は待ち順を表示する
+        on_wait = None
+        if placeholder is not None:
+            def on_wait(position):
+                placeholder.markdown(f"ただいま混み合っています。順番にお応えしますので少々お待ちください（{position}番目）...")
         
-        # 応答が正常に生成されたか確認
-        if response.parts:
-            return response.text
+        message = with_slot_checklist(user_message, checklist) if checklist else user_message
+        metrics = get_metrics()
+        started = time.perf_counter()
+        if placeholder is not None and GEMINI_STREAMING:
+            # ストリーミングで受信し、届いた分から表示する
+            response, session.gemini_endpoint = send_chat_message(
+                session.chat, message, session.gemini_endpoint,
+                stream=True, on_wait=on_wait
+            )
+            metrics.observe("gemini_ttfb", time.perf_counter() - started)
+            text = ""
+            for chunk in response:
+                if chunk.parts:
+                    text += chunk.text
+                    placeholder.markdown(text + "▌")
+            metrics.observe("gemini_total", time.perf_counter() - started)
+            record_usage(response, session.usage)
+            # SAFETYなどで止まった応答はSDKが履歴に入れられず、次に履歴を読むと例外になるので取り消す
+            finish_reason = response.candidates[0].finish_reason if response.candidates else None
+            if finish_reason is not None and finish_reason not in (
+                protos.Candidate.FinishReason.FINISH_REASON_UNSPECIFIED,
+                protos.Candidate.FinishReason.STOP,
+                protos.Candidate.FinishReason.MAX_TOKENS,
+            ):
+                session.chat.rewind()
+            elif text:
+                if checklist:
+                    drop_slot_checklist(session.chat, user_message)
+                placeholder.markdown(text)
+                return text
         else:
-            # 応答が生成されなかった場合の詳細を確認
-            finish_reason = getattr(response.candidates[0], 'finish_reason', None) if response.candidates else None
+            # メッセージを送信して応答を取得
+            response, session.gemini_endpoint = send_chat_message(
+                session.chat, message, session.gemini_endpoint,
+                on_wait=on_wait
+            )
+            metrics.observe("gemini_ttfb", time.perf_counter() - started)
+            metrics.observe("gemini_total", time.perf_counter() - started)
+            record_usage(response, session.usage)
             
-            # フィルタリングされた可能性がある場合
-            if finish_reason == 2:  # SAFETY
-                return "申し訳ございません。システムの都合により応答を生成できませんでした。別の表現で入力いただけますでしょうか。"
-            elif finish_reason == 3:  # MAX_TOKENS
-                return "応答が長すぎたため、途中で切れてしまいました。もう一度お試しください。"
-            else:
-                return f"応答の生成に失敗しました。もう一度お試しください。（理由コード: {finish_reason}）"
+            # 応答が正常に生成されたか確認
+            if response.parts:
+                if checklist:
+                    drop_slot_checklist(session.chat, user_message)
+                return response.text
+        
+        # 応答が生成されなかった場合の詳細を確認
+        finish_reason = getattr(response.candidates[0], 'finish_reason', None) if response.candidates else None
+        
+        # フィルタリングされた可能性がある場合
+        if finish_reason == protos.Candidate.FinishReason.SAFETY:
+            metrics.count("gemini_errors", "safety")
+            return "申し訳ございません。システムの都合により応答を生成できませんでした。別の表現で入力いただけますでしょうか。"
+        elif finish_reason == protos.Candidate.FinishReason.MAX_TOKENS:
+            metrics.count("gemini_errors", "max_tokens")
+            return "応答が長すぎたため、途中で切れてしまいました。もう一度お試しください。"
+        else:
+            metrics.count("gemini_errors", "other")
+            return f"応答の生成に失敗しました。もう一度お試しください。（理由コード: {finish_reason}）"
     
     except AttributeError as e:
         # response.text が存在しない場合
+        get_metrics().count("gemini_errors", "other")
         return "申し訳ございません。応答を生成できませんでした。もう一度お試しください。"
     
+    except gemini_cassette.CassetteMiss:
+        # 再生時に一致する記録がないのは試験の設定の誤りなので、エラーの案内に置き換えずにそのまま止める
+        raise
+    
     except Exception as e:
         error_msg = str(e)
+        get_metrics().count("gemini_errors", classify_gemini_error(e))
         
-        # クォータ超過エラー（429）を検出
-        if "429" in error_msg or "quota" in error_msg.lower() or "exceeded" in error_msg.lower():
+        # クォータ超過エラー（429、再試行しても解消しない場合）や待ち行列のタイムアウトを検出
+        if isinstance(e, GeminiQueueTimeout) or is_quota_error(e):
             return "申し訳ございません。現在、多くの方にご利用いただいているため、一時的に応答できない状況です。少し時間をおいてから再度お試しください。ご不便をおかけして申し訳ございません。"
         
         # その他のエラー
@@ -363,127 +2484,331 @@ def get_gemini_response(user_message):
         # 技術的なエラーメッセージは非表示にする
         return "申し訳ございません。一時的なエラーが発生しました。もう一度お試しください。"
 
-# メインUI
-st.title("バス利用に関するヒアリング調査")
+def admin_authenticated():
+    """管理者パスワードの確認（確認済みならTrue、未確認なら入力欄を表示してFalse）"""
+    if not ADMIN_PASSWORD:
+        st.error("管理者パスワード（ADMIN_PASSWORD）が設定されていないため表示できません。")
+        return False
+    if not st.session_state.get("admin_authenticated"):
+        password = st.text_input("パスワード", type="password")
+        if not password:
+            return False
+        # 一致するまでの文字数で応答時間が変わらないよう、定数時間で比較する
+        if not hmac.compare_digest(password.encode("utf-8"), ADMIN_PASSWORD.encode("utf-8")):
+            st.error("パスワードが違います")
+            return False
+        st.session_state.admin_authenticated = True
+    return True
 
-# Google Sheets初期化（初回のみ）
-if st.session_state.spreadsheet is None:
-    spreadsheet, error = initialize_google_sheets()
-    if spreadsheet:
-        st.session_state.spreadsheet = spreadsheet
-    elif error:
-        st.error(f"⚠️ Google Sheets接続エラー: {error}")
-        st.info("""
-        **セットアップが必要です：**
-        1. Google Cloud Platformでサービスアカウントを作成
-        2. Streamlit SecretsにJSON認証情報を設定
-        3. スプレッドシートをサービスアカウントと共有
-        
-        詳細は SETUP_SHEETS.md を参照してください。
-        """)
-        st.stop()
-
-# APIキーの確認
-if not GEMINI_API_KEY:
-    st.warning("⚠️ APIキーが設定されていません")
-    st.info("👉 Google AI StudioでAPIキーを取得: https://makersuite.google.com/app/apikey")
-    api_key_input = st.text_input("Gemini APIキーを入力してください：", type="password")
-    if api_key_input:
-        GEMINI_API_KEY = api_key_input
-        genai.configure(api_key=GEMINI_API_KEY)
-        st.success("✅ APIキーが設定されました！")
+def render_admin_page():
+    """管理者ページ（計測値・キープール・セッション・保存キューの状況）"""
+    st.title("管理者ページ")
+    if not admin_authenticated():
+        return
+    
+    metrics = get_metrics()
+    
+    st.subheader("処理時間")
+    timing_rows = []
+    for name, label in TIMINGS.items():
+        count, total = metrics.totals(name)
+        timing_rows.append({
+            "項目": label,
+            "件数": count,
+            "平均（秒）": round(total / count, 3) if count else None,
+        })
+        for q in (0.5, 0.95, 0.99):
+            value = metrics.quantile(name, q)
+            timing_rows[-1][f"p{int(q * 100)}（秒）"] = round(value, 3) if value is not None else None
+    st.dataframe(timing_rows, hide_index=True)
+    
+    st.subheader("エラー・件数")
+    with metrics.lock:
+        counter_rows = [
+            {"項目": name, "分類": label, "件数": value}
+            for (name, label), value in sorted(metrics.counters.items())
+        ]
+    st.dataframe(counter_rows, hide_index=True)
+    
+    st.subheader("Gemini キープール")
+    pool = get_gemini_pool()
+    now = time.monotonic()
+    st.dataframe([
+        {
+            "キー": f"…{api_key[-4:]}",
+            "モデル": model_name,
+            "残りリクエスト枠": round(pool.limiters[(api_key, model_name)].available(), 1),
+            "休止残り（秒）": max(0, round(pool.cooldown_until[(api_key, model_name)] - now)),
+        }
+        for api_key, model_name in pool.endpoints
+    ], hide_index=True)
+    
+    st.subheader("トークン使用量（直近24時間）")
+    budget = get_token_budget()
+    if budget.limit > 0:
+        st.progress(min(1.0, budget.fraction()), text=f"{budget.used():,} / {budget.limit:,} トークン")
+        if not budget.accepting_new_sessions():
+            st.caption("上限に近いため新しい調査の受付を停止しています。")
+        elif budget.max_output_tokens() < GENERATION_CONFIG["max_output_tokens"]:
+            st.caption(f"上限に近いため応答を最大{budget.max_output_tokens()}トークンに抑えています。")
+    else:
+        st.metric("使用トークン数", f"{budget.used():,}")
+    
+    st.subheader("セッション")
+    live, stored = session_counts()
+    col1, col2 = st.columns(2)
+    col1.metric("メモリ上のセッション", live)
+    col2.metric("保存先のセッション", stored)
+    
+    st.subheader("保存キュー")
+    st.metric("未送信行数", outbox_pending_count())
+    last_error = _outbox_flusher()["last_error"]
+    if last_error:
+        st.caption(f"直近の送信エラー: {last_error}")
+    
+    if METRICS_PORT:
+        st.caption(f"Prometheus形式: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    if st.button("更新"):
         st.rerun()
-    st.stop()
 
-# 調査開始前の基本情報入力
-if not st.session_state.survey_started:
-    st.markdown("""
-    ### ご協力のお願い
+# 集計する時間帯（要約シートの項目の列）
+TRAVEL_TIME_BANDS = {
+    "morning": ("朝", "slot_morning_minutes"),
+    "noon": ("昼", "slot_noon_minutes"),
+    "evening": ("夕方", "slot_evening_minutes"),
+    "fastest": ("最速", "slot_fastest"),
+    "slowest": ("最遅", "slot_slowest"),
+    "spread": ("時間帯による差", "slot_spread"),
+}
+# 集計の切り口（全体・利用区間・地域）
+AGGREGATE_DIMENSIONS = {"all": "全体", "route": "利用区間", "area": "地域"}
+
+def parse_minutes(values):
+    """「30分」「1時間10分」「25」などの文字列の列を分（float、読めなければNaN）にする（ベクトル演算）
     
-    バスの利便性評価に関する研究を行っております。
-    AIとの対話形式で、バス利用に関するあなたの率直なご意見をお聞かせください。
+    「7時30分頃」「8時半」「17:30」などの時刻は所要時間ではないので、先に取り除く
+    （「8時頃・25分」は25分）。
+    """
+    text = values.fillna("").astype(str).str.normalize("NFKC")
+    text = text.str.replace(r"\d+(?:\.\d+)?\s*時(?!間)(?:\s*\d+\s*分|\s*半)?|\d{1,2}:\d{2}", "", regex=True)
+    hours = text.str.extract(r"(\d+(?:\.\d+)?)\s*時間", expand=False).astype(float)
+    minutes = text.str.extract(r"(\d+(?:\.\d+)?)\s*分", expand=False).astype(float)
+    bare = text.str.extract(r"^\s*(\d+(?:\.\d+)?)\s*$", expand=False).astype(float)
+    total = hours.fillna(0) * 60 + minutes.fillna(0)
+    return total.where(hours.notna() | minutes.notna(), bare)
+
+class TravelTimeAggregates:
+    """時間帯別の所要時間の集計（新しいセッションの分だけ足し込み、プロセス内で保持する）
     
-    **所要時間**：約5〜10分  
-    **データの取り扱い**：回答は匿名で処理され、研究目的のみに使用されます。  
-    **使用AI**：Gemini 2.5 Flash-Lite
-    """)
+    切り口（全体・利用区間・地域）×値×時間帯ごとに、件数・合計・二乗和・最小・最大と
+    分布（DASHBOARD_BIN_MINUTES分刻みの件数）を持つ。どれも足し合わせられるので、
+    新しい行だけを集計して既存の集計に加えればよい。
+    """
     
-    with st.form("user_info_form"):
-        st.subheader("基本情報")
-        
-        age_group = st.selectbox(
-            "年齢層",
-            ["選択してください", "10代", "20代", "30代", "40代", "50代", "60代", "70代以上"]
-        )
-        
-        usage_frequency = st.selectbox(
-            "バスの利用頻度",
-            ["選択してください", "ほぼ毎日", "週に数回", "月に数回", "年に数回", "ほとんど利用しない"]
-        )
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.high_water = {}  # ワークシート名 → 集計済みの最終行
+        self.headers = {}     # ワークシート名 → ヘッダー行
+        self.sessions = 0
+        self.missing = 0      # 所要時間の項目が1つも読めなかったセッション数
+        self.stats = None
+        self.refreshed_at = 0.0
+    
+    @staticmethod
+    def summarize_batch(frame):
+        """要約シートの行（DataFrame）を集計する（(集計, 所要時間が読めなかった行数) を返す）"""
+        minutes = pd.DataFrame({
+            band: parse_minutes(frame[column]) if column in frame else np.nan
+            for band, (_, column) in TRAVEL_TIME_BANDS.items()
+        }, index=frame.index)
+        # 時間帯による差が聞けていなければ、朝・昼・夕方の最大と最小の差で補う
+        observed = minutes[["morning", "noon", "evening"]]
+        derived = (observed.max(axis=1) - observed.min(axis=1)).where(observed.count(axis=1) >= 2)
+        minutes["spread"] = minutes["spread"].fillna(derived)
+        missing = int(minutes.isna().all(axis=1).sum())
         
-        st.markdown("---")
-        st.markdown("### お住まいの地域（任意）")
-        st.caption("より地域に即した改善提案のため、差し支えなければご記入ください。")
+        keys = pd.DataFrame({
+            "all": "全体",
+            "route": frame.get("slot_route", pd.Series("", index=frame.index)).fillna("").astype(str).str.strip(),
+            "area": frame.get("area_code", pd.Series("", index=frame.index)).fillna("").astype(str).str.strip(),
+        }, index=frame.index).replace("", "不明")
         
-        location_input = st.text_input(
-            "お住まいの場所",
-            placeholder="例：郵便番号（920-1192）、町名（角間町）、目印（金沢大学の近く）など",
-            help="郵便番号、町字、近くの目印（駅名・大学名・商業施設など）のいずれかで構いません。入力は任意です。"
-        )
+        minutes.columns.name = "band"
+        long = minutes.stack().dropna().rename("minutes").reset_index(level="band")
+        long = long.join(keys)
+        long["bin"] = np.clip(long["minutes"] // DASHBOARD_BIN_MINUTES, 0, DASHBOARD_BINS - 1).astype(int)
+        long["square"] = long["minutes"] ** 2
         
-        submitted = st.form_submit_button("調査を開始する")
+        parts = []
+        for dimension in AGGREGATE_DIMENSIONS:
+            grouped = long.groupby([dimension, "band"])
+            stats = grouped["minutes"].agg(["count", "sum", "min", "max"])
+            stats["sumsq"] = grouped["square"].sum()
+            histogram = long.groupby([dimension, "band", "bin"]).size().unstack(fill_value=0)
+            histogram = histogram.reindex(columns=range(DASHBOARD_BINS), fill_value=0)
+            histogram.columns = [f"bin_{i}" for i in histogram.columns]
+            stats = stats.join(histogram)
+            stats.index = pd.MultiIndex.from_arrays(
+                [[dimension] * len(stats), stats.index.get_level_values(0), stats.index.get_level_values(1)],
+                names=["dimension", "key", "band"],
+            )
+            parts.append(stats)
+        return (pd.concat(parts) if parts else None), missing
+    
+    def add(self, frame):
+        """新しい行の集計を既存の集計に足し込む"""
+        batch, missing = self.summarize_batch(frame)
+        self.sessions += len(frame)
+        self.missing += missing
+        if batch is None or batch.empty:
+            return
+        if self.stats is None:
+            self.stats = batch.sort_index()
+            return
+        index = self.stats.index.union(batch.index)
+        old = self.stats.reindex(index)
+        new = batch.reindex(index)
+        merged = old.fillna(0) + new.fillna(0)
+        merged["min"] = np.fmin(old["min"], new["min"])
+        merged["max"] = np.fmax(old["max"], new["max"])
+        self.stats = merged.sort_index()
+    
+    def table(self, dimension):
+        """切り口ごとの表（平均・標準偏差・分布から求めた中央値と90%点）"""
+        if self.stats is None or dimension not in self.stats.index.get_level_values(0):
+            return None
+        stats = self.stats.loc[dimension]
+        count = stats["count"]
+        mean = stats["sum"] / count
+        std = np.sqrt(np.maximum(stats["sumsq"] / count - mean ** 2, 0))
+        histogram = stats[[f"bin_{i}" for i in range(DASHBOARD_BINS)]].to_numpy()
+        cumulative = histogram.cumsum(axis=1)
+        total = cumulative[:, -1:]
+        # 分布の区間の上端で近似した分位点
+        median = (np.argmax(cumulative >= total * 0.5, axis=1) + 1) * DASHBOARD_BIN_MINUTES
+        p90 = (np.argmax(cumulative >= total * 0.9, axis=1) + 1) * DASHBOARD_BIN_MINUTES
+        table = pd.DataFrame({
+            "件数": count.astype(int),
+            "平均（分）": mean.round(1),
+            "標準偏差（分）": std.round(1),
+            "中央値（分）": median,
+            "90%点（分）": p90,
+            "最小（分）": stats["min"],
+            "最大（分）": stats["max"],
+        }, index=stats.index)
+        # 時間帯は朝・昼・夕方…の順に並べる
+        order = list(TRAVEL_TIME_BANDS)
+        table = table.iloc[sorted(range(len(table)), key=lambda i: (table.index[i][0], order.index(table.index[i][1])))]
+        table = table.rename(index={band: label for band, (label, _) in TRAVEL_TIME_BANDS.items()}, level=1)
+        return table.rename_axis([AGGREGATE_DIMENSIONS[dimension], "時間帯"])
+    
+    def distribution(self, dimension="all", key="全体"):
+        """時間帯ごとの所要時間の分布（行：区間の下端（分）、列：時間帯）"""
+        if self.stats is None or (dimension, key) not in self.stats.index.droplevel(2):
+            return None
+        stats = self.stats.loc[(dimension, key)]
+        histogram = stats[[f"bin_{i}" for i in range(DASHBOARD_BINS)]].T
+        histogram.index = [i * DASHBOARD_BIN_MINUTES for i in range(DASHBOARD_BINS)]
+        return histogram.rename(columns={band: label for band, (label, _) in TRAVEL_TIME_BANDS.items()})
+
+@st.cache_resource
+def get_travel_time_aggregates():
+    """時間帯別の所要時間の集計（プロセス全体で共有し、ページを開き直しても保持する）"""
+    return TravelTimeAggregates()
+
+def refresh_travel_time_aggregates(force=False):
+    """要約シートの未集計の行だけを読み込んで集計に足し込む（読み込んだ行数を返す）"""
+    aggregates = get_travel_time_aggregates()
+    with aggregates.lock:
+        if not force and time.monotonic() - aggregates.refreshed_at < DASHBOARD_REFRESH_INTERVAL:
+            return 0
+        spreadsheet, error = get_spreadsheet()
+        if spreadsheet is None:
+            raise RuntimeError(error)
         
-        if submitted:
-            if age_group == "選択してください" or usage_frequency == "選択してください":
-                st.error("年齢層とバス利用頻度を選択してください。")
-            else:
-                st.session_state.user_info = {
-                    "age_group": age_group,
-                    "usage_frequency": usage_frequency,
-                    "location": location_input if location_input else "未記入"
-                }
-                st.session_state.survey_started = True
-                
-                # チャットセッションを初期化
-                st.session_state.chat = initialize_chat()
-                
-                # 初回メッセージ
-                location_info = f"\n- お住まいの地域：{location_input}" if location_input else ""
-                initial_context = f"""調査対象者の基本情報：
-- 年齢層：{age_group}
-- バス利用頻度：{usage_frequency}{location_info}
+        added = 0
+        for worksheet in list_shards(spreadsheet, "summary"):
+            title = worksheet.title
+            header = aggregates.headers.get(title) or worksheet.row_values(1)
+            start = aggregates.high_water.get(title, 1) + 1
+            while True:
+                # 新しい行だけを行の範囲指定でまとめて読む（列は限定せず、後から増えた列も読む）
+                end = start + OUTBOX_BATCH_ROWS - 1
+                rows = worksheet.get(f"{start}:{end}")
+                # ヘッダーより長い行があれば列が追加されているので、ヘッダーを読み直す
+                if any(len(row) > len(header) for row in rows):
+                    header = worksheet.row_values(1)
+                rows = [row + [""] * (len(header) - len(row)) for row in rows]
+                if rows:
+                    frame = pd.DataFrame([row[:len(header)] for row in rows], columns=header)
+                    aggregates.add(frame[frame["session_id"] != ""])
+                    aggregates.high_water[title] = start + len(rows) - 1
+                    added += len(rows)
+                if len(rows) < OUTBOX_BATCH_ROWS:
+                    break
+                start = end + 1
+            aggregates.headers[title] = header
+        aggregates.refreshed_at = time.monotonic()
+        return added
 
-この情報を踏まえて、自然な挨拶と最初の質問をしてください。"""
-                
-                initial_message = get_gemini_response(initial_context)
-                
-                # 初回メッセージでもエラーチェック
-                error_keywords = [
-                    "申し訳ございません",
-                    "申し訳ありません", 
-                    "エラー",
-                    "応答できない",
-                    "利用いただけない",
-                    "quota",
-                    "429"
-                ]
-                is_error = any(keyword in initial_message for keyword in error_keywords)
-                
-                if is_error:
-                    st.session_state.error_fallback_shown = True
-                
-                st.session_state.messages.append({
-                    "role": "assistant",
-                    "content": initial_message
-                })
-                st.rerun()
+def render_dashboard_page():
+    """集計ページ（時間帯別の所要時間の分布と、時間帯による差）"""
+    st.title("所要時間の集計")
+    if not admin_authenticated():
+        return
+    
+    force = st.button("最新の状態に更新")
+    try:
+        added = refresh_travel_time_aggregates(force=force)
+    except Exception as e:
+        st.error(f"要約シートを読み込めませんでした: {e}")
+        added = 0
+    
+    aggregates = get_travel_time_aggregates()
+    col1, col2, col3 = st.columns(3)
+    col1.metric("集計したセッション数", aggregates.sessions, delta=added or None)
+    col2.metric("所要時間が未抽出", aggregates.missing)
+    col3.caption(f"新しい行は最短{DASHBOARD_REFRESH_INTERVAL:.0f}秒ごとに読み込みます（要約シートの新しい行だけを読み込みます）")
+    if aggregates.missing:
+        # 要約シートの slot_* 列は対話中の抽出結果で、混雑時は終了までに抽出しきれないことがある
+        st.caption(
+            "所要時間が未抽出のセッションは、対話中の項目抽出が終了までに間に合わなかったものです。"
+            "集計に含めるには extract_transcripts.py で対話記録から抽出してください。"
+        )
+    
+    overall = aggregates.table("all")
+    if overall is None:
+        st.info("まだ集計できる回答がありません。")
+        return
+    
+    st.subheader("時間帯別の所要時間")
+    st.dataframe(overall.droplevel(0))
+    distribution = aggregates.distribution()
+    if distribution is not None:
+        st.caption(f"所要時間の分布（{DASHBOARD_BIN_MINUTES}分刻み、横軸は区間の下端）")
+        st.bar_chart(distribution[[label for label in ("朝", "昼", "夕方") if label in distribution]])
+    
+    for dimension in ("route", "area"):
+        table = aggregates.table(dimension)
+        if table is not None:
+            st.subheader(f"{AGGREGATE_DIMENSIONS[dimension]}別")
+            st.dataframe(table)
 
-# 調査中の対話
-elif st.session_state.survey_started and not st.session_state.survey_completed:
-    st.markdown("---")
+@st.fragment
+def render_chat_pane(rendered_count):
+    """対話の入力欄・自由記述欄・終了ボタン（フラグメントとして単独で再実行される）
+    
+    rendered_count はスクリプト全体の実行時に描画済みのメッセージ数。
+    フラグメントの再実行では描画がいったん消えるので、それ以降に追加されたメッセージを描き直す。
+    その数が CHAT_FRAGMENT_MAX_MESSAGES に達したらスクリプト全体を再実行して rendered_count を進め、
+    1回のフラグメントの再実行で描き直すメッセージ数がターンごとに増え続けないようにする。
+    """
+    # 別の画面でこの調査が再開されていたら、スクリプト全体を再実行して案内を表示する
+    if session_taken_over():
+        st.rerun()
     
-    # 対話履歴の表示
-    for message in st.session_state.messages:
+    session = current_session()
+    for message in session.messages[rendered_count:]:
         with st.chat_message(message["role"]):
             st.write(message["content"])
     
@@ -493,38 +2818,40 @@ elif st.session_state.survey_started and not st.session_state.survey_completed:
         st.warning("⚠️ AIとの対話が一時的にご利用いただけない状況です")
         st.markdown("""
         ### 📝 自由記述での回答をお願いします
-        
+    
         もしよろしければ、以下の欄に**バスの所要時間のバラツキ**について、
         ご自由にお書きください。どのような内容でも構いません。
-        
+    
         **例：**
         - 同じ区間でも日によって何分くらい時間が違うか
         - 10回乗ったら何回くらい遅れるか、許容できるか
         - 所要時間が読めないことで困っていること
         - バスの定時性について感じていること
         """)
-        
+    
         free_text = st.text_area(
             "ご意見・ご感想（自由記述）",
             height=200,
             placeholder="例：朝のバスは10回中3回くらい遅れます。普段は25分くらいですが、遅い日は35分かかります。90%くらいの確率で時間通りなら満足ですが、今は70%くらいしか定時に来ないので困っています。",
             key="free_text_fallback"
         )
-        
+    
         if st.button("自由記述を送信", type="primary", key="submit_free_text"):
             if free_text:
                 # 自由記述をメッセージとして追加
-                st.session_state.messages.append({
+                session.messages.append({
                     "role": "user",
                     "content": f"[自由記述] {free_text}"
                 })
-                st.session_state.messages.append({
+                session.messages.append({
                     "role": "assistant",
                     "content": "ご意見いただきありがとうございました。"
                 })
                 st.session_state.error_fallback_shown = False
+                if not persist_session():
+                    st.rerun()
                 st.success("✅ ご回答ありがとうございました！")
-                st.rerun()
+                st.rerun(scope="fragment")
             else:
                 st.warning("回答を入力してください")
     
@@ -533,15 +2860,26 @@ elif st.session_state.survey_started and not st.session_state.survey_completed:
     
     if user_input:
         # ユーザーメッセージを追加
-        st.session_state.messages.append({
+        session.messages.append({
             "role": "user",
             "content": user_input
         })
-        
-        # Gemini応答を取得
-        with st.spinner("考え中..."):
-            assistant_response = get_gemini_response(user_input)
-        
+    
+        with st.chat_message("user"):
+            st.write(user_input)
+    
+        # Gemini応答を取得（ストリーミング時は受信しながら表示、調査項目の確認状況を添えて送る）
+        with st.chat_message("assistant"):
+            placeholder = st.empty()
+            if GEMINI_STREAMING:
+                placeholder.markdown("考え中...")
+                assistant_response = get_gemini_response(user_input, placeholder, checklist=slot_checklist())
+            else:
+                with st.spinner("考え中..."):
+                    assistant_response = get_gemini_response(user_input, checklist=slot_checklist())
+            # エラー時の案内文なども含め、最終的な応答で表示を確定させる
+            placeholder.write(assistant_response)
+    
         # エラーが発生したかチェック
         error_keywords = [
             "申し訳ございません",
@@ -552,49 +2890,267 @@ elif st.session_state.survey_started and not st.session_state.survey_completed:
             "quota",
             "429"
         ]
-        
+    
         is_error = any(keyword in assistant_response for keyword in error_keywords)
-        
-        # アシスタントメッセージを追加
-        st.session_state.messages.append({
+    
+        # アシスタントメッセージを追加（表示は済んでいるので再実行しない）
+        session.messages.append({
             "role": "assistant",
             "content": assistant_response
         })
-        
-        # エラーの場合、自由記述欄フラグを立てる
+    
+        # エラーの場合、自由記述欄フラグを立てて自由記述欄を表示
         if is_error:
             st.session_state.error_fallback_shown = True
+        else:
+            # 古いターンを要約してコンテキストを一定の長さに保つ（表示・保存用の履歴はそのまま）
+            session.chat = compact_chat_history(session.chat, session.usage)
+            # 回答がたまったら調査項目を抽出（次のターンまでにバックグラウンドで済ませる）
+            tracker = get_slot_tracker()
+            if tracker is not None:
+                tracker.submit(session.messages)
         
-        st.rerun()
+        # このターンまでの履歴と状態を保存先に書き込む（別のレプリカ・再起動後でも続きから再開できる）
+        if not persist_session():
+            st.rerun()
+        if len(session.messages) - rendered_count >= CHAT_FRAGMENT_MAX_MESSAGES:
+            st.rerun()
+        if is_error:
+            st.rerun(scope="fragment")
     
     # 調査終了ボタン
     st.markdown("---")
+    tracker = get_slot_tracker()
     col1, col2 = st.columns([3, 1])
+    with col1:
+        if tracker is not None and tracker.extracted and not tracker.missing():
+            st.caption("お伺いしたい内容はすべてお聞きできました。よろしければ「調査を終了」を押してください。")
     with col2:
         if st.button("調査を終了", type="primary"):
-            # Google Sheetsに保存
+            # 保存キューに書き込む（Google Sheetsへはバックグラウンドで送信）
             with st.spinner("データを保存中..."):
-                success, error = save_to_google_sheets(st.session_state.spreadsheet)
+                # 最後のターンの項目抽出を待ってから要約行を作る
+                if tracker is not None:
+                    tracker.submit(session.messages, force=True)
+                    tracker.wait(SLOT_FINAL_WAIT)
+                    # 間に合わなければ要約行の slot_* 列は途中までの抽出結果になる（集計ページで件数を表示）
+                    if tracker.busy():
+                        get_metrics().count("slot_incomplete")
+                success, error = enqueue_session()
                 if success:
                     st.session_state.survey_completed = True
+                    # 回答は保存キューにあるので、対話の状態はメモリから外す
+                    end_live_session()
+                    # 完了ページへはスクリプト全体を再実行して切り替える
                     st.rerun()
                 else:
                     st.error(f"保存に失敗しました: {error}")
 
-# 調査完了
-else:
-    st.success("✅ ご協力ありがとうございました！")
-    st.markdown("""
-    ### 調査完了
+def main():
+    """メインUI"""
+    global GEMINI_API_KEY
     
-    お忙しい中、貴重なご意見をいただきありがとうございました。  
-    いただいた情報は、バス交通の改善に向けた研究に活用させていただきます。
+    # 計測値の公開（プロセスで1回のみ）
+    if METRICS_PORT:
+        _metrics_server()
     
-    """)
+    # 管理者ページ（?admin=1）
+    if st.query_params.get("admin"):
+        render_admin_page()
+        st.stop()
+    
+    # 集計ページ（?dashboard=1）
+    if st.query_params.get("dashboard"):
+        render_dashboard_page()
+        st.stop()
+    
+    st.title("バス利用に関するヒアリング調査")
+    
+    # 再開用のクッキーがあれば、保存先から続きを再開（別のレプリカ・再起動後でも）
+    resume_session()
+    
+    # SDKの読み込みを先に始め、基本情報フォームはその完了を待たずに表示する
+    _preload_sdks()
+
+    # Google Sheets接続（プロセス内で共有、初回のみネットワーク接続）
+    # 基本情報フォームの表示では接続を待たず、接続済みの結果だけを確認する（接続はウォームアップで行う）
+    # 対話中の回答者は保存キューに書き込むので、接続が切れていても止めずに続けてもらう
+    error = last_spreadsheet_error()
+    if error and GEMINI_CASSETTE_MODE == "replay":
+        # 再生時はSheetsなしでも進める（回答は保存キューに残り、接続できたときに送られる）
+        st.caption(f"再生モード：Google Sheetsに接続していません（{error}）。回答は保存キューに残ります。")
+    elif error and st.session_state.survey_started:
+        st.caption("保存先に一時的に接続できません。回答はこのまま続けていただけます（接続が戻り次第保存されます）。")
+    elif error:
+        st.error(f"⚠️ Google Sheets接続エラー: {error}")
+        st.info("""
+        **セットアップが必要です：**
+        1. Google Cloud Platformでサービスアカウントを作成
+        2. Streamlit SecretsにJSON認証情報を設定
+        3. スプレッドシートをサービスアカウントと共有
+    
+        詳細は SETUP_SHEETS.md を参照してください。
+        """)
+        st.stop()
+
+    # 保存キューの送信スレッドを開始（プロセスで1回のみ、前回の未送信分もここから送られる）
+    _outbox_flusher()
+    # アイドルセッションの退避スレッドを開始（プロセスで1回のみ）
+    _session_sweeper()
+
+    # APIキーの確認
+    if not GEMINI_API_KEY:
+        st.warning("⚠️ APIキーが設定されていません")
+        st.info("👉 Google AI StudioでAPIキーを取得: https://makersuite.google.com/app/apikey")
+        api_key_input = st.text_input("Gemini APIキーを入力してください：", type="password")
+        if api_key_input:
+            GEMINI_API_KEY = api_key_input
+            genai.configure(api_key=GEMINI_API_KEY)
+            st.success("✅ APIキーが設定されました！")
+            st.rerun()
+        st.stop()
+
+    # 接続のウォームアップ（最初の回答者が挨拶を待たずに済むように）
+    if SURVEY_WARMUP:
+        _warm_up_connections()
+
+    # 調査開始前の基本情報入力
+    if not st.session_state.survey_started:
+        # トークン使用量が上限に近いときは新しい調査を受け付けない（対話中の回答者はそのまま続けられる）
+        if not get_token_budget().accepting_new_sessions():
+            st.info("本日の受付は終了しました。お手数ですが、明日以降に改めてご協力いただけますと幸いです。")
+            st.stop()
+        
+        st.markdown("""
+        ### ご協力のお願い
     
-    if st.button("新しい調査を開始"):
-        # セッションをリセット
-        for key in list(st.session_state.keys()):
-            if key not in ["spreadsheet", "sheets_client"]:  # Google Sheets接続は保持
+        バスの利便性評価に関する研究を行っております。
+        AIとの対話形式で、バス利用に関するあなたの率直なご意見をお聞かせください。
+    
+        **所要時間**：約5〜10分  
+        **データの取り扱い**：回答は匿名で処理され、研究目的のみに使用されます。  
+        **使用AI**：Gemini 2.5 Flash-Lite
+        """)
+    
+        with st.form("user_info_form"):
+            st.subheader("基本情報")
+        
+            age_group = st.selectbox(
+                "年齢層",
+                ["選択してください"] + AGE_GROUPS
+            )
+        
+            usage_frequency = st.selectbox(
+                "バスの利用頻度",
+                ["選択してください"] + USAGE_FREQUENCIES
+            )
+        
+            st.markdown("---")
+            st.markdown("### お住まいの地域（任意）")
+            st.caption("より地域に即した改善提案のため、差し支えなければご記入ください。")
+        
+            location_input = st.text_input(
+                "お住まいの場所",
+                placeholder="例：郵便番号（920-1192）、町名（角間町）、目印（金沢大学の近く）など",
+                help="郵便番号、町字、近くの目印（駅名・大学名・商業施設など）のいずれかで構いません。入力は任意です。"
+            )
+        
+            submitted = st.form_submit_button("調査を開始する")
+        
+            if submitted:
+                if age_group == "選択してください" or usage_frequency == "選択してください":
+                    st.error("年齢層とバス利用頻度を選択してください。")
+                else:
+                    st.session_state.user_info = {
+                        "age_group": age_group,
+                        "usage_frequency": usage_frequency,
+                        "location": location_input if location_input else "未記入",
+                        **normalize_location(location_input),
+                    }
+                    st.session_state.survey_started = True
+                
+                    # 初回メッセージ
+                    initial_context = build_initial_context(age_group, usage_frequency, location_input)
+                    cached_greeting = None if location_input else get_cached_greeting(age_group, usage_frequency)
+                
+                    if cached_greeting:
+                        # 事前生成した挨拶を、Geminiが応答したものとして履歴に入れる
+                        session = current_session()
+                        session.chat = initialize_chat(history=[
+                            {"role": "user", "parts": [initial_context]},
+                            {"role": "model", "parts": [cached_greeting]},
+                        ])
+                        initial_message = cached_greeting
+                    else:
+                        # チャットセッションを初期化
+                        session = current_session()
+                        session.chat = initialize_chat()
+                        initial_message = get_gemini_response(initial_context)
+                
+                    # 初回メッセージでもエラーチェック
+                    error_keywords = [
+                        "申し訳ございません",
+                        "申し訳ありません", 
+                        "エラー",
+                        "応答できない",
+                        "利用いただけない",
+                        "quota",
+                        "429"
+                    ]
+                    is_error = any(keyword in initial_message for keyword in error_keywords)
+                
+                    if is_error:
+                        st.session_state.error_fallback_shown = True
+                    elif not location_input and not cached_greeting:
+                        # ライブで生成した挨拶はキャッシュの候補として保存
+                        store_greeting(age_group, usage_frequency, initial_message)
+                
+                    session.messages.append({
+                        "role": "assistant",
+                        "content": initial_message
+                    })
+                    persist_session()
+                    st.rerun()
+
+    # 調査中の対話
+    elif st.session_state.survey_started and not st.session_state.survey_completed:
+        if session_taken_over():
+            st.warning("この調査は別の画面で再開されました。続きはその画面でご回答ください。")
+            st.stop()
+        # このブラウザで再読み込み・再接続したときに続きから再開できるよう、再開用のクッキーを設定
+        set_resume_cookie()
+        st.markdown("---")
+    
+        # これまでの対話履歴（スクリプト全体の実行時のみ描画、メモリから外れていれば保存先から復元される）
+        session = current_session()
+        for message in session.messages:
+            with st.chat_message(message["role"]):
+                st.write(message["content"])
+    
+        # 入力欄・終了ボタンはフラグメント内で処理し、やり取りのたびにスクリプト全体を再実行しない
+        render_chat_pane(len(session.messages))
+
+    # 調査完了
+    else:
+        clear_resume_cookie()
+        st.success("✅ ご協力ありがとうございました！")
+        st.markdown("""
+        ### 調査完了
+    
+        お忙しい中、貴重なご意見をいただきありがとうございました。  
+        いただいた情報は、バス交通の改善に向けた研究に活用させていただきます。
+    
+        """)
+    
+        if st.button("新しい調査を開始"):
+            # セッションをリセット
+            # （Google Sheets接続はプロセス全体で共有しているので保持される）
+            for key in list(st.session_state.keys()):
                 del st.session_state[key]
-        st.rerun()
+            st.rerun()
+
+try:
+    main()
+finally:
+    # st.rerun()・st.stop()で抜けた場合も含めてスクリプト1回分の実行時間を記録
+    get_metrics().observe("script_run", time.perf_counter() - _script_started)
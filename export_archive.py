@@ -0,0 +1,140 @@
+"""Google Sheetsの調査データをローカルのParquetアーカイブに差分エクスポートする
+
+ワークシート（分割している場合は各シャード）ごとに前回までにエクスポートした行番号を
+記録しておき、それより後の行だけを範囲指定でまとめて読んでアーカイブに追加する。
+アーカイブは シート名/date=YYYY-MM-DD/ に分けたParquetファイルで、各ファイル内は
+session_id 順に並べる。2回目以降は新しい行だけを読むので、Sheetsの読み取り回数も増えない。
+
+アーカイブはDuckDBなどから直接参照できる:
+    SELECT * FROM read_parquet('survey_data/archive/details/*/*.parquet',
+                               hive_partitioning = true, union_by_name = true)
+
+使い方:
+    python export_archive.py --credentials service-account.json \
+        --spreadsheet https://docs.google.com/spreadsheets/d/... --archive survey_data/archive
+"""
+import argparse
+import json
+import os
+import shutil
+import time
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+import survey_sheets
+
+STATE_FILE = "export_state.json"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="調査データのローカルアーカイブへの差分エクスポート")
+    survey_sheets.add_connection_arguments(parser)
+    parser.add_argument("--archive", default="survey_data/archive", help="アーカイブのディレクトリ")
+    parser.add_argument("--sheets", nargs="+", default=["summary", "details"],
+                        help="エクスポートするシート（分割時はシャードをすべて読む）")
+    parser.add_argument("--batch-rows", type=int, default=survey_sheets.READ_BATCH_ROWS,
+                        help="1回の読み出しで取得する行数")
+    parser.add_argument("--full", action="store_true",
+                        help="エクスポート済みのファイルと記録した行番号を消して最初から読み直す")
+    return parser.parse_args()
+
+
+def load_state(archive):
+    """ワークシートごとのエクスポート済みの最終行番号"""
+    try:
+        with open(os.path.join(archive, STATE_FILE), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(archive, state):
+    """最終行番号を書き込む（途中で止まっても壊れないよう一時ファイルから置き換える）"""
+    path = os.path.join(archive, STATE_FILE)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def to_table(header, rows):
+    """行を文字列列のArrowテーブルにし、タイムスタンプから日付の列を加える（session_id順）"""
+    columns = {name: [] for name in header}
+    for _, values in rows:
+        values = values + [""] * (len(header) - len(values))
+        for name, value in zip(header, values):
+            columns[name].append(str(value))
+    columns["date"] = [timestamp[:10] or "unknown" for timestamp in columns.get("timestamp", [""] * len(rows))]
+    table = pa.table({name: pa.array(values, type=pa.string()) for name, values in columns.items()})
+    if "session_id" in header:
+        table = table.sort_by([("date", "ascending"), ("session_id", "ascending")])
+    return table
+
+
+def export_worksheet(worksheet, sheet, archive, start_row, batch_rows):
+    """start_row行目以降をアーカイブに追加し、(追加した行数, 最終行番号) を返す"""
+    header = worksheet.row_values(1)
+    if not header:
+        return 0, start_row - 1
+
+    exported = 0
+    last_row = start_row - 1
+    batch = []
+
+    def flush():
+        # ファイル名に行番号の範囲を入れて、状態の保存前に止まっても再実行で同じファイルを上書きする
+        table = to_table(header, batch)
+        ds.write_dataset(
+            table,
+            os.path.join(archive, sheet),
+            format="parquet",
+            partitioning=ds.partitioning(pa.schema([("date", pa.string())]), flavor="hive"),
+            basename_template=f"{worksheet.title}-{batch[0][0]:08d}-{batch[-1][0]:08d}-{{i}}.parquet",
+            existing_data_behavior="overwrite_or_ignore",
+        )
+
+    rows = survey_sheets.iter_rows(worksheet, start_row, columns=len(header), batch_rows=batch_rows)
+    for row_number, values in rows:
+        last_row = row_number
+        if not any(values):
+            continue
+        batch.append((row_number, values))
+        if len(batch) >= batch_rows:
+            flush()
+            exported += len(batch)
+            batch = []
+    if batch:
+        flush()
+        exported += len(batch)
+    return exported, last_row
+
+
+def main():
+    args = parse_args()
+    os.makedirs(args.archive, exist_ok=True)
+    state = load_state(args.archive)
+    if args.full:
+        # 読み直す行と同じ行のファイルが残っていると重複するので、シートのアーカイブごと消す
+        for sheet in args.sheets:
+            shutil.rmtree(os.path.join(args.archive, sheet), ignore_errors=True)
+            for worksheet_title in [title for title in state if survey_sheets.parse_shard_title(sheet, title)]:
+                del state[worksheet_title]
+        save_state(args.archive, state)
+
+    spreadsheet = survey_sheets.open_spreadsheet(args.credentials, args.spreadsheet)
+    started = time.perf_counter()
+    total = 0
+    for sheet in args.sheets:
+        for worksheet in survey_sheets.list_shards(spreadsheet, sheet):
+            # ヘッダーが1行目なので、初回は2行目から
+            start_row = state.get(worksheet.title, 1) + 1
+            exported, last_row = export_worksheet(worksheet, sheet, args.archive, start_row, args.batch_rows)
+            state[worksheet.title] = last_row
+            save_state(args.archive, state)
+            total += exported
+            print(f"{worksheet.title}: {exported}行を追加（{last_row}行目まで）")
+    print(f"合計 {total}行を {args.archive} に追加しました（{time.perf_counter() - started:.1f}秒）")
+
+
+if __name__ == "__main__":
+    main()
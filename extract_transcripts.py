@@ -0,0 +1,298 @@
+"""保存済みの対話記録から所要時間データを一括抽出する（オフライン処理）
+
+details シート（分割している場合は全シャード）を session_id ごとにまとめて読み、
+SYSTEM_PROMPT の「データとして欲しい情報」の各項目を Gemini で抽出して
+型付きの表（pandas.DataFrame）に出力する。[自由記述] の回答も対象に含める。
+
+抽出結果は対話記録の内容のハッシュでローカルに記録するので、再実行時は
+新しいセッションと内容が変わったセッションだけを抽出する。
+
+使い方:
+    python extract_transcripts.py --credentials service-account.json \
+        --spreadsheet https://docs.google.com/spreadsheets/d/... --output survey_data/extracted.parquet
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+import google.generativeai as genai
+import pandas as pd
+from google.api_core import exceptions as google_exceptions
+
+import survey_sheets
+
+DETAIL_HEADER = [
+    "session_id", "timestamp", "age_group", "usage_frequency",
+    "location", "message_number", "role", "content"
+]
+
+FREE_TEXT_PREFIX = "[自由記述]"
+
+# 抽出する項目と型（SYSTEM_PROMPTの「データとして欲しい情報」）
+FIELDS = {
+    "route_from": ("string", "利用区間の出発地"),
+    "route_to": ("string", "利用区間の目的地"),
+    "usual_time": ("string", "よく利用する時間帯（例：8時頃）"),
+    "morning_minutes": ("Int64", "朝の所要時間（分）"),
+    "noon_minutes": ("Int64", "昼の所要時間（分）"),
+    "evening_minutes": ("Int64", "夕方の所要時間（分）"),
+    "fastest_time": ("string", "最速の時間帯"),
+    "fastest_minutes": ("Int64", "最速の時間帯の所要時間（分）"),
+    "slowest_time": ("string", "最遅の時間帯"),
+    "slowest_minutes": ("Int64", "最遅の時間帯の所要時間（分）"),
+    "max_spread_minutes": ("Int64", "時間帯による差の最大（分）"),
+    "causes": ("string", "変動の要因"),
+    "impact": ("string", "行動への影響・エピソード"),
+}
+
+# セッションの基本情報の型
+SESSION_COLUMNS = {
+    "session_id": "string",
+    "timestamp": "datetime64[ns]",
+    "age_group": "category",
+    "usage_frequency": "category",
+    "location": "string",
+    "message_count": "Int64",
+    "has_free_text": "boolean",
+    "transcript_hash": "string",
+}
+
+# 抽出の指示（変えたら PROMPT_VERSION を上げて既存の記録を使わないようにする）
+PROMPT_VERSION = "1"
+EXTRACTION_PROMPT = """以下はバス利用に関するヒアリング調査の対話記録です。
+回答者の発言から、次の項目を抽出してください。
+「[自由記述]」で始まる発言は、対話の代わりに回答者が自由に書いた回答です。これも同じように扱ってください。
+
+【項目】
+{fields}
+
+分単位の項目は整数（分）にしてください（「30分くらい」→30、「1時間」→60、幅がある場合は中央の値）。
+回答者が述べていない項目は null にしてください。推測は加えないでください。
+項目のキーを使ったJSONオブジェクトだけを出力してください。
+
+【対話記録】
+{transcript}"""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="対話記録から所要時間データを一括抽出")
+    survey_sheets.add_connection_arguments(parser)
+    parser.add_argument("--sheet", default="details", help="対話記録のシート名（分割時はシャードをすべて読む）")
+    parser.add_argument("--output", default="survey_data/extracted.parquet",
+                        help="出力ファイル（.parquet または .csv）")
+    parser.add_argument("--cache", default="survey_data/extractions.sqlite3", help="抽出結果の記録（SQLite）")
+    parser.add_argument("--model", default=os.getenv("GEMINI_MODEL_NAME", "gemini-2.5-flash-lite"))
+    parser.add_argument("--workers", type=int, default=4, help="同時に実行する抽出の数")
+    parser.add_argument("--rpm", type=int, default=int(os.getenv("GEMINI_RPM", "15")), help="1分あたりの最大リクエスト数")
+    parser.add_argument("--max-retries", type=int, default=5, help="429などで失敗したときの再試行回数")
+    parser.add_argument("--limit", type=int, default=0, help="抽出するセッション数の上限（0で無制限）")
+    return parser.parse_args()
+
+
+class RequestLimiter:
+    """1分あたりのリクエスト数を均等な間隔に制限する（複数スレッドで共有）"""
+
+    def __init__(self, rpm):
+        self.interval = 60.0 / rpm if rpm > 0 else 0.0
+        self.lock = threading.Lock()
+        self.next_at = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            at = max(now, self.next_at)
+            self.next_at = at + self.interval
+        time.sleep(max(0.0, at - now))
+
+
+class ExtractionCache:
+    """抽出結果の記録（対話記録のハッシュ → 抽出結果）"""
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS extractions (
+                    transcript_hash TEXT PRIMARY KEY,
+                    session_id TEXT NOT NULL,
+                    result_json TEXT NOT NULL,
+                    created_at TEXT NOT NULL
+                )
+            """)
+
+    def get(self, transcript_hash):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT result_json FROM extractions WHERE transcript_hash = ?", (transcript_hash,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, transcript_hash, session_id, result):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO extractions VALUES (?, ?, ?, ?)",
+                (transcript_hash, session_id, json.dumps(result, ensure_ascii=False),
+                 datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
+            )
+
+
+def iter_sessions(spreadsheet, sheet):
+    """detailsの行をsession_idごとにまとめて返す（最初に現れた順）
+
+    保存キューはまとめて送るため、1セッションの行が他のセッションの行と交互に並んだり、
+    別のシャードに分かれたりすることがある。全シャードを読み終えてからセッションごとに返す。
+    """
+    sessions = {}
+    for worksheet in survey_sheets.list_shards(spreadsheet, sheet):
+        rows = survey_sheets.iter_rows(worksheet, columns=len(DETAIL_HEADER))
+        for _, row in survey_sheets.rows_as_dicts(rows, DETAIL_HEADER):
+            if row["session_id"]:
+                sessions.setdefault(row["session_id"], []).append(row)
+    yield from sessions.values()
+
+
+def format_transcript(rows):
+    """対話記録をプロンプト用の文字列にする（メッセージ番号順）"""
+    rows = sorted(rows, key=lambda row: int(row["message_number"] or 0))
+    return "\n".join(
+        f"{'回答者' if row['role'] == 'user' else '調査員'}：{row['content']}"
+        for row in rows
+    )
+
+
+def transcript_hash(model_name, transcript):
+    payload = json.dumps([PROMPT_VERSION, model_name, transcript], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def extract(model, limiter, transcript, max_retries):
+    """1セッション分の抽出（429・一時的なエラーはジッター付き指数バックオフで再試行）"""
+    prompt = EXTRACTION_PROMPT.format(
+        fields="\n".join(f"- {key}：{description}" for key, (_, description) in FIELDS.items()),
+        transcript=transcript,
+    )
+    for attempt in range(max_retries + 1):
+        limiter.wait()
+        try:
+            response = model.generate_content(prompt)
+            result = json.loads(response.text)
+            return {key: result.get(key) for key in FIELDS} if isinstance(result, dict) else {}
+        except (google_exceptions.ResourceExhausted, google_exceptions.ServiceUnavailable,
+                google_exceptions.DeadlineExceeded, google_exceptions.InternalServerError):
+            if attempt == max_retries:
+                raise
+            time.sleep(min(60.0, 2 ** attempt) * random.uniform(0.5, 1.5))
+
+
+def session_record(rows, digest):
+    """セッションの基本情報（表の行の前半）"""
+    first = rows[0]
+    return {
+        "session_id": first["session_id"],
+        "timestamp": first["timestamp"],
+        "age_group": first["age_group"],
+        "usage_frequency": first["usage_frequency"],
+        "location": first["location"],
+        "message_count": len(rows),
+        "has_free_text": any(row["content"].startswith(FREE_TEXT_PREFIX) for row in rows),
+        "transcript_hash": digest,
+    }
+
+
+def to_int(value):
+    """抽出した分の値を整数にする（数値にできなければ欠損）"""
+    if value is None or isinstance(value, bool):
+        return pd.NA
+    try:
+        return int(round(float(str(value).replace("分", "").strip())))
+    except ValueError:
+        return pd.NA
+
+
+def build_table(records):
+    """抽出結果を型付きのDataFrameにする"""
+    columns = list(SESSION_COLUMNS) + list(FIELDS)
+    frame = pd.DataFrame.from_records(records, columns=columns)
+    for key, (dtype, _) in FIELDS.items():
+        if dtype == "Int64":
+            frame[key] = frame[key].map(to_int)
+    frame["timestamp"] = pd.to_datetime(frame["timestamp"], errors="coerce")
+    dtypes = dict(SESSION_COLUMNS, **{key: dtype for key, (dtype, _) in FIELDS.items()})
+    dtypes.pop("timestamp")
+    return frame.astype(dtypes)
+
+
+def write_table(frame, path):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    if path.endswith(".csv"):
+        frame.to_csv(path, index=False)
+    else:
+        frame.to_parquet(path, index=False)
+
+
+def main():
+    args = parse_args()
+    api_key = os.getenv("GEMINI_API_KEY", "")
+    if not api_key:
+        raise SystemExit("GEMINI_API_KEY を設定してください")
+    genai.configure(api_key=api_key)
+    model = genai.GenerativeModel(
+        model_name=args.model,
+        generation_config={"temperature": 0.0, "response_mime_type": "application/json"},
+    )
+
+    spreadsheet = survey_sheets.open_spreadsheet(args.credentials, args.spreadsheet)
+    cache = ExtractionCache(args.cache)
+    limiter = RequestLimiter(args.rpm)
+
+    records = []
+    reused = extracted = failed = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {}
+        for rows in iter_sessions(spreadsheet, args.sheet):
+            if args.limit and len(records) + len(futures) >= args.limit:
+                break
+            transcript = format_transcript(rows)
+            digest = transcript_hash(args.model, transcript)
+            record = session_record(rows, digest)
+            cached = cache.get(digest)
+            if cached is not None:
+                records.append(dict(record, **cached))
+                reused += 1
+                continue
+            future = executor.submit(extract, model, limiter, transcript, args.max_retries)
+            futures[future] = record
+
+        for future in as_completed(futures):
+            record = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"抽出に失敗しました（{record['session_id']}）: {e}")
+                records.append(record)
+                continue
+            cache.put(record["transcript_hash"], record["session_id"], result)
+            records.append(dict(record, **result))
+            extracted += 1
+
+    frame = build_table(records).sort_values("timestamp", ignore_index=True)
+    write_table(frame, args.output)
+    print(f"{len(frame)}セッション（新たに抽出 {extracted}、記録を再利用 {reused}、失敗 {failed}）を {args.output} に出力しました")
+
+
+if __name__ == "__main__":
+    main()
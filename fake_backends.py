@@ -0,0 +1,402 @@
+"""GeminiとGoogle Sheetsのローカル代替実装（負荷試験・オフライン実行用）
+
+google.generativeai の GenerativeModel / ChatSession と、gspread のクライアント・
+スプレッドシート・ワークシートのうち、アプリが使う部分だけを真似る。
+応答の遅延や429エラーを設定で注入できる。
+"""
+import contextlib
+import itertools
+import json
+import random
+import threading
+import time
+from dataclasses import dataclass
+from unittest import mock
+
+import gspread
+from google.api_core import exceptions as google_exceptions
+
+
+@dataclass
+class FakeConfig:
+    """代替実装の遅延・エラー注入の設定"""
+    gemini_ttfb: float = 0.8           # 最初のチャンクまでの秒数
+    gemini_chunk_delay: float = 0.05   # ストリーミング時のチャンク間隔
+    gemini_chunks: int = 8             # 1応答あたりのチャンク数
+    gemini_error_rate: float = 0.0     # 429を返す確率
+    sheets_latency: float = 0.3        # Sheets APIの1リクエストあたりの秒数
+
+
+class FakeStats:
+    """代替実装が受けた呼び出し回数"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def add(self, name, n=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts)
+
+
+FAKE_CONFIG = FakeConfig()
+FAKE_STATS = FakeStats()
+
+FAKE_REPLIES = [
+    "こんにちは、本日はお忙しい中ありがとうございます。普段、どちらからどちらまでバスを利用されていますか？",
+    "ありがとうございます。何時頃に乗ることが多いですか？",
+    "朝（7-9時頃）だと、何分くらいかかりますか？",
+    "昼間（10-15時頃）だと、何分くらいですか？",
+    "夕方（17-19時頃）は、どうですか？",
+    "一番時間がかかるのは何時頃で、何分かかりますか？",
+    "所要時間が変わる主な理由は何だと思いますか？",
+    "出発時刻を選べるとき、何時頃を選びますか？それはなぜですか？",
+]
+
+# JSON出力を求められたとき（調査項目の抽出）に、対話に含まれる語から返す項目
+FAKE_SLOT_ANSWERS = {
+    "駅から": ("route", "駅→大学"),
+    "8時頃が": ("usual_time", "8時頃"),
+    "朝は": ("morning_minutes", "30分"),
+    "昼間は": ("noon_minutes", "20分"),
+    "夕方は": ("evening_minutes", "35分"),
+    "渋滞": ("causes", "渋滞"),
+    "早めに": ("impact", "早めに出る"),
+}
+
+
+# ---- Gemini ----
+
+class FakePart:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeContent:
+    def __init__(self, role, parts):
+        self.role = role
+        self.parts = parts
+
+
+def to_content(value, default_role="user"):
+    """文字列・辞書・Content風オブジェクトをFakeContentに変換"""
+    if isinstance(value, str):
+        return FakeContent(default_role, [FakePart(value)])
+    if isinstance(value, dict):
+        parts = [FakePart(p if isinstance(p, str) else getattr(p, "text", "")) for p in value.get("parts", [])]
+        return FakeContent(value.get("role", default_role), parts)
+    parts = [FakePart(getattr(p, "text", "")) for p in value.parts]
+    return FakeContent(getattr(value, "role", default_role) or default_role, parts)
+
+
+def content_text(content):
+    return "".join(part.text for part in content.parts)
+
+
+class FakeUsage:
+    def __init__(self, prompt_token_count, candidates_token_count, cached_content_token_count=0):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+        self.cached_content_token_count = cached_content_token_count
+        self.total_token_count = prompt_token_count + candidates_token_count
+
+
+class FakeCandidate:
+    def __init__(self, text, finish_reason):
+        self.content = FakeContent("model", [FakePart(text)] if text else [])
+        self.finish_reason = finish_reason
+
+
+class FakeResponse:
+    """GenerateContentResponseの代替（ストリーミング時は反復でチャンクを返す）"""
+
+    def __init__(self, text, finish_reason=1, usage=None, chunks=None, chunk_delay=0.0):
+        self.text_value = text
+        self.candidates = [FakeCandidate(text, finish_reason)]
+        self.usage_metadata = usage
+        self._chunks = chunks
+        self._chunk_delay = chunk_delay
+
+    @property
+    def parts(self):
+        return self.candidates[0].content.parts
+
+    @property
+    def text(self):
+        if not self.parts:
+            raise ValueError("The `response.text` quick accessor requires the response to contain a valid `Part`")
+        return self.text_value
+
+    def __iter__(self):
+        if self._chunks is None:
+            yield self
+            return
+        for i, chunk in enumerate(self._chunks):
+            if i:
+                time.sleep(self._chunk_delay)
+            yield FakeResponse(chunk, self.candidates[0].finish_reason, self.usage_metadata)
+
+    def resolve(self):
+        for _ in self:
+            pass
+
+
+def _split_chunks(text, n):
+    size = max(1, -(-len(text) // max(1, n)))
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+class FakeGenerativeModel:
+    """GenerativeModelの代替"""
+
+    _replies = itertools.count()
+
+    def __init__(self, model_name="gemini-2.5-flash-lite", generation_config=None,
+                 safety_settings=None, system_instruction=None, **kwargs):
+        self.model_name = model_name
+        self._generation_config = generation_config or {}
+        self._system_instruction = system_instruction or ""
+        self._client = None
+
+    @classmethod
+    def from_cached_content(cls, cached_content, generation_config=None, safety_settings=None):
+        return cls(generation_config=generation_config, safety_settings=safety_settings)
+
+    def _reply(self, contents, stream):
+        FAKE_STATS.add("gemini_requests")
+        time.sleep(FAKE_CONFIG.gemini_ttfb)
+        if random.random() < FAKE_CONFIG.gemini_error_rate:
+            FAKE_STATS.add("gemini_429")
+            raise google_exceptions.ResourceExhausted("429 Resource has been exhausted (e.g. check quota).")
+
+        text = FAKE_REPLIES[next(self._replies) % len(FAKE_REPLIES)]
+        prompt_tokens = len(self._system_instruction) + sum(len(content_text(c)) for c in contents)
+        usage = FakeUsage(prompt_tokens, len(text))
+        if stream:
+            return FakeResponse(text, usage=usage, chunks=_split_chunks(text, FAKE_CONFIG.gemini_chunks),
+                                chunk_delay=FAKE_CONFIG.gemini_chunk_delay)
+        time.sleep(FAKE_CONFIG.gemini_chunk_delay * max(0, FAKE_CONFIG.gemini_chunks - 1))
+        return FakeResponse(text, usage=usage)
+
+    def generate_content(self, contents, stream=False, generation_config=None, **kwargs):
+        if not isinstance(contents, list):
+            contents = [contents]
+        contents = [to_content(c) for c in contents]
+        config = dict(self._generation_config, **(generation_config or {}))
+        if config.get("response_mime_type") == "application/json":
+            return self._json_reply(contents)
+        return self._reply(contents, stream)
+
+    def _json_reply(self, contents):
+        FAKE_STATS.add("gemini_requests")
+        FAKE_STATS.add("gemini_json_requests")
+        time.sleep(FAKE_CONFIG.gemini_ttfb)
+        prompt = "".join(content_text(c) for c in contents)
+        found = dict(slot for word, slot in FAKE_SLOT_ANSWERS.items() if word in prompt)
+        text = json.dumps(found, ensure_ascii=False)
+        return FakeResponse(text, usage=FakeUsage(len(prompt), len(text)))
+
+    def count_tokens(self, contents, **kwargs):
+        return {"total_tokens": len(str(contents))}
+
+    def start_chat(self, history=None, **kwargs):
+        return FakeChatSession(self, history or [])
+
+
+class FakeChatSession:
+    """ChatSessionの代替（成功したやり取りだけを履歴に追加する）"""
+
+    def __init__(self, model, history):
+        self.model = model
+        self.history = [to_content(c) for c in history]
+
+    def send_message(self, content, stream=False, **kwargs):
+        sent = to_content(content)
+        response = self.model._reply(self.history + [sent], stream)
+        self.history.extend([sent, FakeContent("model", [FakePart(response.text_value)])])
+        return response
+
+
+class FakeGenerativeServiceClient:
+    def __init__(self, *args, **kwargs):
+        pass
+
+
+# ---- Google Sheets ----
+
+class FakeCredentials:
+    token = None
+    valid = True
+
+    def refresh(self, request):
+        pass
+
+
+class FakeWorksheet:
+    def __init__(self, title, rows=1000, cols=26):
+        self.title = title
+        self.row_count = int(rows)
+        self.col_count = int(cols)
+        self.rows = []
+        self.lock = threading.Lock()
+
+    def _request(self, name):
+        FAKE_STATS.add("sheets_requests")
+        FAKE_STATS.add(f"sheets_{name}")
+        time.sleep(FAKE_CONFIG.sheets_latency)
+
+    def append_row(self, values, **kwargs):
+        self.append_rows([values], **kwargs)
+
+    def append_rows(self, values, **kwargs):
+        self._request("append")
+        with self.lock:
+            self.rows.extend(list(row) for row in values)
+            self.row_count = max(self.row_count, len(self.rows))
+
+    def row_values(self, row):
+        self._request("read")
+        with self.lock:
+            return list(self.rows[row - 1]) if row <= len(self.rows) else []
+
+    def col_values(self, col):
+        self._request("read")
+        with self.lock:
+            return [row[col - 1] if col <= len(row) else "" for row in self.rows]
+
+    def get(self, range_name=None, **kwargs):
+        """A1表記の範囲（例：A2:H5001）の行を返す（列の範囲は無視する）"""
+        self._request("read")
+        first, _, last = (range_name or "A1").partition(":")
+        start = int("".join(ch for ch in first if ch.isdigit()) or 1)
+        end = int("".join(ch for ch in last if ch.isdigit()) or len(self.rows))
+        with self.lock:
+            return [list(row) for row in self.rows[start - 1:end]]
+
+    def get_all_values(self, **kwargs):
+        self._request("read")
+        with self.lock:
+            return [list(row) for row in self.rows]
+
+    def add_cols(self, cols):
+        self._request("update")
+        self.col_count += int(cols)
+
+    def resize(self, rows=None, cols=None):
+        self._request("update")
+        if rows is not None:
+            self.row_count = int(rows)
+        if cols is not None:
+            self.col_count = int(cols)
+
+    def update_title(self, title):
+        self._request("update")
+        self.title = title
+
+    def update(self, values=None, range_name=None, **kwargs):
+        self._request("update")
+        start = int("".join(ch for ch in (range_name or "A1") if ch.isdigit()) or 1)
+        with self.lock:
+            while len(self.rows) < start - 1 + len(values):
+                self.rows.append([])
+            for i, row in enumerate(values):
+                self.rows[start - 1 + i] = list(row)
+
+
+class FakeSpreadsheet:
+    def __init__(self, spreadsheet_id="fake-spreadsheet", title="fake"):
+        self.id = spreadsheet_id
+        self.title = title
+        self.url = f"https://docs.google.com/spreadsheets/d/{spreadsheet_id}"
+        self.worksheets_by_title = {}
+        self.shared_with = []
+        self.lock = threading.Lock()
+
+    @property
+    def sheet1(self):
+        with self.lock:
+            return next(iter(self.worksheets_by_title.values()))
+
+    def worksheet(self, title):
+        FAKE_STATS.add("sheets_requests")
+        time.sleep(FAKE_CONFIG.sheets_latency)
+        with self.lock:
+            # update_title で名前が変わったシートも見つける
+            for worksheet in self.worksheets_by_title.values():
+                if worksheet.title == title:
+                    return worksheet
+            raise gspread.exceptions.WorksheetNotFound(title)
+
+    def worksheets(self):
+        FAKE_STATS.add("sheets_requests")
+        with self.lock:
+            return list(self.worksheets_by_title.values())
+
+    def add_worksheet(self, title, rows, cols, **kwargs):
+        FAKE_STATS.add("sheets_requests")
+        time.sleep(FAKE_CONFIG.sheets_latency)
+        with self.lock:
+            worksheet = FakeWorksheet(title, rows, cols)
+            self.worksheets_by_title[title] = worksheet
+            return worksheet
+
+    def share(self, email_address, perm_type, role, **kwargs):
+        FAKE_STATS.add("sheets_requests")
+        self.shared_with.append((email_address, role))
+
+
+class FakeSheetsClient:
+    """メインのスプレッドシートと、create で作ったスプレッドシート（シャードのファイル）を持つ"""
+
+    _created = itertools.count(1)
+
+    def __init__(self, spreadsheet):
+        self.spreadsheet = spreadsheet
+
+    def open_by_url(self, url):
+        FAKE_STATS.add("sheets_requests")
+        time.sleep(FAKE_CONFIG.sheets_latency)
+        return self.spreadsheet
+
+    def open_by_key(self, key):
+        FAKE_STATS.add("sheets_requests")
+        time.sleep(FAKE_CONFIG.sheets_latency)
+        with FAKE_FILES_LOCK:
+            return FAKE_FILES.get(key, self.spreadsheet)
+
+    def create(self, title, folder_id=None):
+        FAKE_STATS.add("sheets_requests")
+        FAKE_STATS.add("sheets_create")
+        time.sleep(FAKE_CONFIG.sheets_latency)
+        spreadsheet = FakeSpreadsheet(f"fake-shard-{next(self._created)}", title)
+        spreadsheet.worksheets_by_title["Sheet1"] = FakeWorksheet("Sheet1")
+        with FAKE_FILES_LOCK:
+            FAKE_FILES[spreadsheet.id] = spreadsheet
+        return spreadsheet
+
+
+FAKE_SPREADSHEET = FakeSpreadsheet()
+FAKE_FILES = {}
+FAKE_FILES_LOCK = threading.Lock()
+
+
+@contextlib.contextmanager
+def install_fakes():
+    """Gemini・Google Sheetsの呼び出しを代替実装に差し替える"""
+    import google.ai.generativelanguage as glm
+    import google.generativeai as genai
+    from google.oauth2.service_account import Credentials
+
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(mock.patch.object(genai, "GenerativeModel", FakeGenerativeModel))
+        stack.enter_context(mock.patch.object(genai, "configure", lambda **kwargs: None))
+        stack.enter_context(mock.patch.object(glm, "GenerativeServiceClient", FakeGenerativeServiceClient))
+        stack.enter_context(mock.patch.object(gspread, "authorize", lambda credentials: FakeSheetsClient(FAKE_SPREADSHEET)))
+        stack.enter_context(mock.patch.object(
+            Credentials, "from_service_account_info", lambda info, scopes=None: FakeCredentials()
+        ))
+        yield
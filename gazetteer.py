@@ -0,0 +1,338 @@
+"""オフラインの地名辞書：自由記述の「お住まいの場所」を地域コードと座標に正規化する
+
+郵便番号・町字の表と目印（駅・大学・商業施設など）の一覧から索引ファイルを作り、
+アプリや一括処理からはメモリマップで読み込んで引く（外部APIには問い合わせない）。
+完全一致・前方一致（「金沢駅前」→「金沢駅」、「920-11」→ 郵便番号の前方一致）・
+あいまい一致（表記ゆれ）の順に探す。
+
+入力の表（UTF-8のCSV、1行目は列名）:
+    町字:   postal_code,area_code,prefecture,city,town,latitude,longitude,town_kana（town_kanaは省略可）
+    目印:   name,area_code,latitude,longitude,aliases（aliasesは「|」区切り、省略可）
+
+使い方:
+    python gazetteer.py build --towns towns.csv --landmarks landmarks.csv --output survey_data/gazetteer.idx
+    python gazetteer.py lookup "920-1192" "角間町" "金沢大学の近く"
+    python gazetteer.py normalise --credentials service-account.json --spreadsheet ... --output locations.csv
+"""
+import argparse
+import bisect
+import csv
+import difflib
+import mmap
+import os
+import re
+import struct
+import sys
+import unicodedata
+from collections import namedtuple
+
+MAGIC = b"GZT1"
+HEADER = struct.Struct("<4sIII")       # MAGIC, キー数, レコード数, 文字列領域のバイト数
+KEY = struct.Struct("<III")            # キー文字列の位置, 長さ, レコード番号
+RECORD = struct.Struct("<IIIIff")      # 地域コードの位置, 長さ, 名称の位置, 長さ, 緯度, 経度
+
+# 目印の後ろに付きがちな語（「金沢大学の近く」→「金沢大学」）
+NEAR_SUFFIXES = ["の近く", "のそば", "の辺り", "のあたり", "付近", "周辺", "近辺", "辺り", "あたり", "近く", "前"]
+
+# あいまい一致の候補数の上限と、一致とみなす類似度（候補500件で1回数ミリ秒）
+FUZZY_CANDIDATES = 500
+FUZZY_THRESHOLD = 0.65
+
+# 町字の表で、町名を持たない行
+TOWN_PLACEHOLDERS = {"以下に掲載がない場合", ""}
+
+Place = namedtuple("Place", ["area_code", "name", "latitude", "longitude", "matched", "method"])
+
+
+def normalize(text):
+    """表記をそろえる（全角英数→半角、カタカナ→ひらがな、空白・記号・〒の除去、郵便番号のハイフン除去）"""
+    text = unicodedata.normalize("NFKC", text or "").strip()
+    text = "".join(chr(ord(ch) - 0x60) if "ァ" <= ch <= "ヶ" else ch for ch in text)
+    text = text.replace("〒", "")
+    text = re.sub(r"[\s　・,、。]", "", text)
+    if re.fullmatch(r"[0-9\-‐－ー]+", text):
+        return re.sub(r"\D", "", text)
+    return text.lower()
+
+
+def strip_near(text):
+    """「の近く」などの語を取り除いた候補（長い語から順に1つだけ）"""
+    for suffix in NEAR_SUFFIXES:
+        if text.endswith(suffix) and len(text) > len(suffix):
+            return text[:-len(suffix)]
+    return None
+
+
+def _read_rows(path):
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        yield from csv.DictReader(f)
+
+
+def build_index(towns_path, landmarks_path, output_path):
+    """町字の表と目印の一覧から索引ファイルを作る（キーの数・レコードの数を返す）"""
+    strings = bytearray()
+    string_offsets = {}
+
+    def intern(value):
+        data = value.encode("utf-8")
+        if data not in string_offsets:
+            string_offsets[data] = len(strings)
+            strings.extend(data)
+        return string_offsets[data], len(data)
+
+    records = []
+    keys = set()
+
+    def add_record(area_code, name, latitude, longitude, names):
+        number = len(records)
+        records.append((*intern(area_code), *intern(name), float(latitude or 0), float(longitude or 0)))
+        for key in names:
+            key = normalize(key)
+            if key:
+                keys.add((key.encode("utf-8"), number))
+
+    if towns_path:
+        for row in _read_rows(towns_path):
+            town = row["town"] if row["town"] not in TOWN_PLACEHOLDERS else ""
+            name = row["prefecture"] + row["city"] + town
+            names = [row["postal_code"]]
+            if town:
+                names += [town, row["city"] + town, name, row.get("town_kana") or ""]
+            else:
+                names += [row["city"], row["prefecture"] + row["city"]]
+            add_record(row["area_code"], name, row["latitude"], row["longitude"], names)
+
+    if landmarks_path:
+        for row in _read_rows(landmarks_path):
+            aliases = [alias for alias in (row.get("aliases") or "").split("|") if alias]
+            add_record(row["area_code"], row["name"], row["latitude"], row["longitude"], [row["name"]] + aliases)
+
+    sorted_keys = sorted(keys)
+    # 動いているアプリがメモリマップで開いている索引を書き換えないよう、一時ファイルに書いてから置き換える
+    temp_path = output_path + ".tmp"
+    with open(temp_path, "wb") as f:
+        key_entries = [(*intern(key.decode("utf-8")), number) for key, number in sorted_keys]
+        f.write(HEADER.pack(MAGIC, len(key_entries), len(records), len(strings)))
+        for entry in key_entries:
+            f.write(KEY.pack(*entry))
+        for record in records:
+            f.write(RECORD.pack(*record))
+        f.write(strings)
+    os.replace(temp_path, output_path)
+    return len(key_entries), len(records)
+
+
+class Gazetteer:
+    """メモリマップで読み込んだ地名辞書（読み取り専用なので複数スレッドから共有できる）"""
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.key_count, self.record_count, _ = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise ValueError(f"地名辞書の形式が違います: {path}")
+        self.keys_at = HEADER.size
+        self.records_at = self.keys_at + self.key_count * KEY.size
+        self.strings_at = self.records_at + self.record_count * RECORD.size
+        # 二分探索でキーをその場で読むための列（要素アクセスのたびにmmapから取り出す）
+        self.sorted_keys = _KeyView(self)
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def _string(self, offset, length):
+        start = self.strings_at + offset
+        return self.data[start:start + length]
+
+    def _key(self, i):
+        offset, length, number = KEY.unpack_from(self.data, self.keys_at + i * KEY.size)
+        return self._string(offset, length), number
+
+    def _place(self, number, matched, method):
+        code_offset, code_length, name_offset, name_length, latitude, longitude = RECORD.unpack_from(
+            self.data, self.records_at + number * RECORD.size
+        )
+        return Place(
+            self._string(code_offset, code_length).decode("utf-8"),
+            self._string(name_offset, name_length).decode("utf-8"),
+            round(latitude, 6),
+            round(longitude, 6),
+            matched,
+            method,
+        )
+
+    def _prefix_range(self, prefix):
+        data = prefix.encode("utf-8")
+        start = bisect.bisect_left(self.sorted_keys, data)
+        # 前方一致する範囲の終わり（prefixの直後の値の手前）
+        end = bisect.bisect_left(self.sorted_keys, data + b"\xff", lo=start)
+        return start, end
+
+    def exact(self, key):
+        """完全一致するレコード（同じ表記が複数あれば最初のもの）"""
+        data = key.encode("utf-8")
+        i = bisect.bisect_left(self.sorted_keys, data)
+        if i < self.key_count:
+            found, number = self._key(i)
+            if found == data:
+                return number
+        return None
+
+    def lookup(self, text):
+        """自由記述の場所を正規化（見つからなければNone）"""
+        key = normalize(text)
+        if not key:
+            return None
+        candidates = [key]
+        stripped = strip_near(key)
+        if stripped:
+            candidates.append(stripped)
+
+        for candidate in candidates:
+            number = self.exact(candidate)
+            if number is not None:
+                return self._place(number, candidate, "exact")
+
+        # 郵便番号の途中まで（「920-11」など）は、前方一致する最初の地域
+        if key.isdigit():
+            start, end = self._prefix_range(key)
+            if start < end:
+                matched, number = self._key(start)
+                return self._place(number, matched.decode("utf-8"), "postal_prefix")
+            return None
+
+        # 登録された名前で始まる入力（「金沢駅前広場」→「金沢駅」）は、最も長く一致する名前
+        for candidate in candidates:
+            for length in range(len(candidate) - 1, 1, -1):
+                number = self.exact(candidate[:length])
+                if number is not None:
+                    return self._place(number, candidate[:length], "prefix")
+
+        # 登録された名前の途中まで（「金沢大」→「金沢大学」）
+        for candidate in candidates:
+            start, end = self._prefix_range(candidate)
+            if start < end:
+                matched, number = self._key(start)
+                return self._place(number, matched.decode("utf-8"), "completion")
+
+        return self.fuzzy(candidates[-1])
+
+    def fuzzy(self, key):
+        """表記ゆれのあいまい一致（先頭の文字が同じ名前の中で最も似ているもの、最大FUZZY_CANDIDATES件）
+
+        入力側の解析は1回だけ行い、類似度の上限（長さ・文字の重なり）が今の最良に
+        届かない候補は ratio() を計算せずに飛ばす。
+        """
+        start, end = self._prefix_range(key[0])
+        # 先頭の文字が同じ名前が多すぎるときは、先頭2文字が同じ名前に絞る
+        if end - start > FUZZY_CANDIDATES and len(key) > 1:
+            start, end = self._prefix_range(key[:2])
+        matcher = difflib.SequenceMatcher(None, b=key)
+        best = None
+        for i in range(start, min(end, start + FUZZY_CANDIDATES)):
+            found, number = self._key(i)
+            matcher.set_seq1(found.decode("utf-8"))
+            floor = FUZZY_THRESHOLD if best is None else best[0]
+            if matcher.real_quick_ratio() < floor or matcher.quick_ratio() < floor:
+                continue
+            ratio = matcher.ratio()
+            if ratio >= FUZZY_THRESHOLD and (best is None or ratio > best[0]):
+                best = (ratio, found, number)
+        if best is None:
+            return None
+        return self._place(best[2], best[1].decode("utf-8"), "fuzzy")
+
+
+class _KeyView:
+    """bisect用に、索引のキー文字列を並びとして見せる"""
+
+    def __init__(self, gazetteer):
+        self.gazetteer = gazetteer
+
+    def __len__(self):
+        return self.gazetteer.key_count
+
+    def __getitem__(self, i):
+        return self.gazetteer._key(i)[0]
+
+
+def normalise_rows(gazetteer, rows):
+    """summaryの行（辞書）に地域コード・座標の列を加える"""
+    for row in rows:
+        location = row.get("location", "")
+        place = gazetteer.lookup(location) if location and location != "未記入" else None
+        yield {
+            "session_id": row.get("session_id", ""),
+            "timestamp": row.get("timestamp", ""),
+            "location": location,
+            "area_code": place.area_code if place else "",
+            "place_name": place.name if place else "",
+            "latitude": place.latitude if place else None,
+            "longitude": place.longitude if place else None,
+            "match": place.method if place else "",
+        }
+
+
+def bulk_normalise(args):
+    """過去のsummary行をまとめて正規化してCSV/Parquetに出力"""
+    import pandas as pd
+    import survey_sheets
+
+    spreadsheet = survey_sheets.open_spreadsheet(args.credentials, args.spreadsheet)
+    gazetteer = Gazetteer(args.index)
+    records = []
+    for worksheet in survey_sheets.list_shards(spreadsheet, args.sheet):
+        header = worksheet.row_values(1)
+        rows = survey_sheets.rows_as_dicts(survey_sheets.iter_rows(worksheet, columns=len(header)), header)
+        records.extend(normalise_rows(gazetteer, (row for _, row in rows)))
+    frame = pd.DataFrame.from_records(records).astype({
+        "session_id": "string", "location": "string", "area_code": "string",
+        "place_name": "string", "latitude": "Float64", "longitude": "Float64", "match": "category",
+    })
+    if args.output.endswith(".csv"):
+        frame.to_csv(args.output, index=False)
+    else:
+        frame.to_parquet(args.output, index=False)
+    matched = (frame["area_code"] != "").sum()
+    print(f"{len(frame)}件中{matched}件の場所を正規化して {args.output} に出力しました")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="オフラインの地名辞書")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    build = commands.add_parser("build", help="索引ファイルを作る")
+    build.add_argument("--towns", help="郵便番号・町字の表（CSV）")
+    build.add_argument("--landmarks", help="目印の一覧（CSV）")
+    build.add_argument("--output", default="survey_data/gazetteer.idx")
+
+    lookup = commands.add_parser("lookup", help="場所を引く")
+    lookup.add_argument("--index", default="survey_data/gazetteer.idx")
+    lookup.add_argument("texts", nargs="+")
+
+    normalise = commands.add_parser("normalise", help="summaryシートの場所をまとめて正規化")
+    normalise.add_argument("--index", default="survey_data/gazetteer.idx")
+    normalise.add_argument("--sheet", default="summary")
+    normalise.add_argument("--output", default="survey_data/locations.parquet", help="出力（.parquet または .csv）")
+    if "normalise" in sys.argv[1:2]:
+        import survey_sheets
+        survey_sheets.add_connection_arguments(normalise)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.command == "build":
+        key_count, record_count = build_index(args.towns, args.landmarks, args.output)
+        print(f"{record_count}件の地名（キー{key_count}個）を {args.output} に書き出しました")
+    elif args.command == "lookup":
+        gazetteer = Gazetteer(args.index)
+        for text in args.texts:
+            print(text, gazetteer.lookup(text), sep="\t")
+    else:
+        bulk_normalise(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
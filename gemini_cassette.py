@@ -0,0 +1,67 @@
+"""Gemini呼び出しの記録・再生（カセット）の保存先
+
+GEMINI_CASSETTE_MODE=record のときは呼び出しをJSON Linesに書き出し、replay のときは
+記録を読み込んでリクエスト内容のハッシュで引く。アプリのモデルのラッパーから使う。
+Streamlitはスクリプトを再実行するたびにアプリのモジュールのクラスを作り直すので、
+再実行をまたいでキャッシュするストアと、呼び出し側で捕まえる例外はこのモジュールに置く。
+"""
+import collections
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime
+
+
+class CassetteMiss(LookupError):
+    """再生時に、リクエストと完全に一致する記録がない"""
+
+
+class CassetteStore:
+    """記録した呼び出しの読み書き（再生時はリクエスト内容のハッシュで引ける索引をメモリに持つ）"""
+
+    def __init__(self, directory, mode):
+        self.directory = directory
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.by_request = collections.defaultdict(collections.deque)
+        self.path = None
+
+        if mode == "record":
+            os.makedirs(directory, exist_ok=True)
+            name = f"cassette-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.jsonl"
+            self.path = os.path.join(directory, name)
+        elif mode == "replay" and os.path.isdir(directory):
+            for name in sorted(os.listdir(directory)):
+                if name.endswith(".jsonl"):
+                    with open(os.path.join(directory, name), encoding="utf-8") as f:
+                        for line in f:
+                            if line.strip():
+                                self._index(json.loads(line))
+
+    @staticmethod
+    def request_key(model_name, contents):
+        payload = json.dumps([model_name, contents], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _index(self, entry):
+        # 同じリクエストが複数あれば記録順に繰り返し使う
+        self.by_request[entry["key"]].append(entry)
+
+    def record(self, entry):
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def lookup(self, key):
+        """リクエスト（モデルと全メッセージ）が完全一致する記録を返す（なければNone）
+
+        最後のメッセージだけで引くと別の対話の記録を返すことがあるので、近い記録では代用しない。
+        """
+        with self.lock:
+            entries = self.by_request.get(key)
+            if not entries:
+                return None
+            entry = entries[0]
+            entries.rotate(-1)
+            return entry
@@ -0,0 +1,260 @@
+"""負荷試験：模擬回答者N人に app_gemini_sheets.py の調査フローを同時に実行させる
+
+基本情報フォーム → 数ターンのチャット → 「調査を終了」までを、Streamlit の
+AppTest で実際のスクリプトごと実行する。Gemini と Google Sheets は
+fake_backends の代替実装（遅延・429を注入可能）に差し替える。
+
+使い方:
+    python load_test.py --users 20 --turns 6 --gemini-ttfb 0.8 --error-rate 0.05
+"""
+import argparse
+import contextlib
+import json
+import os
+import statistics
+import resource
+import tempfile
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import fake_backends
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app_gemini_sheets.py")
+
+SECRETS = {
+    "gcp_service_account": {"type": "service_account"},
+    "spreadsheet_url": "https://docs.google.com/spreadsheets/d/fake",
+}
+
+USER_MESSAGES = [
+    "駅から大学までです。",
+    "朝の8時頃が多いです。",
+    "朝は30分くらいかかります。",
+    "昼間は20分くらいです。",
+    "夕方は35分くらいです。",
+    "渋滞のせいだと思います。",
+    "早めに出るようにしています。",
+    "特にありません。",
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="バス調査アプリの負荷試験")
+    parser.add_argument("--users", type=int, default=10, help="同時に実行する模擬回答者の数")
+    parser.add_argument("--turns", type=int, default=6, help="1人あたりのチャットのターン数")
+    parser.add_argument("--gemini-ttfb", type=float, default=0.8, help="Geminiの最初の応答までの秒数")
+    parser.add_argument("--gemini-chunk-delay", type=float, default=0.05, help="ストリーミングのチャンク間隔（秒）")
+    parser.add_argument("--sheets-latency", type=float, default=0.3, help="Sheets APIの1リクエストあたりの秒数")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Geminiが429を返す確率")
+    parser.add_argument("--rpm", type=int, default=100000, help="アプリのレート制限（GEMINI_RPM）")
+    parser.add_argument("--tpm", type=int, default=100000000, help="アプリのレート制限（GEMINI_TPM）")
+    parser.add_argument("--greeting-variants", type=int, default=0,
+                        help="挨拶キャッシュの候補数（0なら毎回ライブ生成、事前生成の呼び出しを含めないため既定は0）")
+    parser.add_argument("--location", default="", help="基本情報フォームの「お住まいの場所」（空なら未記入）")
+    parser.add_argument("--timeout", type=float, default=300, help="1回のスクリプト実行のタイムアウト（秒）")
+    parser.add_argument("--json", action="store_true", help="結果をJSONで出力")
+    return parser.parse_args()
+
+
+def configure_environment(args, workdir):
+    """アプリが起動時に読む環境変数を設定（最初のAppTest実行より前に呼ぶ）"""
+    os.environ.update({
+        "GEMINI_API_KEY": "fake-key",
+        "GEMINI_RPM": str(args.rpm),
+        "GEMINI_TPM": str(args.tpm),
+        "GEMINI_BACKOFF_BASE": "0.2",
+        "SURVEY_OUTBOX_PATH": os.path.join(workdir, "outbox.sqlite3"),
+        "SURVEY_OUTBOX_FLUSH_INTERVAL": "1",
+        "SURVEY_OUTBOX_COALESCE_SECONDS": "0.5",
+        "GREETING_CACHE_PATH": os.path.join(workdir, "greetings.json"),
+        "SESSION_STORE_PATH": os.path.join(workdir, "sessions.sqlite3"),
+        "GREETING_CACHE_VARIANTS": str(args.greeting_variants),
+    })
+    fake_backends.FAKE_CONFIG.gemini_ttfb = args.gemini_ttfb
+    fake_backends.FAKE_CONFIG.gemini_chunk_delay = args.gemini_chunk_delay
+    fake_backends.FAKE_CONFIG.sheets_latency = args.sheets_latency
+    fake_backends.FAKE_CONFIG.gemini_error_rate = args.error_rate
+
+
+@contextlib.contextmanager
+def concurrent_apptest():
+    """AppTestを複数スレッドで同時に実行できるようにする
+
+    AppTestは実行のたびにRuntime・st.secrets・設定値・スクリプトキャッシュを作り直して
+    元に戻すため、そのまま並行実行すると互いに上書きしてしまう。これらをプロセスで1つに固定する。
+    """
+    import streamlit as st
+    from streamlit import config
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.secrets import Secrets
+    from streamlit.testing.v1 import app_test, local_script_runner
+
+    fallback = mock.MagicMock(spec=Runtime)
+    fallback.media_file_mgr = app_test.MediaFileManager(app_test.MemoryMediaFileStorage("/mock/media"))
+    fallback.dataframe_source_mgr = app_test.DataframeSourceManager()
+    fallback.cache_storage_manager = app_test.MemoryCacheStorageManager()
+
+    # 実際のサーバーと同じく、スクリプトのコンパイル結果を全セッションで共有する
+    script_cache = app_test.ScriptCache()
+
+    secrets = Secrets()
+    secrets._secrets = SECRETS
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(mock.patch.object(app_test, "ScriptCache", lambda: script_cache))
+        stack.enter_context(mock.patch.object(local_script_runner, "ScriptCache", lambda: script_cache))
+        stack.enter_context(mock.patch.object(Runtime, "instance", classmethod(lambda cls: cls._instance or fallback)))
+        stack.enter_context(mock.patch.object(Runtime, "exists", classmethod(lambda cls: True)))
+        stack.enter_context(mock.patch.object(app_test, "patch_config_options", lambda options: contextlib.nullcontext()))
+        stack.enter_context(mock.patch.object(st, "secrets", secrets))
+        config.set_option("global.appTest", True)
+        yield
+
+
+def new_app(timeout):
+    from streamlit.testing.v1 import AppTest
+
+    return AppTest.from_file(APP_PATH, default_timeout=timeout)
+
+
+def find_button(at, label):
+    return next(button for button in at.button if button.label == label)
+
+
+def run_respondent(index, args, results):
+    """模擬回答者1人分の調査フロー（各ステップの所要時間を記録）"""
+    at = new_app(args.timeout)
+    at.run()
+
+    at.selectbox[0].select("20代")
+    at.selectbox[1].select("ほぼ毎日")
+    if args.location:
+        at.text_input[0].input(args.location)
+    started = time.perf_counter()
+    find_button(at, "調査を開始する").click().run()
+    results["greeting"].append(time.perf_counter() - started)
+
+    for turn in range(args.turns):
+        message = USER_MESSAGES[(index + turn) % len(USER_MESSAGES)]
+        if not at.chat_input:
+            raise RuntimeError(f"チャット入力欄が表示されていません（{turn + 1}ターン目）")
+        started = time.perf_counter()
+        at.chat_input[0].set_value(message).run()
+        results["turn"].append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    find_button(at, "調査を終了").click().run()
+    results["save"].append(time.perf_counter() - started)
+
+    completed = any("ありがとうございました" in element.value for element in at.success)
+    results["completed"].append(completed)
+    if at.exception:
+        results["exceptions"].append(str(at.exception[0].value))
+    return at
+
+
+def percentiles(values):
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+    if len(values) == 1:
+        return {"p50": values[0], "p95": values[0], "p99": values[0], "max": values[0]}
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return {"p50": cuts[49], "p95": cuts[94], "p99": cuts[98], "max": max(values)}
+
+
+def current_rss():
+    """プロセスの常駐メモリ（バイト）。/procがなければ最大常駐メモリで代用"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def wait_for_outbox(timeout=60):
+    """バックグラウンド送信で保存キューが空になるまで待つ（空になるまでの秒数）"""
+    import sqlite3
+
+    path = os.environ["SURVEY_OUTBOX_PATH"]
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        conn = sqlite3.connect(path)
+        try:
+            pending = conn.execute("SELECT COUNT(*) FROM outbox WHERE sent_at IS NULL").fetchone()[0]
+        finally:
+            conn.close()
+        if pending == 0:
+            return time.perf_counter() - started
+        time.sleep(0.2)
+    return None
+
+
+def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix="bus-survey-load-")
+    configure_environment(args, workdir)
+
+    results = {"greeting": [], "turn": [], "save": [], "completed": [], "exceptions": []}
+
+    with fake_backends.install_fakes(), concurrent_apptest():
+        # 1回目の実行でモジュールの読み込みとプロセス共有リソースの作成を済ませる
+        warm = new_app(args.timeout)
+        warm.run()
+        del warm
+
+        baseline = current_rss()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.users) as executor:
+            futures = [executor.submit(run_respondent, i, args, results) for i in range(args.users)]
+            apps = []
+            for future in futures:
+                try:
+                    apps.append(future.result())
+                except Exception as e:
+                    results["exceptions"].append(traceback.format_exc(limit=-4))
+        elapsed = time.perf_counter() - started
+        # 全セッションを保持したままの常駐メモリの増分を1人あたりに換算
+        retained = current_rss() - baseline
+
+        drain = wait_for_outbox()
+        del apps
+
+    completed = sum(results["completed"])
+    report = {
+        "users": args.users,
+        "turns_per_user": args.turns,
+        "completed_sessions": completed,
+        "elapsed_seconds": elapsed,
+        "sessions_per_minute": completed / elapsed * 60 if elapsed else None,
+        "turns_per_second": len(results["turn"]) / elapsed if elapsed else None,
+        "greeting_latency": percentiles(results["greeting"]),
+        "turn_latency": percentiles(results["turn"]),
+        "save_latency": percentiles(results["save"]),
+        "memory_per_session_kib": retained / max(1, args.users) / 1024,
+        "outbox_drain_seconds": drain,
+        "backend_calls": fake_backends.FAKE_STATS.snapshot(),
+        "exceptions": results["exceptions"][:10],
+    }
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return
+
+    print(f"模擬回答者: {args.users}人 × {args.turns}ターン（完了 {completed}人）")
+    print(f"経過時間: {elapsed:.1f}秒  スループット: {report['sessions_per_minute']:.1f}セッション/分, "
+          f"{report['turns_per_second']:.2f}ターン/秒")
+    for name in ("greeting_latency", "turn_latency", "save_latency"):
+        p = report[name]
+        if p["p50"] is None:
+            continue
+        print(f"{name}: p50={p['p50']:.3f}s p95={p['p95']:.3f}s p99={p['p99']:.3f}s max={p['max']:.3f}s")
+    print(f"1セッションあたりのメモリ: {report['memory_per_session_kib']:.1f} KiB")
+    print(f"保存キューの送信完了まで: {drain if drain is None else round(drain, 2)}秒")
+    print(f"バックエンド呼び出し: {report['backend_calls']}")
+    for exception in report["exceptions"]:
+        print(f"例外: {exception}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""起動時間の計測：新しいPythonプロセスで app_gemini_sheets.py の最初の画面が出るまでの時間
+
+毎回新しいプロセスを起動し（モジュールのキャッシュがない、スリープ復帰直後と同じ状態）、
+AppTest でスクリプトを1回実行して基本情報フォームが描画されるまでの時間と、
+その後 Gemini・Google Sheets の SDK が使える状態になるまでの時間を計る。
+比較のため、以前のように SDK と pandas を先頭でまとめて import した場合の時間も計る。
+
+使い方:
+    python startup_benchmark.py --repeat 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app_gemini_sheets.py")
+
+# 以前はスクリプトの先頭で読み込んでいたモジュール
+HEAVY_MODULES = [
+    "google.generativeai",
+    "google.ai.generativelanguage",
+    "gspread",
+    "google.oauth2.service_account",
+    "google.auth.transport.requests",
+    "pandas",
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="バス調査アプリの起動時間の計測")
+    parser.add_argument("--repeat", type=int, default=5, help="計測の回数（毎回新しいプロセスで実行）")
+    parser.add_argument("--json", action="store_true", help="結果をJSONで出力")
+    parser.add_argument("--child", choices=["app", "eager"], help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def measure_app():
+    """子プロセス：最初のスクリプト実行で基本情報フォームが出るまでと、SDKの読み込み完了までの秒数"""
+    started = time.perf_counter()
+    from streamlit.testing.v1 import AppTest
+    streamlit_loaded = time.perf_counter() - started
+
+    at = AppTest.from_file(APP_PATH, default_timeout=120)
+    at.secrets["gcp_service_account"] = {"type": "service_account"}
+    at.secrets["spreadsheet_url"] = "https://docs.google.com/spreadsheets/d/benchmark"
+    at.run()
+    first_render = time.perf_counter() - started
+    if at.exception or len(at.selectbox) < 2:
+        raise RuntimeError(f"基本情報フォームが表示されませんでした: {at.exception}")
+
+    # バックグラウンドの先読みが終わるまで待つ（読み込み中のモジュールのimportは完了まで待たされる）
+    for name in HEAVY_MODULES[:-1]:
+        __import__(name)
+    sdk_ready = time.perf_counter() - started
+
+    return {
+        "streamlit_import": streamlit_loaded,
+        "first_render": first_render,
+        "sdk_ready": sdk_ready,
+        "pandas_loaded": "pandas" in sys.modules,
+    }
+
+
+def measure_eager():
+    """子プロセス：重いモジュールを先頭でまとめてimportした場合の秒数"""
+    started = time.perf_counter()
+    for name in HEAVY_MODULES:
+        __import__(name)
+    return {"eager_import": time.perf_counter() - started}
+
+
+def run_child(mode, workdir):
+    env = dict(
+        os.environ,
+        GEMINI_API_KEY="benchmark-key",
+        SURVEY_WARMUP="0",
+        GREETING_CACHE_VARIANTS="0",
+        SURVEY_OUTBOX_PATH=os.path.join(workdir, "outbox.sqlite3"),
+        GREETING_CACHE_PATH=os.path.join(workdir, "greetings.json"),
+        SESSION_STORE_PATH=os.path.join(workdir, "sessions.sqlite3"),
+        PYTHONWARNINGS="ignore",
+    )
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", mode],
+        env=env, capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def summarize(values):
+    return {"median": statistics.median(values), "min": min(values), "max": max(values)}
+
+
+def main():
+    args = parse_args()
+    if args.child:
+        result = measure_app() if args.child == "app" else measure_eager()
+        print(json.dumps(result))
+        return
+
+    workdir = tempfile.mkdtemp(prefix="bus-survey-startup-")
+    samples = {}
+    for _ in range(args.repeat):
+        for mode in ("app", "eager"):
+            for name, value in run_child(mode, workdir).items():
+                samples.setdefault(name, []).append(value)
+
+    report = {name: summarize(values) for name, values in samples.items() if name != "pandas_loaded"}
+    report["pandas_loaded"] = any(samples["pandas_loaded"])
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return
+
+    labels = {
+        "streamlit_import": "streamlitの読み込み",
+        "first_render": "基本情報フォームの表示まで",
+        "sdk_ready": "Gemini・SheetsのSDKの読み込み完了まで",
+        "eager_import": "（参考）SDKとpandasを先頭でimportした場合の読み込み時間",
+    }
+    print(f"新しいプロセスで{args.repeat}回計測（中央値 / 最小 / 最大）")
+    for name, label in labels.items():
+        r = report[name]
+        print(f"{label}: {r['median']:.3f}s / {r['min']:.3f}s / {r['max']:.3f}s")
+    print(f"最初の画面でpandasが読み込まれたか: {report['pandas_loaded']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""コマンドラインツール用のGoogle Sheets読み出し（Streamlitアプリの外から保存済みデータを読む）
+
+app_gemini_sheets.py と同じサービスアカウント・スプレッドシートに接続し、
+summary / details シート（分割している場合は全シャードのファイル）を範囲指定でまとめて読む。
+"""
+import json
+import os
+import re
+
+import gspread
+from google.oauth2.service_account import Credentials
+
+SCOPES = [
+    "https://www.googleapis.com/auth/spreadsheets.readonly",
+]
+
+# アプリが分割時に作るシャードのファイル一覧のシート
+SHARD_FILES_SHEET = "shard_files"
+
+# 1回の読み出しで取得する行数（Sheets APIの読み取り回数を抑えるため大きめにまとめる）
+READ_BATCH_ROWS = 5000
+
+
+def add_connection_arguments(parser):
+    """接続先を指定する共通のコマンドライン引数"""
+    parser.add_argument(
+        "--credentials", default=os.getenv("GOOGLE_APPLICATION_CREDENTIALS", ""),
+        help="サービスアカウントのJSONファイル（既定はGOOGLE_APPLICATION_CREDENTIALS）",
+    )
+    parser.add_argument(
+        "--spreadsheet", default=os.getenv("SURVEY_SPREADSHEET", ""),
+        help="スプレッドシートのURLまたはキー（既定はSURVEY_SPREADSHEET）",
+    )
+
+
+def open_spreadsheet(credentials_path, spreadsheet):
+    """サービスアカウントでスプレッドシートを開く"""
+    if not credentials_path:
+        raise SystemExit("サービスアカウントのJSONファイルを --credentials で指定してください")
+    if not spreadsheet:
+        raise SystemExit("スプレッドシートのURLまたはキーを --spreadsheet で指定してください")
+    with open(credentials_path, encoding="utf-8") as f:
+        credentials = Credentials.from_service_account_info(json.load(f), scopes=SCOPES)
+    client = gspread.authorize(credentials)
+    if spreadsheet.startswith("https://"):
+        return client.open_by_url(spreadsheet)
+    return client.open_by_key(spreadsheet)
+
+
+def parse_shard_title(sheet, title):
+    """シャード名（details, details_001, details_2026-10_002 など）を (期間, 番号) に分解"""
+    match = re.fullmatch(rf"{re.escape(sheet)}(?:_(\d{{4}}-\d{{2}}))?(?:_(\d{{3,}}))?", title)
+    if match is None:
+        return None
+    return match.group(1) or "", int(match.group(2) or 1)
+
+
+def list_shards(spreadsheet, sheet):
+    """シートの全シャードのワークシート（古い順、分割していなければ1枚）
+
+    メインのスプレッドシート内のシートのあとに、shard_files シートに登録された
+    シャードのファイル（別のスプレッドシート）を続ける。
+    """
+    worksheets = spreadsheet.worksheets()
+    shards = sorted(
+        ((parse_shard_title(sheet, worksheet.title), worksheet) for worksheet in worksheets
+         if parse_shard_title(sheet, worksheet.title) is not None),
+        key=lambda item: item[0],
+    )
+    result = [worksheet for _, worksheet in shards]
+
+    directory = next((worksheet for worksheet in worksheets if worksheet.title == SHARD_FILES_SHEET), None)
+    if directory is not None:
+        files = {}
+        for row in directory.get_all_values()[1:]:
+            # 同じシャードが複数登録されていれば、アプリと同じく先に登録されたファイルを使う
+            if len(row) >= 3 and row[0] == sheet and parse_shard_title(sheet, row[1]) and row[1] not in files:
+                files[row[1]] = row[2]
+        for _, title in sorted((parse_shard_title(sheet, title), title) for title in files):
+            shard = gspread.Spreadsheet(spreadsheet.client, {"id": files[title]})
+            result.append(shard.worksheet(title))
+    return result
+
+
+def column_letter(n):
+    """列番号（1始まり）をA1表記の列名に変換"""
+    letters = ""
+    while n:
+        n, rem = divmod(n - 1, 26)
+        letters = chr(ord("A") + rem) + letters
+    return letters
+
+
+def iter_rows(worksheet, start_row=2, columns=26, batch_rows=READ_BATCH_ROWS):
+    """start_row行目以降を範囲指定でまとめて読み、(行番号, 値のリスト) を順に返す"""
+    row = start_row
+    last_column = column_letter(columns)
+    while True:
+        values = worksheet.get(f"A{row}:{last_column}{row + batch_rows - 1}")
+        for offset, values_row in enumerate(values):
+            yield row + offset, list(values_row)
+        if len(values) < batch_rows:
+            return
+        row += batch_rows
+
+
+def rows_as_dicts(rows, header):
+    """(行番号, 値のリスト) をヘッダー名の辞書に変換（末尾の空セルは空文字で補う）"""
+    for row_number, values in rows:
+        values = values + [""] * (len(header) - len(values))
+        yield row_number, dict(zip(header, values))